@@ -4,12 +4,16 @@ from __future__ import annotations
 
 from fastapi import FastAPI, HTTPException, Depends, Header, Request, Query, File, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 import traceback
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
+from dataclasses import dataclass
 from typing import Optional, List
 import tempfile
+import csv
+import io
 import asyncpg
 import os
 from dotenv import load_dotenv
@@ -19,11 +23,18 @@ import json
 import uuid
 import base64
 import asyncio
+import functools
+import time
 import httpx
+import numpy as np
 import re
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, date
 from decimal import Decimal
 
+from users_db import provision_user
+
 _env_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")
 load_dotenv(_env_path)
 
@@ -36,7 +47,19 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 
-app = FastAPI()
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    """Пул БД создаётся (вместе с min_size соединениями) до первого запроса, закрывается при остановке."""
+    try:
+        await get_db()
+    except Exception as e:
+        # API поднимается и без БД; get_db() повторит попытку на первом запросе
+        logging.error("DB pool was not created at startup: %s", e)
+    yield
+    await _close_db()
+
+
+app = FastAPI(lifespan=_lifespan)
 
 # Статика фронта (React/Vite build) — frontend/dist
 _frontend_dist = os.path.join(os.path.dirname(__file__), "frontend", "dist")
@@ -73,6 +96,12 @@ async def unhandled_exception_handler(request, exc):
         )
     return JSONResponse(status_code=500, content={"detail": "Internal Server Error"})
 
+# Кэш ответов /api по версии данных (_response_cache_middleware). Зарегистрирован до CORS, поэтому
+# выполняется внутри него: ответы из кэша и 304 тоже получают CORS-заголовки
+@app.middleware("http")
+async def response_cache_middleware(request: Request, call_next):
+    return await _response_cache_middleware(request, call_next)
+
 # CORS для Telegram Web App
 app.add_middleware(
     CORSMiddleware,
@@ -98,7 +127,61 @@ G_AUTH_URL = os.getenv("GIGACHAT_AUTH_URL")
 G_API_URL = os.getenv("GIGACHAT_API_URL")
 GIGACHAT_MODEL = os.getenv("GIGACHAT_MODEL", "GigaChat:2.0.28.2")
 
-db_pool: Optional[asyncpg.Pool] = None
+# Пул соединений: размеры и таймауты из .env (подбираются по pool-stats под реальный трафик)
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "6"))
+DB_POOL_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_POOL_MAX_INACTIVE_LIFETIME", "300"))  # секунд
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "60"))  # секунд на один запрос к БД
+INTERNAL_API_TOKEN = os.getenv("INTERNAL_API_TOKEN")  # доступ к /api/internal/* на проде
+DASHBOARD_SECTION_TIMEOUT = float(os.getenv("DASHBOARD_SECTION_TIMEOUT", "5"))  # секунд на раздел /api/dashboard
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", "500"))  # строк на одну порцию выгрузки транзакций
+
+db_pool: Optional["_InstrumentedPool"] = None
+_db_pool_lock = asyncio.Lock()
+
+# Кэш проверенных initData: Mini App шлёт один и тот же заголовок весь сеанс,
+# поэтому HMAC и обращение к users нужны один раз. Ключ — sha256(initData), значение — (users.id, истекает_в).
+AUTH_CACHE_MAX_SIZE = int(os.getenv("AUTH_CACHE_MAX_SIZE", "10000"))
+AUTH_CACHE_TTL = int(os.getenv("AUTH_CACHE_TTL", "3600"))  # секунд
+INIT_DATA_MAX_AGE = int(os.getenv("INIT_DATA_MAX_AGE", "86400"))  # запись не живёт дольше auth_date + это значение
+_auth_cache: "OrderedDict[str, tuple[int, float]]" = OrderedDict()
+_auth_inflight: dict[str, asyncio.Task] = {}
+
+# Сессионный токен, выдаваемый /api/auth/telegram: HMAC-подпись user_id и premium_until.
+# Подпись проверяется без БД; что аккаунт не удалён — по кэшу подписки (см. _user_alive).
+SESSION_TOKEN_TTL = int(os.getenv("SESSION_TOKEN_TTL", "3600"))  # секунд
+SESSION_SECRET = os.getenv("SESSION_SECRET")  # если не задан — выводится из BOT_TOKEN
+
+# Кэш подписки: user_id -> (premium_until, истекает_в). Подписку меняет только бот (оплата);
+# он шлёт NOTIFY premium_changed, '<user_id>', а API держит отдельное LISTEN-соединение и вытесняет запись.
+# То же уведомление шлёт DELETE /api/me: запись в кэше — заодно признак, что строка users существует.
+# Без живого LISTEN-соединения кэш не используется.
+PREMIUM_CACHE_MAX_SIZE = int(os.getenv("PREMIUM_CACHE_MAX_SIZE", "10000"))
+PREMIUM_CACHE_TTL = int(os.getenv("PREMIUM_CACHE_TTL", "600"))  # страховка на случай потерянного уведомления
+_premium_cache: "OrderedDict[int, tuple[Optional[datetime], float]]" = OrderedDict()
+_premium_cache_epoch = 0  # растёт при каждом сбросе: подписка, прочитанная до сброса, в кэш не попадает
+_premium_listener: Optional[asyncpg.Connection] = None
+_premium_listener_retry_at = 0.0
+
+# Кэш текущего капитала: user_id -> (CapitalSnapshot, истекает_в). Сбрасывается при записи активов/долгов:
+# API шлёт NOTIFY capital_changed, '<user_id>' в той же транзакции, все реплики вытесняют запись через
+# то же LISTEN-соединение, что и для подписки. Без живого LISTEN-соединения кэш не используется.
+CAPITAL_CACHE_MAX_SIZE = int(os.getenv("CAPITAL_CACHE_MAX_SIZE", "10000"))
+CAPITAL_CACHE_TTL = int(os.getenv("CAPITAL_CACHE_TTL", "600"))  # страховка на случай потерянного уведомления
+_capital_cache: "OrderedDict[int, tuple[CapitalSnapshot, float]]" = OrderedDict()
+_capital_cache_epoch = 0  # растёт при каждом сбросе: снимок, прочитанный до сброса, в кэш не попадает
+
+# Версия данных пользователя (users.data_version) растёт при каждом изменяющем запросе под /api.
+# Кэш версий: user_id -> (версия, истекает_в); сбрасывается по NOTIFY data_changed через то же LISTEN-соединение.
+# Кэш ответов: (user_id, путь, параметры, версия, дата) -> сериализованный JSON; вытесняется по суммарному размеру.
+DATA_VERSION_CACHE_MAX_SIZE = int(os.getenv("DATA_VERSION_CACHE_MAX_SIZE", "10000"))
+DATA_VERSION_CACHE_TTL = int(os.getenv("DATA_VERSION_CACHE_TTL", "600"))  # страховка на случай потерянного уведомления
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+_data_version_cache: "OrderedDict[int, tuple[int, float]]" = OrderedDict()
+_data_version_cache_epoch = 0
+_response_cache: "OrderedDict[tuple, bytes]" = OrderedDict()
+_response_cache_bytes = 0
+_response_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
 
 
 def _json_serializable(val):
@@ -115,18 +198,679 @@ def _row_to_dict(r: asyncpg.Record) -> dict:
     return {k: _json_serializable(r[k]) for k in r.keys()}
 
 
+class _AcquireTimer:
+    """async with pool.acquire(): замеряет ожидание свободного соединения."""
+
+    def __init__(self, pool: "_InstrumentedPool", timeout: Optional[float]):
+        self._pool = pool
+        self._ctx = pool.pool.acquire(timeout=timeout)
+
+    async def __aenter__(self):
+        started = time.perf_counter()
+        self._pool.waiting += 1
+        try:
+            return await self._ctx.__aenter__()
+        finally:
+            self._pool.waiting -= 1
+            self._pool.record_wait(time.perf_counter() - started)
+
+    async def __aexit__(self, *exc):
+        return await self._ctx.__aexit__(*exc)
+
+
+class _InstrumentedPool:
+    """Обёртка над asyncpg.Pool со статистикой ожидания acquire(); остальное проксируется в пул."""
+
+    def __init__(self, pool: asyncpg.Pool):
+        self.pool = pool
+        self.waiting = 0
+        self.acquire_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.recent_waits: deque = deque(maxlen=1000)
+
+    def acquire(self, *, timeout: Optional[float] = None) -> _AcquireTimer:
+        return _AcquireTimer(self, timeout)
+
+    def record_wait(self, seconds: float) -> None:
+        self.acquire_count += 1
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+        self.recent_waits.append(seconds)
+
+    def stats(self) -> dict:
+        recent = sorted(self.recent_waits)
+
+        def pct(p: float) -> float:
+            return round(recent[min(len(recent) - 1, int(len(recent) * p))] * 1000, 2) if recent else 0.0
+
+        return {
+            "size": self.pool.get_size(),
+            "idle": self.pool.get_idle_size(),
+            "min_size": self.pool.get_min_size(),
+            "max_size": self.pool.get_max_size(),
+            "waiting": self.waiting,
+            "acquire_count": self.acquire_count,
+            "acquire_wait_avg_ms": round(self.wait_total / self.acquire_count * 1000, 2) if self.acquire_count else 0.0,
+            "acquire_wait_max_ms": round(self.wait_max * 1000, 2),
+            "acquire_wait_p50_ms": pct(0.5),
+            "acquire_wait_p95_ms": pct(0.95),
+        }
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+
 async def get_db():
     global db_pool
     if db_pool is None:
-        db_pool = await asyncpg.create_pool(
+        # Параллельные первые запросы не должны создать два пула
+        async with _db_pool_lock:
+            if db_pool is None:
+                pool = await asyncpg.create_pool(
+                    user=DB_USER, password=DB_PASSWORD, database=DB_NAME,
+                    host=DB_HOST, port=DB_PORT,
+                    min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE,
+                    max_inactive_connection_lifetime=DB_POOL_MAX_INACTIVE_LIFETIME,
+                    command_timeout=DB_COMMAND_TIMEOUT,
+                    connection_class=_AppConnection,
+                    init=_init_connection,
+                )
+                db_pool = _InstrumentedPool(pool)
+                await _start_premium_listener()
+    return db_pool
+
+
+async def _close_db():
+    """Закрыть LISTEN-соединение и пул (остановка приложения)."""
+    global db_pool, _premium_listener
+    listener, _premium_listener = _premium_listener, None
+    if listener is not None:
+        try:
+            await listener.close()
+        except Exception as e:
+            logging.warning("premium_changed listener close failed: %s", e)
+    if db_pool is not None:
+        pool, db_pool = db_pool, None
+        await pool.close()
+
+
+# --- Реестр горячих запросов ---
+# Запросы, которые выполняются почти на каждом экране, собраны здесь под именами и готовятся
+# один раз на соединение (init-колбэк пула). Динамические фильтры сведены к фиксированному
+# тексту: отсутствующий фильтр передаётся как NULL, а не меняет SQL.
+
+_STATEMENTS: dict[str, str] = {
+    # Список транзакций: $2/$3 — границы периода, $4 — начала выбранных месяцев,
+    # $5 — категории, $6 — TRUE доходы / FALSE расходы, $7 — limit,
+    # $8/$9 — курсор (created_at, id) последней строки предыдущей страницы; первая страница — (infinity, NULL).
+    # Курсор задан и как граница created_at <= $8 — по индексу (user_id, created_at DESC, id DESC) любая
+    # страница начинается сразу с нужного места, без пропуска предыдущих строк.
+    "tx_list": """
+        SELECT t.id, t.amount, c.name AS category, t.description, t.created_at
+        FROM transactions t
+        JOIN categories c ON c.id = t.category_id
+        WHERE t.user_id = $1
+          AND t.created_at >= $2::timestamp AND t.created_at < $3::timestamp
+          AND ($4::timestamp[] IS NULL OR date_trunc('month', t.created_at) = ANY($4::timestamp[]))
+          AND ($5::text[] IS NULL OR c.name = ANY($5::text[]))
+          AND ($6::bool IS NULL OR (t.amount >= 0) = $6::bool)
+          AND t.created_at <= $8::timestamp
+          AND ($9::bigint IS NULL OR t.created_at < $8::timestamp OR t.id < $9::bigint)
+        ORDER BY t.created_at DESC, t.id DESC
+        LIMIT $7
+    """,
+    # Сводка по тем же фильтрам; $7 — исключаемые категории (переводы)
+    "tx_summary": """
+        SELECT
+            COALESCE(SUM(CASE WHEN t.amount < 0 THEN -t.amount ELSE 0 END), 0) AS total_expense,
+            COALESCE(SUM(CASE WHEN t.amount > 0 THEN t.amount ELSE 0 END), 0) AS total_income,
+            COUNT(CASE WHEN t.amount < 0 THEN 1 END)::int AS count_expense,
+            COUNT(CASE WHEN t.amount > 0 THEN 1 END)::int AS count_income
+        FROM transactions t
+        JOIN categories c ON c.id = t.category_id
+        WHERE t.user_id = $1
+          AND t.created_at >= $2::timestamp AND t.created_at < $3::timestamp
+          AND ($4::timestamp[] IS NULL OR date_trunc('month', t.created_at) = ANY($4::timestamp[]))
+          AND ($5::text[] IS NULL OR c.name = ANY($5::text[]))
+          AND ($6::bool IS NULL OR (t.amount >= 0) = $6::bool)
+          AND ($7::text[] IS NULL OR c.name <> ALL($7::text[]))
+    """,
+    # Те же запросы с поиском по описанию: отдельный текст, чтобы план всегда шёл через
+    # trigram-индекс (migrate_transactions_search.sql); $10 / $8 — шаблон LIKE от _search_pattern.
+    "tx_list_search": """
+        SELECT t.id, t.amount, c.name AS category, t.description, t.created_at
+        FROM transactions t
+        JOIN categories c ON c.id = t.category_id
+        WHERE t.user_id = $1
+          AND tx_search_norm(t.description) LIKE $10
+          AND t.created_at >= $2::timestamp AND t.created_at < $3::timestamp
+          AND ($4::timestamp[] IS NULL OR date_trunc('month', t.created_at) = ANY($4::timestamp[]))
+          AND ($5::text[] IS NULL OR c.name = ANY($5::text[]))
+          AND ($6::bool IS NULL OR (t.amount >= 0) = $6::bool)
+          AND t.created_at <= $8::timestamp
+          AND ($9::bigint IS NULL OR t.created_at < $8::timestamp OR t.id < $9::bigint)
+        ORDER BY t.created_at DESC, t.id DESC
+        LIMIT $7
+    """,
+    "tx_summary_search": """
+        SELECT
+            COALESCE(SUM(CASE WHEN t.amount < 0 THEN -t.amount ELSE 0 END), 0) AS total_expense,
+            COALESCE(SUM(CASE WHEN t.amount > 0 THEN t.amount ELSE 0 END), 0) AS total_income,
+            COUNT(CASE WHEN t.amount < 0 THEN 1 END)::int AS count_expense,
+            COUNT(CASE WHEN t.amount > 0 THEN 1 END)::int AS count_income
+        FROM transactions t
+        JOIN categories c ON c.id = t.category_id
+        WHERE t.user_id = $1
+          AND tx_search_norm(t.description) LIKE $8
+          AND t.created_at >= $2::timestamp AND t.created_at < $3::timestamp
+          AND ($4::timestamp[] IS NULL OR date_trunc('month', t.created_at) = ANY($4::timestamp[]))
+          AND ($5::text[] IS NULL OR c.name = ANY($5::text[]))
+          AND ($6::bool IS NULL OR (t.amount >= 0) = $6::bool)
+          AND ($7::text[] IS NULL OR c.name <> ALL($7::text[]))
+    """,
+    # Помесячная сводка за месяцы [$2, $3): из tx_monthly_agg и то же самое по transactions (до миграции)
+    "tx_monthly_agg_range": """
+        SELECT a.year, a.month, c.name AS category, c.type AS category_type,
+               a.income, a.expense, a.count
+        FROM tx_monthly_agg a
+        LEFT JOIN categories c ON c.id = a.category_id
+        WHERE a.user_id = $1 AND make_date(a.year, a.month, 1) >= $2::date AND make_date(a.year, a.month, 1) < $3::date
+    """,
+    "tx_monthly_raw_range": """
+        SELECT EXTRACT(YEAR FROM t.created_at)::int AS year, EXTRACT(MONTH FROM t.created_at)::int AS month,
+               c.name AS category, c.type AS category_type,
+               SUM(GREATEST(t.amount, 0)) AS income, SUM(GREATEST(-t.amount, 0)) AS expense, COUNT(*)::int AS count
+        FROM transactions t
+        LEFT JOIN categories c ON c.id = t.category_id
+        WHERE t.user_id = $1 AND t.created_at >= $2::date AND t.created_at < $3::date
+        GROUP BY 1, 2, c.name, c.type
+    """,
+    # Доходы и расходы по категориям за [$2, $3), крупнейшие расходы первыми: статистика за месяц, квартал, год.
+    # Сводка — если границы совпадают с началом месяца, иначе (произвольный диапазон дат) — сами транзакции.
+    "stats_by_category_agg": """
+        SELECT c.name AS category, SUM(a.income) AS income, SUM(a.expense) AS expense
+        FROM tx_monthly_agg a
+        LEFT JOIN categories c ON c.id = a.category_id
+        WHERE a.user_id = $1 AND make_date(a.year, a.month, 1) >= $2::date AND make_date(a.year, a.month, 1) < $3::date
+        GROUP BY c.name
+        ORDER BY expense DESC
+    """,
+    "stats_by_category_raw": """
+        SELECT c.name AS category, SUM(GREATEST(t.amount, 0)) AS income, SUM(GREATEST(-t.amount, 0)) AS expense
+        FROM transactions t
+        LEFT JOIN categories c ON c.id = t.category_id
+        WHERE t.user_id = $1 AND t.created_at >= $2::date::timestamp AND t.created_at < $3::date::timestamp
+        GROUP BY c.name
+        ORDER BY expense DESC
+    """,
+    # Лимиты пользователя и потраченное в месяце $2 — один запрос на все бюджеты.
+    # Потраченное — строка сводки (пользователь, месяц, категория): поиск по первичному ключу на каждый бюджет.
+    "budgets_status_agg": """
+        SELECT b.id, b.category, b.monthly_limit, COALESCE(a.expense, 0) AS spent
+        FROM budgets b
+        LEFT JOIN categories c ON c.name = b.category
+        LEFT JOIN tx_monthly_agg a
+               ON a.user_id = b.user_id AND a.category_id = c.id
+              AND a.year = EXTRACT(YEAR FROM $2::date)::int AND a.month = EXTRACT(MONTH FROM $2::date)::int
+        WHERE b.user_id = $1
+        ORDER BY b.category
+    """,
+    "budgets_status_raw": """
+        SELECT b.id, b.category, b.monthly_limit, COALESCE(s.spent, 0) AS spent
+        FROM budgets b
+        LEFT JOIN categories c ON c.name = b.category
+        LEFT JOIN (
+            SELECT category_id, SUM(-amount) AS spent
+            FROM transactions
+            WHERE user_id = $1 AND amount < 0
+              AND created_at >= $2::date::timestamp AND created_at < $3::date::timestamp
+            GROUP BY category_id
+        ) s ON s.category_id = c.id
+        WHERE b.user_id = $1
+        ORDER BY b.category
+    """,
+    # Сохранённые бейджи и алерты, если они посчитаны для текущей версии данных и текущего месяца.
+    # Заодно возвращает версию данных — с ней сохраняется новый результат.
+    "user_insights_get": """
+        SELECT u.data_version, i.badges, i.alerts
+        FROM users u
+        LEFT JOIN user_insights i ON i.user_id = u.id AND i.data_version = u.data_version AND i.period = $2::date
+        WHERE u.id = $1
+    """,
+    # Не затирает результат, посчитанный параллельно для более новой версии данных
+    "user_insights_put": """
+        INSERT INTO user_insights AS i (user_id, data_version, period, badges, alerts, evaluated_at)
+        VALUES ($1, $2, $3::date, $4::jsonb, $5::jsonb, NOW())
+        ON CONFLICT (user_id) DO UPDATE
+        SET data_version = EXCLUDED.data_version, period = EXCLUDED.period,
+            badges = EXCLUDED.badges, alerts = EXCLUDED.alerts, evaluated_at = EXCLUDED.evaluated_at
+        WHERE i.data_version <= EXCLUDED.data_version
+    """,
+    # Помесячный денежный поток за [$2, $3): generate_series даёт строку и для месяцев без операций
+    "cash_flow_agg": """
+        SELECT g.month_start::date AS month_start,
+               COALESCE(SUM(a.income), 0) AS income, COALESCE(SUM(a.expense), 0) AS expense
+        FROM generate_series($2::date::timestamp, $3::date::timestamp - INTERVAL '1 month', INTERVAL '1 month') AS g(month_start)
+        LEFT JOIN tx_monthly_agg a
+               ON a.user_id = $1
+              AND a.year = EXTRACT(YEAR FROM g.month_start)::int
+              AND a.month = EXTRACT(MONTH FROM g.month_start)::int
+        GROUP BY g.month_start
+        ORDER BY g.month_start
+    """,
+    "cash_flow_raw": """
+        SELECT g.month_start::date AS month_start,
+               COALESCE(t.income, 0) AS income, COALESCE(t.expense, 0) AS expense
+        FROM generate_series($2::date::timestamp, $3::date::timestamp - INTERVAL '1 month', INTERVAL '1 month') AS g(month_start)
+        LEFT JOIN (
+            SELECT date_trunc('month', created_at) AS month_start,
+                   SUM(GREATEST(amount, 0)) AS income, SUM(GREATEST(-amount, 0)) AS expense
+            FROM transactions
+            WHERE user_id = $1 AND created_at >= $2::date AND created_at < $3::date
+            GROUP BY 1
+        ) t ON t.month_start = g.month_start
+        ORDER BY g.month_start
+    """,
+    # Текущий капитал: assets/liabilities.current_* (обновляются при каждой записи значения).
+    # *_history — те же запросы по истории значений, пока migrate_current_balances.sql не применена.
+    "assets_latest": """
+        SELECT id AS asset_id, title, type, currency,
+               current_amount AS amount, current_as_of AS updated_at
+        FROM assets
+        WHERE user_id = $1 AND (current_amount IS NULL OR current_amount > 0)
+        ORDER BY type, current_amount ASC
+    """,
+    "liabilities_latest": """
+        SELECT id AS liability_id, title, type, currency,
+               current_amount AS amount, current_monthly_payment AS monthly_payment, current_as_of AS updated_at
+        FROM liabilities
+        WHERE user_id = $1 AND (current_amount IS NULL OR current_amount > 0)
+        ORDER BY type, current_amount ASC
+    """,
+    "assets_latest_history": """
+        SELECT a.id AS asset_id, a.title, a.type, a.currency,
+               v.amount, v.created_at AS updated_at
+        FROM assets a
+        LEFT JOIN LATERAL (
+            SELECT amount, created_at
+            FROM asset_values
+            WHERE asset_id = a.id
+            ORDER BY created_at DESC
+            LIMIT 1
+        ) v ON TRUE
+        WHERE a.user_id = $1 AND (v.amount IS NULL OR v.amount > 0)
+        ORDER BY a.type, v.amount ASC
+    """,
+    "liabilities_latest_history": """
+        SELECT l.id AS liability_id, l.title, l.type, l.currency,
+               v.amount, v.monthly_payment, v.created_at AS updated_at
+        FROM liabilities l
+        LEFT JOIN LATERAL (
+            SELECT amount, monthly_payment, created_at
+            FROM liability_values
+            WHERE liability_id = l.id
+            ORDER BY created_at DESC
+            LIMIT 1
+        ) v ON TRUE
+        WHERE l.user_id = $1 AND (v.amount IS NULL OR v.amount > 0)
+        ORDER BY l.type, v.amount ASC
+    """,
+    # Снимок текущего капитала одним запросом: $2/$3 — ликвидные типы активов/долгов.
+    # Платежи — только по непогашенным долгам.
+    "capital_snapshot": """
+        SELECT a.total_assets, a.liquid_assets, l.total_liabilities, l.liquid_liabilities, l.monthly_payments
+        FROM (
+            SELECT COALESCE(SUM(current_amount), 0) AS total_assets,
+                   COALESCE(SUM(current_amount) FILTER (WHERE type = ANY($2::text[])), 0) AS liquid_assets
+            FROM assets
+            WHERE user_id = $1
+        ) a, (
+            SELECT COALESCE(SUM(current_amount), 0) AS total_liabilities,
+                   COALESCE(SUM(current_amount) FILTER (WHERE type = ANY($3::text[])), 0) AS liquid_liabilities,
+                   COALESCE(SUM(current_monthly_payment) FILTER (WHERE current_amount > 0), 0) AS monthly_payments
+            FROM liabilities
+            WHERE user_id = $1
+        ) l
+    """,
+    "capital_snapshot_history": """
+        SELECT a.total_assets, a.liquid_assets, l.total_liabilities, l.liquid_liabilities, l.monthly_payments
+        FROM (
+            SELECT COALESCE(SUM(v.amount), 0) AS total_assets,
+                   COALESCE(SUM(v.amount) FILTER (WHERE a.type = ANY($2::text[])), 0) AS liquid_assets
+            FROM assets a
+            LEFT JOIN LATERAL (
+                SELECT amount FROM asset_values WHERE asset_id = a.id ORDER BY created_at DESC LIMIT 1
+            ) v ON TRUE
+            WHERE a.user_id = $1
+        ) a, (
+            SELECT COALESCE(SUM(v.amount), 0) AS total_liabilities,
+                   COALESCE(SUM(v.amount) FILTER (WHERE l.type = ANY($3::text[])), 0) AS liquid_liabilities,
+                   COALESCE(SUM(v.monthly_payment) FILTER (WHERE v.amount > 0), 0) AS monthly_payments
+            FROM liabilities l
+            LEFT JOIN LATERAL (
+                SELECT amount, monthly_payment FROM liability_values
+                WHERE liability_id = l.id ORDER BY created_at DESC LIMIT 1
+            ) v ON TRUE
+            WHERE l.user_id = $1
+        ) l
+    """,
+    # Капитал на конец каждого периода: $2/$3 — начала первого и последнего периода, $4 — шаг ('1 day' и т.п.).
+    # Каждое новое значение актива/долга — приращение к предыдущему значению той же позиции (LAG),
+    # нарастающий итог приращений по времени = сумма последних значений всех позиций на этот момент.
+    # Границы периодов вставляются в тот же поток событий и получают итог на момент своего начала.
+    "capital_series": """
+        WITH deltas AS (
+            SELECT v.created_at AS at,
+                   v.amount - COALESCE(LAG(v.amount) OVER (PARTITION BY v.asset_id ORDER BY v.created_at), 0) AS d_assets,
+                   0 AS d_liabilities
+            FROM asset_values v JOIN assets a ON a.id = v.asset_id
+            WHERE a.user_id = $1
+            UNION ALL
+            SELECT v.created_at,
+                   0,
+                   v.amount - COALESCE(LAG(v.amount) OVER (PARTITION BY v.liability_id ORDER BY v.created_at), 0)
+            FROM liability_values v JOIN liabilities l ON l.id = v.liability_id
+            WHERE l.user_id = $1
+        ),
+        events AS (
+            SELECT at, 1 AS kind, NULL::timestamp AS period_start, d_assets, d_liabilities FROM deltas
+            UNION ALL
+            SELECT p + $4::text::interval, 0, p, 0, 0
+            FROM generate_series($2::date::timestamp, $3::date::timestamp, $4::text::interval) AS p
+        ),
+        running AS (
+            SELECT kind, period_start,
+                   SUM(d_assets) OVER w AS assets,
+                   SUM(d_liabilities) OVER w AS liabilities
+            FROM events
+            WINDOW w AS (ORDER BY at, kind ROWS UNBOUNDED PRECEDING)
+        )
+        SELECT period_start, COALESCE(assets, 0) AS assets, COALESCE(liabilities, 0) AS liabilities
+        FROM running
+        WHERE kind = 0
+        ORDER BY period_start
+    """,
+    # Консультации (ai_context, content LIKE 'CONSULTATION:%')
+    "consultation_exists": """
+        SELECT 1 FROM ai_context
+        WHERE user_id = $1 AND role = 'assistant' AND content LIKE 'CONSULTATION:%' LIMIT 1
+    """,
+    # Онбординг одним запросом. Шаги, отмеченные в users, только растут (до удаления всех данных):
+    # у отмеченного шага CASE не доходит до ветки ELSE, поэтому у прошедшего онбординг пользователя EXISTS
+    # не выполняются и transactions/assets/liabilities/ai_context не читаются (порядок вычисления OR в SQL
+    # не гарантирован, порядок ветвей CASE — гарантирован). Впервые выполненный шаг сохраняется в users.
+    "onboarding_progress": """
+        WITH f AS (
+            SELECT u.onboarding_transactions AS stored_transactions,
+                   u.onboarding_capital AS stored_capital,
+                   u.onboarding_consultation AS stored_consultation,
+                   CASE WHEN u.onboarding_transactions THEN TRUE
+                        ELSE EXISTS (SELECT 1 FROM transactions WHERE user_id = $1)
+                   END AS has_transactions,
+                   CASE WHEN u.onboarding_capital THEN TRUE
+                        WHEN EXISTS (SELECT 1 FROM assets WHERE user_id = $1) THEN TRUE
+                        ELSE EXISTS (SELECT 1 FROM liabilities WHERE user_id = $1)
+                   END AS has_capital,
+                   CASE WHEN u.onboarding_consultation THEN TRUE
+                        ELSE EXISTS (
+                            SELECT 1 FROM ai_context
+                            WHERE user_id = $1 AND role = 'assistant' AND content LIKE 'CONSULTATION:%'
+                        )
+                   END AS has_consultation
+            FROM users u
+            WHERE u.id = $1
+        ),
+        persist AS (
+            UPDATE users u
+            SET onboarding_transactions = f.has_transactions,
+                onboarding_capital = f.has_capital,
+                onboarding_consultation = f.has_consultation
+            FROM f
+            WHERE u.id = $1
+              AND ((f.has_transactions AND NOT f.stored_transactions)
+                   OR (f.has_capital AND NOT f.stored_capital)
+                   OR (f.has_consultation AND NOT f.stored_consultation))
+        )
+        SELECT has_transactions, has_capital, has_consultation FROM f
+    """,
+    # Без сохранённых шагов (нет строки users или миграции migrate_users_onboarding.sql)
+    "onboarding_progress_live": """
+        SELECT EXISTS (SELECT 1 FROM transactions WHERE user_id = $1) AS has_transactions,
+               EXISTS (SELECT 1 FROM assets WHERE user_id = $1)
+                   OR EXISTS (SELECT 1 FROM liabilities WHERE user_id = $1) AS has_capital,
+               EXISTS (
+                   SELECT 1 FROM ai_context
+                   WHERE user_id = $1 AND role = 'assistant' AND content LIKE 'CONSULTATION:%'
+               ) AS has_consultation
+    """,
+    "consultation_days_since": """
+        SELECT DISTINCT DATE(created_at) AS d
+        FROM ai_context
+        WHERE user_id = $1 AND role = 'assistant' AND content LIKE 'CONSULTATION:%'
+          AND created_at >= $2
+    """,
+    "consultation_last": """
+        SELECT content, DATE(created_at) AS d
+        FROM ai_context
+        WHERE user_id = $1 AND role = 'assistant' AND content LIKE 'CONSULTATION:%'
+        ORDER BY created_at DESC LIMIT 1
+    """,
+    "consultation_history": """
+        SELECT role, content, created_at
+        FROM ai_context
+        WHERE user_id = $1
+          AND (
+            (role = 'assistant' AND content LIKE 'CONSULTATION:%')
+            OR (role = 'user' AND content LIKE 'FOLLOW_UP:%')
+          )
+        ORDER BY created_at ASC
+        LIMIT 500
+    """,
+}
+
+
+class _AppConnection(asyncpg.Connection):
+    """Соединение пула с подготовленными запросами из _STATEMENTS (по имени)."""
+
+    __slots__ = ("_named_statements",)
+
+
+async def _init_connection(conn: _AppConnection) -> None:
+    """init-колбэк пула: подготовить запросы реестра один раз на новое соединение."""
+    conn._named_statements = {}
+    for name, sql in _STATEMENTS.items():
+        try:
+            conn._named_statements[name] = await conn.prepare(sql)
+        except asyncpg.PostgresError as e:
+            # Например, таблицы ещё нет: запрос подготовится при первом вызове
+            # и упадёт там, где у вызывающего кода есть fallback
+            logging.warning("Statement %s not prepared: %s", name, e)
+
+
+async def _run_named(conn, name: str, method: str, args: tuple):
+    statements = getattr(conn, "_named_statements", None)
+    if statements is None:
+        # Соединение не из пула приложения — обычный путь через кэш запросов asyncpg
+        return await getattr(conn, method)(_STATEMENTS[name], *args)
+    for attempt in range(2):
+        stmt = statements.get(name)
+        if stmt is None:
+            stmt = statements[name] = await conn.prepare(_STATEMENTS[name])
+        try:
+            return await getattr(stmt, method)(*args)
+        except (asyncpg.exceptions.InvalidCachedStatementError, asyncpg.exceptions.OutdatedSchemaCacheError):
+            # Схема изменилась после подготовки (миграция) — подготовить заново
+            statements.pop(name, None)
+            if attempt or conn.is_in_transaction():
+                raise
+
+
+async def _fetch(conn, name: str, *args) -> list:
+    """conn.fetch для запроса из реестра _STATEMENTS."""
+    return await _run_named(conn, name, "fetch", args)
+
+
+async def _fetchrow(conn, name: str, *args):
+    """conn.fetchrow для запроса из реестра _STATEMENTS."""
+    return await _run_named(conn, name, "fetchrow", args)
+
+
+async def _fetchval(conn, name: str, *args):
+    """conn.fetchval для запроса из реестра _STATEMENTS."""
+    return await _run_named(conn, name, "fetchval", args)
+
+
+async def _capital_query(conn, method: str, name: str, *args):
+    """Запрос к assets/liabilities.current_*; до миграции колонок — тот же запрос по истории (<name>_history)."""
+    try:
+        return await _run_named(conn, name, method, args)
+    except asyncpg.UndefinedColumnError:
+        return await _run_named(conn, name + "_history", method, args)
+
+
+def _transaction_filters(
+    month: Optional[int],
+    year: Optional[int],
+    period: Optional[List[str]],
+    categories: Optional[List[str]],
+    type_: Optional[str],
+) -> tuple:
+    """Фильтры /api/transactions* → параметры $2..$6 запросов tx_list / tx_summary.
+
+    Периоды "2025-1" сводятся к общим границам (для индекса по created_at) и списку начал месяцев.
+    Без фильтра по дате границы — ±infinity (datetime.min/max в asyncpg).
+    """
+    months = []
+    for p in period or []:
+        parts = p.strip().split("-")
+        if len(parts) != 2:
+            continue
+        try:
+            y, m = int(parts[0]), int(parts[1])
+        except ValueError:
+            continue
+        if 1 <= m <= 12:
+            months.append(datetime(y, m, 1))
+    if months:
+        start = min(months)
+        last = max(months)
+        end = datetime(last.year, last.month + 1, 1) if last.month < 12 else datetime(last.year + 1, 1, 1)
+    elif month is not None and year is not None:
+        start = datetime(year, month, 1)
+        end = datetime(year, month + 1, 1) if month < 12 else datetime(year + 1, 1, 1)
+    else:
+        start, end = datetime.min, datetime.max
+    want_income = {"income": True, "expense": False}.get(type_)
+    return start, end, months or None, categories or None, want_income
+
+
+def _on_premium_changed(conn, pid, channel, payload):
+    """NOTIFY premium_changed: payload — users.id; непонятный payload сбрасывает весь кэш."""
+    try:
+        _premium_cache_forget(int(payload))
+    except (TypeError, ValueError):
+        _premium_cache_forget()
+
+
+def _on_capital_changed(conn, pid, channel, payload):
+    """NOTIFY capital_changed: payload — users.id; непонятный payload сбрасывает весь кэш."""
+    try:
+        _capital_cache_forget(int(payload))
+    except (TypeError, ValueError):
+        _capital_cache_forget()
+
+
+def _on_data_changed(conn, pid, channel, payload):
+    """NOTIFY data_changed: payload — users.id; непонятный payload сбрасывает весь кэш версий."""
+    try:
+        _data_version_forget(int(payload))
+    except (TypeError, ValueError):
+        _data_version_forget()
+
+
+def _on_premium_listener_lost(conn):
+    """LISTEN-соединение закрыто: уведомления могут потеряться, кэши больше не достоверны."""
+    global _premium_listener
+    _premium_listener = None
+    _premium_cache_forget()
+    _capital_cache_forget()
+    _data_version_forget()
+    logging.warning("premium_changed listener connection lost")
+
+
+async def _start_premium_listener():
+    """Открыть отдельное соединение (вне пула) и подписаться на premium_changed, capital_changed и data_changed."""
+    global _premium_listener, _premium_listener_retry_at
+    if _premium_listener is not None:
+        return
+    _premium_listener_retry_at = time.time() + 30
+    try:
+        conn = await asyncpg.connect(
             user=DB_USER, password=DB_PASSWORD, database=DB_NAME,
-            host=DB_HOST, port=DB_PORT, min_size=1, max_size=6
+            host=DB_HOST, port=DB_PORT
         )
-    return db_pool
+        await conn.add_listener("premium_changed", _on_premium_changed)
+        await conn.add_listener("capital_changed", _on_capital_changed)
+        await conn.add_listener("data_changed", _on_data_changed)
+        conn.add_termination_listener(_on_premium_listener_lost)
+    except Exception as e:
+        logging.warning("premium_changed listener not started: %s", e)
+        return
+    _premium_cache_forget()
+    _capital_cache_forget()
+    _data_version_forget()
+    _premium_listener = conn
+
+
+def _premium_cache_get(user_id: int) -> tuple[bool, Optional[datetime]]:
+    """(найдено, premium_until). При отсутствии LISTEN-соединения — промах и попытка переподключиться."""
+    if _premium_listener is None:
+        if db_pool is not None and time.time() >= _premium_listener_retry_at:
+            asyncio.ensure_future(_start_premium_listener())
+        return False, None
+    entry = _premium_cache.get(user_id)
+    if entry is None:
+        return False, None
+    premium_until, expires_at = entry
+    if expires_at <= time.time():
+        _premium_cache.pop(user_id, None)
+        return False, None
+    _premium_cache.move_to_end(user_id)
+    return True, premium_until
+
+
+def _premium_cache_put(user_id: int, premium_until: Optional[datetime], epoch: int) -> None:
+    if _premium_listener is None or epoch != _premium_cache_epoch:
+        return
+    _premium_cache[user_id] = (premium_until, time.time() + PREMIUM_CACHE_TTL)
+    _premium_cache.move_to_end(user_id)
+    while len(_premium_cache) > PREMIUM_CACHE_MAX_SIZE:
+        _premium_cache.popitem(last=False)
+
+
+def _premium_cache_forget(user_id: Optional[int] = None) -> None:
+    """Вытеснить подписку пользователя (без user_id — все)."""
+    global _premium_cache_epoch
+    _premium_cache_epoch += 1
+    if user_id is None:
+        _premium_cache.clear()
+    else:
+        _premium_cache.pop(user_id, None)
 
 # Telegram Web App validation
-def validate_telegram_webapp(init_data: str) -> dict:
-    """Проверка подписи Telegram Web App"""
+@functools.lru_cache(maxsize=1)
+def _webapp_secret_key() -> bytes:
+    """Секретный ключ проверки initData: HMAC("WebAppData", BOT_TOKEN). Не меняется за время жизни процесса."""
+    return hmac.new(
+        "WebAppData".encode(),
+        BOT_TOKEN.encode(),
+        hashlib.sha256
+    ).digest()
+
+
+def _verify_init_data(init_data: str) -> tuple[dict, Optional[int]]:
+    """Проверка подписи Telegram Web App. Возвращает (user, auth_date)."""
     import urllib.parse
     
     try:
@@ -149,22 +893,15 @@ def validate_telegram_webapp(init_data: str) -> dict:
         # Создаем строку для проверки (важно: сортировка по ключам)
         data_check_string = '\n'.join(f"{k}={v}" for k, v in sorted(params.items()))
         
-        # Создаем секретный ключ
-        secret_key = hmac.new(
-            "WebAppData".encode(), 
-            BOT_TOKEN.encode(), 
-            hashlib.sha256
-        ).digest()
-        
         # Вычисляем хеш
         calculated_hash = hmac.new(
-            secret_key,
+            _webapp_secret_key(),
             data_check_string.encode(),
             hashlib.sha256
         ).hexdigest()
         
         # Сравниваем хеши
-        if calculated_hash != hash_value:
+        if not hmac.compare_digest(calculated_hash, hash_value):
             logging.error(f"Hash mismatch. Expected: {hash_value}, Got: {calculated_hash}")
             logging.error(f"Data check string: {data_check_string[:100]}...")
             raise HTTPException(status_code=401, detail="Invalid hash")
@@ -175,8 +912,12 @@ def validate_telegram_webapp(init_data: str) -> dict:
             raise HTTPException(status_code=401, detail="Missing user in initData")
         
         user = json.loads(user_str) if user_str else {}
+        try:
+            auth_date = int(params.get('auth_date') or 0) or None
+        except ValueError:
+            auth_date = None
         
-        return user
+        return user, auth_date
     except HTTPException:
         raise
     except json.JSONDecodeError as e:
@@ -188,6 +929,11 @@ def validate_telegram_webapp(init_data: str) -> dict:
         raise HTTPException(status_code=401, detail=f"Validation error: {str(e)}")
 
 
+def validate_telegram_webapp(init_data: str) -> dict:
+    """Проверка подписи Telegram Web App"""
+    return _verify_init_data(init_data)[0]
+
+
 def _username_from_telegram_user(user: dict) -> Optional[str]:
     """Из объекта user в initData достать username (snake_case или camelCase)."""
     v = user.get('username') or user.get('userName')
@@ -209,6 +955,119 @@ def _is_test_user_request(request: Request) -> bool:
     return APP_ENV == "test" and bool(request.headers.get("x-test-user-id"))
 
 
+@functools.lru_cache(maxsize=1)
+def _session_secret() -> bytes:
+    """Ключ подписи сессионных токенов (SESSION_SECRET или производный от BOT_TOKEN)."""
+    if SESSION_SECRET:
+        return SESSION_SECRET.encode()
+    return hmac.new(b"FinAdvisorSession", BOT_TOKEN.encode(), hashlib.sha256).digest()
+
+
+def _b64url_encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64url_decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def issue_session_token(user_id: int, premium_until: Optional[datetime]) -> tuple[str, int]:
+    """Выпустить токен вида <payload>.<hmac>. Возвращает (token, exp — unix-время истечения)."""
+    exp = int(time.time()) + SESSION_TOKEN_TTL
+    payload = json.dumps(
+        {"uid": user_id, "pu": premium_until.isoformat() if premium_until else None, "exp": exp},
+        separators=(",", ":"),
+    ).encode()
+    body = _b64url_encode(payload)
+    sig = hmac.new(_session_secret(), body.encode(), hashlib.sha256).digest()
+    return f"{body}.{_b64url_encode(sig)}", exp
+
+
+def _read_session_token(token: str) -> Optional[dict]:
+    """Проверить подпись и срок токена. None — токен невалиден или истёк (тогда идём по пути initData)."""
+    try:
+        body, sig = token.split(".", 1)
+        expected = hmac.new(_session_secret(), body.encode(), hashlib.sha256).digest()
+        if not hmac.compare_digest(expected, _b64url_decode(sig)):
+            return None
+        payload = json.loads(_b64url_decode(body))
+        if int(payload.get("exp") or 0) <= time.time():
+            return None
+        user_id = int(payload["uid"])
+        premium_until = datetime.fromisoformat(payload["pu"]) if payload.get("pu") else None
+    except (ValueError, KeyError, TypeError):
+        return None
+    return {"user_id": user_id, "premium_until": premium_until}
+
+
+def _session_claims(request: Request) -> Optional[dict]:
+    """Данные сессионного токена из заголовка Authorization: Bearer (или X-Session-Token); кэшируются на запрос."""
+    if hasattr(request.state, "session_claims"):
+        return request.state.session_claims
+    token = request.headers.get("x-session-token")
+    auth = request.headers.get("authorization") or ""
+    if not token and auth[:7].lower() == "bearer ":
+        token = auth[7:].strip()
+    claims = _read_session_token(token) if token else None
+    request.state.session_claims = claims
+    return claims
+
+
+def _auth_cache_get(key: str) -> Optional[int]:
+    """users.id из кэша initData или None (нет записи / истекла)."""
+    entry = _auth_cache.get(key)
+    if entry is None:
+        return None
+    user_id, expires_at = entry
+    if expires_at <= time.time():
+        _auth_cache.pop(key, None)
+        return None
+    _auth_cache.move_to_end(key)
+    return user_id
+
+
+def _auth_cache_put(key: str, user_id: int, auth_date: Optional[int]) -> None:
+    """Запомнить проверенный initData. TTL ограничен сверху auth_date + INIT_DATA_MAX_AGE; LRU-вытеснение."""
+    expires_at = time.time() + AUTH_CACHE_TTL
+    if auth_date:
+        expires_at = min(expires_at, auth_date + INIT_DATA_MAX_AGE)
+    if expires_at <= time.time():
+        return
+    _auth_cache[key] = (user_id, expires_at)
+    _auth_cache.move_to_end(key)
+    while len(_auth_cache) > AUTH_CACHE_MAX_SIZE:
+        _auth_cache.popitem(last=False)
+
+
+def _auth_cache_forget_user(user_id: int) -> None:
+    """Убрать из кэша все initData пользователя (после удаления аккаунта)."""
+    for key in [k for k, (uid, _) in _auth_cache.items() if uid == user_id]:
+        _auth_cache.pop(key, None)
+
+
+async def _authenticate_init_data(init_data: str, cache_key: str) -> int:
+    """Проверить initData, получить или создать пользователя и положить результат в кэш."""
+    try:
+        user, auth_date = _verify_init_data(init_data)
+        tg_id = user.get('id')
+        
+        if not tg_id:
+            raise HTTPException(status_code=401, detail="Invalid user")
+        
+        # Получаем или создаем пользователя (username или first_name + last_name)
+        display_name = _display_name_from_telegram_user(user)
+        db = await get_db()
+        async with db.acquire() as conn:
+            row = await provision_user(conn, tg_id, display_name)
+        _auth_cache_put(cache_key, row['id'], auth_date)
+        return row['id']
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error in get_user_id: {e}")
+        raise HTTPException(status_code=401, detail=f"Authentication error: {str(e)}")
+
+
 async def get_user_id(request: Request) -> int:
     """Получить user_id из Telegram Web App или в тесте из заголовка X-Test-User-Id"""
     # В тестовой среде разрешаем заголовок X-Test-User-Id (без Telegram)
@@ -222,6 +1081,14 @@ async def get_user_id(request: Request) -> int:
             except ValueError:
                 pass
 
+    # Быстрый путь: валидный сессионный токен — без HMAC initData и (при попадании в кэш подписки) без БД
+    claims = _session_claims(request)
+    if claims is not None:
+        if await _user_alive(request, claims["user_id"]):
+            return claims["user_id"]
+        # Аккаунт удалён после выдачи токена — токен не принимаем, дальше как без него
+        request.state.session_claims = None
+
     # Пробуем получить init-data из заголовков (nginx может передавать как init-data или init_data)
     init_data = request.headers.get("init-data") or request.headers.get("init_data")
 
@@ -229,56 +1096,134 @@ async def get_user_id(request: Request) -> int:
         logging.warning("Missing init-data header in request")
         raise HTTPException(status_code=401, detail="Missing initData. Откройте приложение через Telegram.")
 
-    try:
-        user = validate_telegram_webapp(init_data)
-        tg_id = user.get('id')
-        
-        if not tg_id:
-            raise HTTPException(status_code=401, detail="Invalid user")
-        
-        # Получаем или создаем пользователя (username или first_name + last_name)
-        display_name = _display_name_from_telegram_user(user)
-        db = await get_db()
-        async with db.acquire() as conn:
-            row = await conn.fetchrow("SELECT id, username FROM users WHERE tg_id=$1", tg_id)
-            if not row:
-                await conn.execute(
-                    "INSERT INTO users (tg_id, username, created_at) VALUES ($1, $2, NOW())",
-                    tg_id, display_name
-                )
-                row = await conn.fetchrow("SELECT id FROM users WHERE tg_id=$1", tg_id)
-            else:
-                # Обновить username, если в БД пусто, а в initData есть имя
-                if display_name and (not row['username'] or row['username'] != display_name):
-                    await conn.execute(
-                        "UPDATE users SET username=$1 WHERE tg_id=$2",
-                        display_name, tg_id
-                    )
-            return row['id']
-    except HTTPException:
-        raise
-    except Exception as e:
-        logging.error(f"Error in get_user_id: {e}")
-        raise HTTPException(status_code=401, detail=f"Authentication error: {str(e)}")
+    cache_key = hashlib.sha256(init_data.encode()).hexdigest()
+    user_id = _auth_cache_get(cache_key)
+    if user_id is not None:
+        if await _user_alive(request, user_id):
+            return user_id
+        # Аккаунт удалён (в другом процессе API) — initData проверяется заново
+        _auth_cache.pop(cache_key, None)
+
+    # Дашборд шлёт 8–10 запросов одновременно: первый проверяет initData, остальные ждут его результат
+    task = _auth_inflight.get(cache_key)
+    if task is None:
+        task = asyncio.ensure_future(_authenticate_init_data(init_data, cache_key))
+        _auth_inflight[cache_key] = task
+        task.add_done_callback(lambda _t: _auth_inflight.pop(cache_key, None))
+    return await asyncio.shield(task)
+
+
+async def _user_alive(request: Request, user_id: int) -> bool:
+    """Строка users ещё существует: запись в кэше подписки (DELETE /api/me её вытесняет во всех процессах)
+    или, при промахе, UserContext запроса — он же потом достаётся get_user_context без второго чтения."""
+    found, _ = _premium_cache_get(user_id)
+    return found or (await _user_context(request, user_id)).exists
+
+
+@dataclass
+class UserContext:
+    """Пользователь в рамках одного запроса: идентификатор, подписка и профиль (одна строка users)."""
+    id: int
+    tg_id: Optional[int] = None
+    premium_until: Optional[datetime] = None
+    gender: Optional[str] = None
+    birth_date: Optional[date] = None
+    marital_status: Optional[str] = None
+    children_count: Optional[int] = None
+    city: Optional[str] = None
+    exists: bool = True  # False — строки users нет (тестовый X-Test-User-Id без записи, удалённый аккаунт)
+
+    @property
+    def premium_active(self) -> bool:
+        return bool(self.premium_until and self.premium_until > datetime.now())
+
+    @property
+    def has_profile(self) -> bool:
+        return bool(
+            self.gender
+            or self.birth_date
+            or self.marital_status
+            or self.children_count is not None
+            or self.city
+        )
 
 
-async def check_premium(user_id: int) -> bool:
-    """Проверить активна ли подписка"""
+async def _load_user_context(user_id: int) -> UserContext:
+    """Прочитать строку users одним запросом."""
     db = await get_db()
+    epoch = _premium_cache_epoch
     async with db.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT premium_until FROM users WHERE id=$1", user_id
-        )
-        if not row or not row['premium_until']:
-            return False
-        return row['premium_until'] > datetime.now()
+        try:
+            row = await conn.fetchrow(
+                """
+                SELECT id, tg_id, premium_until, gender, birth_date, marital_status, children_count, city
+                FROM users WHERE id=$1
+                """,
+                user_id
+            )
+        except asyncpg.UndefinedColumnError:
+            # Миграция профиля (migrate_users_profile.sql) не применена
+            row = await conn.fetchrow("SELECT id, tg_id, premium_until FROM users WHERE id=$1", user_id)
+    if not row:
+        return UserContext(id=user_id, exists=False)
+    _premium_cache_put(user_id, row["premium_until"], epoch)
+    return UserContext(
+        id=row["id"],
+        tg_id=row["tg_id"],
+        premium_until=row["premium_until"],
+        gender=row.get("gender"),
+        birth_date=row.get("birth_date"),
+        marital_status=row.get("marital_status"),
+        children_count=row.get("children_count"),
+        city=row.get("city"),
+    )
+
+
+async def _user_context(request: Optional[Request], user_id: int) -> UserContext:
+    """UserContext, мемоизированный на запрос (request.state.user_context)."""
+    if request is not None:
+        ctx = getattr(request.state, "user_context", None)
+        if ctx is not None and ctx.id == user_id:
+            return ctx
+    ctx = await _load_user_context(user_id)
+    if request is not None:
+        request.state.user_context = ctx
+    return ctx
+
+
+async def get_user_context(request: Request, user_id: int = Depends(get_user_id)) -> UserContext:
+    """Dependency: пользователь, подписка и профиль за один запрос к users на весь HTTP-запрос."""
+    return await _user_context(request, user_id)
+
+
+async def check_premium(user_id: int, request: Optional[Request] = None) -> bool:
+    """Проверить активна ли подписка. Активная подписка из сессионного токена принимается без БД
+    (подписка только продлевается); затем UserContext запроса, кэш подписки (сбрасывается по NOTIFY
+    от бота, поэтому покупка видна сразу) и только потом чтение users."""
+    if request is not None:
+        claims = _session_claims(request)
+        if (
+            claims is not None
+            and claims["user_id"] == user_id
+            and claims["premium_until"]
+            and claims["premium_until"] > datetime.now()
+        ):
+            return True
+        ctx = getattr(request.state, "user_context", None)
+        if ctx is not None and ctx.id == user_id:
+            return ctx.premium_active
+    found, premium_until = _premium_cache_get(user_id)
+    if found:
+        return bool(premium_until and premium_until > datetime.now())
+    ctx = await _user_context(request, user_id)
+    return ctx.premium_active
 
 
 async def require_premium(request: Request, user_id: int = Depends(get_user_id)):
     """Dependency для проверки подписки - возвращает user_id если подписка активна. В тесте с X-Test-User-Id подписку не проверяем."""
     if _is_test_user_request(request):
         return user_id
-    if not await check_premium(user_id):
+    if not await check_premium(user_id, request):
         raise HTTPException(
             status_code=403,
             detail="PREMIUM_REQUIRED"
@@ -374,26 +1319,17 @@ class LogActionRequest(BaseModel):
 # --- Профиль пользователя ---
 
 @app.get("/api/profile")
-async def get_profile(user_id: int = Depends(get_user_id)):
+async def get_profile(ctx: UserContext = Depends(get_user_context)):
     """Получить профиль пользователя (пол, дата рождения, семья, город)."""
-    db = await get_db()
-    try:
-        async with db.acquire() as conn:
-            row = await conn.fetchrow(
-                "SELECT gender, birth_date, marital_status, children_count, city FROM users WHERE id=$1",
-                user_id
-            )
-            if not row:
-                raise HTTPException(status_code=404, detail="User not found")
-            return {
-                "gender": row["gender"],
-                "birth_date": row["birth_date"].isoformat() if row.get("birth_date") else None,
-                "marital_status": row["marital_status"],
-                "children_count": row["children_count"],
-                "city": row["city"],
-            }
-    except asyncpg.UndefinedColumnError:
-        return {"gender": None, "birth_date": None, "marital_status": None, "children_count": None, "city": None}
+    if not ctx.exists:
+        raise HTTPException(status_code=404, detail="User not found")
+    return {
+        "gender": ctx.gender,
+        "birth_date": ctx.birth_date.isoformat() if ctx.birth_date else None,
+        "marital_status": ctx.marital_status,
+        "children_count": ctx.children_count,
+        "city": ctx.city,
+    }
 
 
 @app.put("/api/profile")
@@ -448,10 +1384,12 @@ async def delete_all_user_data(user_id: int = Depends(get_user_id)):
         await conn.execute("DELETE FROM ai_context WHERE user_id = $1", user_id)
         await conn.execute("DELETE FROM goals WHERE user_id = $1", user_id)
         await conn.execute("DELETE FROM transactions WHERE user_id = $1", user_id)
+        await _tx_agg_forget_user(conn, user_id)
         await conn.execute("DELETE FROM asset_values WHERE asset_id IN (SELECT id FROM assets WHERE user_id = $1)", user_id)
         await conn.execute("DELETE FROM assets WHERE user_id = $1", user_id)
         await conn.execute("DELETE FROM liability_values WHERE liability_id IN (SELECT id FROM liabilities WHERE user_id = $1)", user_id)
         await conn.execute("DELETE FROM liabilities WHERE user_id = $1", user_id)
+        await _capital_changed(conn, user_id)
         try:
             await conn.execute("DELETE FROM user_consultation_actions WHERE user_id = $1", user_id)
         except asyncpg.UndefinedTableError:
@@ -464,6 +1402,16 @@ async def delete_all_user_data(user_id: int = Depends(get_user_id)):
             await conn.execute("DELETE FROM user_actions WHERE user_id = $1", user_id)
         except asyncpg.UndefinedTableError:
             pass
+        try:
+            # Онбординг начинается заново
+            await conn.execute(
+                """UPDATE users SET onboarding_transactions = FALSE, onboarding_capital = FALSE,
+                                    onboarding_consultation = FALSE
+                   WHERE id = $1""",
+                user_id
+            )
+        except asyncpg.UndefinedColumnError:
+            pass
     return {"status": "ok", "message": "Все данные удалены. Профиль сохранён."}
 
 
@@ -649,10 +1597,243 @@ async def get_env_info():
     }
 
 
+def _require_internal_access(request: Request) -> None:
+    """Внутренние эндпоинты: в тесте открыты, на проде — только с заголовком X-Internal-Token."""
+    if APP_ENV == "test":
+        return
+    token = request.headers.get("x-internal-token") or ""
+    if not INTERNAL_API_TOKEN or not hmac.compare_digest(token, INTERNAL_API_TOKEN):
+        raise HTTPException(status_code=404, detail="Not available")
+
+
+@app.get("/api/internal/pool-stats")
+async def get_pool_stats(request: Request):
+    """Состояние пула БД: размер, свободные соединения, ожидание acquire() — для подбора DB_POOL_*."""
+    _require_internal_access(request)
+    db = await get_db()
+    return db.stats()
+
+
+# --- Кэш ответов по версии данных пользователя ---
+
+# GET-эндпоинты, ответ которых зависит только от данных самого пользователя (и текущей даты)
+_RESPONSE_CACHE_PATHS = frozenset({
+    "/api/profile",
+    "/api/stats", "/api/stats/monthly",
+    "/api/transactions", "/api/transactions/summary",
+    "/api/goals", "/api/goals/insight",
+    "/api/budgets", "/api/budgets/status",
+    "/api/assets", "/api/liabilities",
+    "/api/capital/summary", "/api/capital/history",
+    "/api/consultation/actions", "/api/consultation/history", "/api/focus-goal",
+    "/api/progress-vs-self", "/api/onboarding-progress", "/api/benchmarks",
+    "/api/alerts", "/api/simulator", "/api/badges",
+    "/api/reports", "/api/dashboard",
+})
+# GET, который пишет данные (новая консультация в ai_context)
+_DATA_CHANGING_GET_PATHS = frozenset({"/api/consultation"})
+# POST без изменения данных, видимых в кэшируемых ответах
+_DATA_VERSION_EXEMPT_PATHS = frozenset({"/api/auth/telegram", "/api/log-action", "/api/transactions/import"})
+_RESPONSE_CACHE_MAX_ENTRY = 1024 * 1024  # ответы крупнее не кэшируются
+
+
+def _data_version_forget(user_id: Optional[int] = None) -> None:
+    """Вытеснить версию пользователя (без user_id — все); прочитанная до этого версия в кэш не попадёт."""
+    global _data_version_cache_epoch
+    _data_version_cache_epoch += 1
+    if user_id is None:
+        _data_version_cache.clear()
+    else:
+        _data_version_cache.pop(user_id, None)
+
+
+async def _data_version(user_id: int) -> Optional[int]:
+    """Текущая версия данных пользователя; None — кэш ответов не используется (нет пользователя или миграции)."""
+    if _premium_listener is not None:
+        entry = _data_version_cache.get(user_id)
+        if entry is not None and entry[1] > time.time():
+            _data_version_cache.move_to_end(user_id)
+            return entry[0]
+    epoch = _data_version_cache_epoch
+    db = await get_db()
+    try:
+        async with db.acquire() as conn:
+            version = await conn.fetchval("SELECT data_version FROM users WHERE id=$1", user_id)
+    except asyncpg.UndefinedColumnError:
+        # migrate_users_data_version.sql не применена
+        return None
+    if version is not None and _premium_listener is not None and epoch == _data_version_cache_epoch:
+        _data_version_cache[user_id] = (version, time.time() + DATA_VERSION_CACHE_TTL)
+        _data_version_cache.move_to_end(user_id)
+        while len(_data_version_cache) > DATA_VERSION_CACHE_MAX_SIZE:
+            _data_version_cache.popitem(last=False)
+    return version
+
+
+async def _bump_data_version(user_id: int) -> None:
+    """Данные пользователя изменились: новая версия в БД, NOTIFY data_changed для остальных реплик."""
+    db = await get_db()
+    try:
+        async with db.acquire() as conn:
+            await conn.execute("UPDATE users SET data_version = data_version + 1 WHERE id=$1", user_id)
+            await conn.execute("SELECT pg_notify('data_changed', $1)", str(user_id))
+    except asyncpg.UndefinedColumnError:
+        return
+    _data_version_forget(user_id)
+    _response_cache_forget_user(user_id)
+
+
+def _response_cache_get(key: tuple) -> Optional[bytes]:
+    body = _response_cache.get(key)
+    if body is None:
+        _response_cache_stats["misses"] += 1
+        return None
+    _response_cache.move_to_end(key)
+    _response_cache_stats["hits"] += 1
+    return body
+
+
+def _response_cache_put(key: tuple, body: bytes) -> None:
+    global _response_cache_bytes
+    if len(body) > _RESPONSE_CACHE_MAX_ENTRY:
+        return
+    old = _response_cache.pop(key, None)
+    if old is not None:
+        _response_cache_bytes -= len(old)
+    _response_cache[key] = body
+    _response_cache_bytes += len(body)
+    while _response_cache_bytes > RESPONSE_CACHE_MAX_BYTES and _response_cache:
+        _, evicted = _response_cache.popitem(last=False)
+        _response_cache_bytes -= len(evicted)
+        _response_cache_stats["evictions"] += 1
+
+
+def _response_cache_forget_user(user_id: int) -> None:
+    """Удалить ответы пользователя (устаревшие версии всё равно недостижимы — освобождаем место)."""
+    global _response_cache_bytes
+    for key in [k for k in _response_cache if k[0] == user_id]:
+        _response_cache_bytes -= len(_response_cache.pop(key))
+
+
+_API_CACHE_CONTROL = "private, no-cache"  # браузер хранит ответ, но перед каждым использованием сверяет ETag
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    """If-None-Match содержит etag (для If-None-Match RFC 9110 требует слабое сравнение — W/ не учитываем)."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in header.split(","))
+
+
+def _not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": _API_CACHE_CONTROL})
+
+
+async def _with_content_etag(request: Request, response):
+    """ETag по содержимому — для GET, ответ которых зависит не только от данных пользователя: экономит трафик, не SQL."""
+    if response.status_code != 200 or response.headers.get("content-type") != "application/json":
+        return response
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+    if _etag_matches(request, etag):
+        return _not_modified(etag)
+    headers = dict(response.headers)
+    headers["ETag"] = etag
+    headers["Cache-Control"] = _API_CACHE_CONTROL
+    return Response(content=body, status_code=200, headers=headers)
+
+
+async def _response_cache_middleware(request: Request, call_next):
+    """GET под /api: 304 по ETag или ответ из кэша по (пользователь, путь, параметры, версия данных);
+    после изменяющих запросов — поднять версию."""
+    path = request.url.path
+    if not path.startswith("/api/") or path.startswith("/api/internal/"):
+        return await call_next(request)
+    method = request.method
+    changes_data = (
+        (method not in ("GET", "HEAD", "OPTIONS") and path not in _DATA_VERSION_EXEMPT_PATHS)
+        or (method == "GET" and path in _DATA_CHANGING_GET_PATHS)
+    )
+    if method != "GET" and not changes_data:
+        return await call_next(request)
+    if method == "GET" and not changes_data and path not in _RESPONSE_CACHE_PATHS:
+        return await _with_content_etag(request, await call_next(request))
+    try:
+        user_id = await get_user_id(request)
+    except HTTPException:
+        return await call_next(request)  # 401 вернёт сам эндпоинт
+
+    if changes_data:
+        # Версию поднимаем и при ошибке: запрос мог успеть что-то записать
+        try:
+            return await call_next(request)
+        finally:
+            try:
+                await _bump_data_version(user_id)
+            except Exception:
+                # Запись уже зафиксирована: 500 заставил бы клиента повторить неидемпотентный запрос.
+                # Кэш этой реплики сбрасываем сами; остальные догонят по DATA_VERSION_CACHE_TTL
+                logging.exception("data_version bump failed for user %s", user_id)
+                _data_version_forget(user_id)
+                _response_cache_forget_user(user_id)
+
+    version = await _data_version(user_id)
+    if version is None:
+        return await _with_content_etag(request, await call_next(request))
+    # Дата в ключе: «текущий месяц», «последние 12 месяцев» и т.п. меняются со сменой дня
+    params = tuple(sorted(request.query_params.multi_items()))
+    today = date.today()
+    # ETag известен до выполнения эндпоинта: совпал — 304 без единого запроса к данным
+    digest = hashlib.sha256(f"{user_id}|{path}|{params}|{today}".encode()).hexdigest()[:24]
+    etag = f'"{version}-{digest}"'
+    if _etag_matches(request, etag):
+        return _not_modified(etag)
+    key = (user_id, path, params, version, today)
+    body = _response_cache_get(key)
+    if body is not None:
+        return Response(
+            content=body, media_type="application/json",
+            headers={"ETag": etag, "Cache-Control": _API_CACHE_CONTROL, "X-Cache": "HIT"},
+        )
+    response = await call_next(request)
+    if response.status_code != 200 or response.headers.get("content-type") != "application/json":
+        return response
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    headers = dict(response.headers)
+    headers["x-cache"] = "MISS"
+    if "no-store" in headers.get("cache-control", ""):
+        # Эндпоинт запретил хранить ответ (неполный дашборд): ни в кэш, ни ETag — ETag по версии данных
+        # совпал бы и после восстановления БД, и клиент получал бы 304 на неполные разделы
+        return Response(content=body, status_code=200, headers=headers)
+    _response_cache_put(key, body)
+    headers.update({"etag": etag, "cache-control": _API_CACHE_CONTROL})
+    return Response(content=body, status_code=200, headers=headers)
+
+
+
+@app.get("/api/internal/cache-stats")
+async def get_cache_stats(request: Request):
+    """Кэш ответов: попадания, промахи, вытеснения, размер — для подбора RESPONSE_CACHE_MAX_BYTES."""
+    _require_internal_access(request)
+    lookups = _response_cache_stats["hits"] + _response_cache_stats["misses"]
+    return {
+        **_response_cache_stats,
+        "hit_ratio": round(_response_cache_stats["hits"] / lookups, 3) if lookups else None,
+        "entries": len(_response_cache),
+        "bytes": _response_cache_bytes,
+        "max_bytes": RESPONSE_CACHE_MAX_BYTES,
+        "data_versions_cached": len(_data_version_cache),
+    }
+
+
 # Auth endpoint (без проверки подписки)
 @app.post("/api/auth/telegram")
 async def auth_telegram(request: Request):
-    """Авторизация через Telegram Web App initData"""
+    """Авторизация через Telegram Web App initData. Возвращает также короткоживущий session_token
+    (заголовок Authorization: Bearer <token>), с которым запросы проходят без проверки initData и без БД."""
     init_data = request.headers.get("init-data") or request.headers.get("init_data")
     
     if not init_data:
@@ -669,30 +1850,20 @@ async def auth_telegram(request: Request):
         display_name = _display_name_from_telegram_user(user)
         db = await get_db()
         async with db.acquire() as conn:
-            row = await conn.fetchrow("SELECT id, premium_until, username FROM users WHERE tg_id=$1", tg_id)
-            if not row:
-                # Новый пользователь - даем 2 бесплатных месяца
-                free_months_until = datetime.now() + timedelta(days=60)
-                await conn.execute(
-                    "INSERT INTO users (tg_id, username, created_at, premium_until) VALUES ($1, $2, NOW(), $3)",
-                    tg_id, display_name, free_months_until
-                )
-                row = await conn.fetchrow("SELECT id, premium_until FROM users WHERE tg_id=$1", tg_id)
-            else:
-                # Обновить username, если в БД пусто, а в initData есть имя
-                if display_name and (not row['username'] or row['username'] != display_name):
-                    await conn.execute(
-                        "UPDATE users SET username=$1 WHERE tg_id=$2",
-                        display_name, tg_id
-                    )
+            # Новый пользователь - даем 2 бесплатных месяца
+            free_months_until = datetime.now() + timedelta(days=60)
+            row = await provision_user(conn, tg_id, display_name, free_months_until)
             
             premium_until = row['premium_until']
             premium_active = premium_until and premium_until > datetime.now()
+            session_token, session_expires_at = issue_session_token(row['id'], premium_until)
             
             return {
                 "user_id": row['id'],
                 "premium_until": premium_until.isoformat() if premium_until else None,
-                "premium_active": premium_active
+                "premium_active": premium_active,
+                "session_token": session_token,
+                "session_expires_at": session_expires_at,
             }
     except HTTPException:
         raise
@@ -733,14 +1904,135 @@ async def read_root():
     )
 
 
+# --- Помесячная сводка транзакций (tx_monthly_agg) ---
+# (user_id, year, month, category_id) → доход, расход, количество. Обновляется в той же транзакции БД,
+# что и запись в transactions; пересобирается scripts/rebuild_tx_monthly_agg.py.
+# Пока миграция не применена, чтение идёт по transactions, а обновление пропускается.
+
+
+def _add_months(d: date, n: int) -> date:
+    """Первое число месяца, отстоящего от d на n месяцев (n может быть отрицательным)."""
+    m = d.year * 12 + d.month - 1 + n
+    return date(m // 12, m % 12 + 1, 1)
+
+
+async def _tx_monthly_rows(conn, user_id: int, start: date, end: date) -> list:
+    """Суммы по (год, месяц, категория) за месяцы [start, end): year, month, category, category_type, income, expense, count."""
+    try:
+        return await _fetch(conn, "tx_monthly_agg_range", user_id, start, end)
+    except asyncpg.UndefinedTableError:
+        return await _fetch(conn, "tx_monthly_raw_range", user_id, start, end)
+
+
+_TX_AGG_APPLY_SQL = """
+    INSERT INTO tx_monthly_agg AS a (user_id, year, month, category_id, income, expense, count)
+    SELECT $1, EXTRACT(YEAR FROM x.created_at)::int, EXTRACT(MONTH FROM x.created_at)::int,
+           COALESCE(x.category_id, 0),
+           $5 * SUM(GREATEST(x.amount, 0)), $5 * SUM(GREATEST(-x.amount, 0)), $5 * COUNT(*)
+    FROM unnest($2::timestamp[], $3::int[], $4::numeric[]) AS x(created_at, category_id, amount)
+    GROUP BY 2, 3, 4
+    ON CONFLICT (user_id, year, month, category_id) DO UPDATE
+    SET income = a.income + EXCLUDED.income,
+        expense = a.expense + EXCLUDED.expense,
+        count = a.count + EXCLUDED.count
+"""
+
+
+async def _tx_agg_apply(conn, user_id: int, rows: list, sign: int) -> None:
+    """Добавить (sign=1) или вычесть (sign=-1) транзакции из сводки. rows — (created_at, category_id, amount)."""
+    if not rows:
+        return
+    try:
+        # Savepoint: отсутствие таблицы сводки не должно откатывать саму запись транзакции
+        async with conn.transaction():
+            await conn.execute(
+                _TX_AGG_APPLY_SQL,
+                user_id,
+                [r[0] for r in rows],
+                [r[1] for r in rows],
+                [r[2] for r in rows],
+                sign,
+            )
+            if sign < 0:
+                await conn.execute("DELETE FROM tx_monthly_agg WHERE user_id = $1 AND count <= 0", user_id)
+    except asyncpg.UndefinedTableError:
+        pass
+
+
+async def _tx_agg_forget_user(conn, user_id: int) -> None:
+    """Удалить сводку пользователя (удаление всех данных / аккаунта)."""
+    try:
+        await conn.execute("DELETE FROM tx_monthly_agg WHERE user_id = $1", user_id)
+    except asyncpg.UndefinedTableError:
+        pass
+
+
 # Статистика
-@app.get("/api/stats")
-async def get_stats(
+async def _period_stats(conn, user_id: int, start: date, end: date) -> dict:
+    """Статистика за [start, end): доходы и расходы по категориям, резерв, инсайт — из одного GROUP BY category."""
+    whole_months = start.day == 1 and end.day == 1
+    rows = None
+    if whole_months:
+        try:
+            rows = await _fetch(conn, "stats_by_category_agg", user_id, start, end)
+        except asyncpg.UndefinedTableError:
+            pass
+    if rows is None:
+        rows = await _fetch(conn, "stats_by_category_raw", user_id, start, end)
+
+    # Строки уже по одной на категорию и отсортированы по расходам
+    income_by_cat = {}
+    expense_by_cat = {}
+    for r in rows:
+        cat = r["category"] or "—"
+        if r["income"]:
+            income_by_cat[cat] = income_by_cat.get(cat, 0) + float(r["income"])
+        if r["expense"]:
+            expense_by_cat[cat] = expense_by_cat.get(cat, 0) + float(r["expense"])
+
+    total_income = sum(income_by_cat.values())
+    total_expense = sum(expense_by_cat.values())
+
+    # Ценность 4: рекомендуемый резервный фонд (3 мес. расходов) — от среднемесячных расходов за период
+    if whole_months:
+        months = (end.year - start.year) * 12 + end.month - start.month
+    else:
+        months = max(1.0, (end - start).days / 30.4375)
+    reserve_recommended = round(total_expense / months * 3, 0) if total_expense else 0
+
+    # Ценность 5: короткий инсайт по топу расходов
+    period = "месяц" if whole_months and months == 1 else "период"
+    top_expense = list(expense_by_cat.items())[:3]
+    total_exp = total_expense or 1
+    insight_parts = [f"{cat}: {int(amt):,} ₽ ({int(100 * amt / total_exp)}%)".replace(",", " ") for cat, amt in top_expense]
+    insight = f"Топ расходов за {period}: " + ", ".join(insight_parts) if insight_parts else f"Пока нет расходов за {period}."
+
+    # Явно приводим к типам, сериализуемым в JSON (избегаем Decimal и т.п.)
+    return {
+        "from": start.isoformat(),
+        "to": (end - timedelta(days=1)).isoformat(),
+        "total_income": float(total_income),
+        "total_expense": float(total_expense),
+        "income_by_category": {k: float(v) for k, v in income_by_cat.items()},
+        "expense_by_category": {k: float(v) for k, v in expense_by_cat.items()},
+        "reserve_recommended": int(reserve_recommended),
+        "insight": insight,
+    }
+
+
+async def _month_stats(
+    conn,
+    user_id: int,
     month: Optional[int] = None,
     year: Optional[int] = None,
-    user_id: int = Depends(get_user_id)
-):
-    """Получить статистику за выбранный месяц (по умолчанию — предыдущий)."""
+    from_: Optional[date] = None,
+    to: Optional[date] = None,
+) -> dict:
+    """Статистика за месяц (по умолчанию — предыдущий) или, если задан from/to, за диапазон дат включительно."""
+    if from_ is not None or to is not None:
+        to = to or datetime.now().date()
+        from_ = from_ or to.replace(day=1)
+        return {"month": None, "year": None, **await _period_stats(conn, user_id, from_, to + timedelta(days=1))}
     now = datetime.now()
     if month is None or year is None:
         # Предыдущий месяц
@@ -749,160 +2041,230 @@ async def get_stats(
         year, month = prev.year, prev.month
     start = date(year, month, 1)
     end = date(year, month + 1, 1) if month < 12 else date(year + 1, 1, 1)
+    return {"month": month, "year": year, **await _period_stats(conn, user_id, start, end)}
 
+
+def _check_stats_range(from_: Optional[date], to: Optional[date]) -> None:
+    if from_ is not None and from_ > (to or datetime.now().date()):
+        raise HTTPException(status_code=400, detail="from must not be after to")
+
+
+@app.get("/api/stats")
+async def get_stats(
+    month: Optional[int] = None,
+    year: Optional[int] = None,
+    from_: Optional[date] = Query(None, alias="from"),
+    to: Optional[date] = None,
+    user_id: int = Depends(get_user_id)
+):
+    """Получить статистику за выбранный месяц (по умолчанию — предыдущий).
+
+    from/to (YYYY-MM-DD, включительно) — произвольный диапазон вместо month/year: квартал, год.
+    Без to — по сегодня, без from — с начала месяца to.
+    """
+    _check_stats_range(from_, to)
     db = await get_db()
     async with db.acquire() as conn:
-        rows = await conn.fetch(
-            """
-            SELECT t.amount, c.name AS category, t.created_at
-            FROM transactions t
-            JOIN categories c ON c.id = t.category_id
-            WHERE t.user_id=$1 AND t.created_at >= $2 AND t.created_at < $3
-            ORDER BY t.created_at ASC
-            """,
-            user_id, start, end
-        )
-        
-        income_by_cat = {}
-        expense_by_cat = {}
-        
-        for r in rows:
-            amount = float(r["amount"])
-            cat = r["category"] or "—"
-            if amount >= 0:
-                income_by_cat[cat] = income_by_cat.get(cat, 0) + amount
-            else:
-                expense_by_cat[cat] = expense_by_cat.get(cat, 0) + (-amount)
-        
-        total_income = sum(income_by_cat.values())
-        total_expense = sum(expense_by_cat.values())
-        
-        # Ценность 4: рекомендуемый резервный фонд (3 мес. расходов)
-        reserve_recommended = round(total_expense * 3, 0) if total_expense else 0
-        
-        # Ценность 5: короткий инсайт по топу расходов
-        top_expense = sorted(expense_by_cat.items(), key=lambda x: -x[1])[:3]
-        total_exp = total_expense or 1
-        insight_parts = [f"{cat}: {int(amt):,} ₽ ({int(100 * amt / total_exp)}%)".replace(",", " ") for cat, amt in top_expense]
-        insight = "Топ расходов за месяц: " + ", ".join(insight_parts) if insight_parts else "Пока нет расходов за месяц."
+        return await _month_stats(conn, user_id, month, year, from_, to)
 
-        # Явно приводим к типам, сериализуемым в JSON (избегаем Decimal и т.п.)
-        return {
-            "month": month,
-            "year": year,
-            "total_income": float(total_income),
-            "total_expense": float(total_expense),
-            "income_by_category": {k: float(v) for k, v in income_by_cat.items()},
-            "expense_by_category": {k: float(v) for k, v in expense_by_cat.items()},
-            "reserve_recommended": int(reserve_recommended),
-            "insight": insight,
-        }
+
+_MONTH_NAMES_RU = (
+    "Январь", "Февраль", "Март", "Апрель", "Май", "Июнь",
+    "Июль", "Август", "Сентябрь", "Октябрь", "Ноябрь", "Декабрь"
+)
+
+
+async def _monthly_cash_flow(conn, user_id: int, end: date, months: int) -> list[dict]:
+    """Доходы, расходы и разница за months месяцев до end (не включая месяц end) — один запрос, пустые месяцы нулями."""
+    start = _add_months(end, -months)
+    try:
+        rows = await _fetch(conn, "cash_flow_agg", user_id, start, end)
+    except asyncpg.UndefinedTableError:
+        rows = await _fetch(conn, "cash_flow_raw", user_id, start, end)
+    result = []
+    for r in rows:
+        y, m = r["month_start"].year, r["month_start"].month
+        income, expense = float(r["income"]), float(r["expense"])
+        result.append({
+            "year": y,
+            "month": m,
+            "label": f"{_MONTH_NAMES_RU[m - 1]} {y}",
+            "income": round(income, 2),
+            "expense": round(expense, 2),
+            "difference": round(income - expense, 2),
+        })
+    return result
 
 
 @app.get("/api/stats/monthly")
-async def get_stats_monthly(user_id: int = Depends(get_user_id)):
-    """Доходы, расходы и разница по месяцам за последние 12 месяцев."""
+async def get_stats_monthly(
+    months: int = Query(12, ge=1, le=120),
+    user_id: int = Depends(get_user_id),
+):
+    """Доходы, расходы и разница по месяцам за последние months завершённых месяцев (по умолчанию 12)."""
     now = datetime.now()
-    result = []
-    month_names_ru = (
-        "Январь", "Февраль", "Март", "Апрель", "Май", "Июнь",
-        "Июль", "Август", "Сентябрь", "Октябрь", "Ноябрь", "Декабрь"
-    )
     db = await get_db()
     async with db.acquire() as conn:
-        for i in range(11, -1, -1):
-            m = now.month - 1 - i
-            y = now.year
-            while m <= 0:
-                m += 12
-                y -= 1
-            start = date(y, m, 1)
-            end = date(y, m + 1, 1) if m < 12 else date(y + 1, 1, 1)
-            rows = await conn.fetch(
-                """
-                SELECT amount FROM transactions t
-                WHERE t.user_id=$1 AND t.created_at >= $2 AND t.created_at < $3
-                """,
-                user_id, start, end
-            )
-            income = sum(float(r["amount"]) for r in rows if float(r["amount"]) > 0)
-            expense = sum(-float(r["amount"]) for r in rows if float(r["amount"]) < 0)
-            result.append({
-                "year": y,
-                "month": m,
-                "label": f"{month_names_ru[m - 1]} {y}",
-                "income": round(income, 2),
-                "expense": round(expense, 2),
-                "difference": round(income - expense, 2),
-            })
-    return result
+        return await _monthly_cash_flow(conn, user_id, date(now.year, now.month, 1), months)
 
 # Транзакции
+_TRANSACTION_FIELDS = ("id", "amount", "category", "description", "created_at")
+
+
+def _search_pattern(q: Optional[str]) -> Optional[str]:
+    """Шаблон LIKE для поиска по описанию: нормализация как у tx_search_norm (регистр, ё → е), %/_ экранируются."""
+    term = (q or "").strip().lower().replace("ё", "е")
+    if not term:
+        return None
+    term = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{term}%"
+
+
+async def _search_query(conn, method: str, name: str, *args):
+    """Запрос с поиском по описанию; до migrate_transactions_search.sql (нет tx_search_norm) — 400 с подсказкой."""
+    try:
+        return await _run_named(conn, name, method, args)
+    except asyncpg.UndefinedFunctionError:
+        raise HTTPException(status_code=400, detail="Search not available. Run scripts/migrate_transactions_search.sql")
+
+
+def _encode_tx_cursor(created_at: datetime, tx_id: int) -> str:
+    return _b64url_encode(f"{created_at.isoformat()}|{tx_id}".encode())
+
+
+def _decode_tx_cursor(cursor: str) -> tuple[datetime, int]:
+    """(created_at, id) из непрозрачного курсора; битый курсор — 400."""
+    try:
+        created_at, tx_id = _b64url_decode(cursor).decode().split("|")
+        return datetime.fromisoformat(created_at), int(tx_id)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
 @app.get("/api/transactions")
 async def get_transactions(
-    limit: int = 100,
+    limit: int = Query(100, ge=1, le=500),  # больше — постранично через next_cursor
     month: Optional[int] = None,
     year: Optional[int] = None,
     categories: Optional[List[str]] = Query(None, alias="category"),  # мультивыбор: category=Cat1&category=Cat2
     period: Optional[List[str]] = Query(None, alias="period"),  # мультивыбор периодов: period=2025-1&period=2025-2
     type_: Optional[str] = Query(None, alias="type"),  # "income" | "expense"
+    paged: bool = False,  # True — ответ {"items", "next_cursor"}, иначе список
+    cursor: Optional[str] = None,  # только при paged: next_cursor предыдущей страницы; пустой или нет — первая страница
+    fields: Optional[str] = None,  # "id,amount,created_at" — только эти поля
+    q: Optional[str] = None,  # поиск по описанию (подстрока, без учёта регистра и ё/е)
     user_id: int = Depends(get_user_id)
 ):
-    """Получить список транзакций с фильтрами (месяц, год, категория/категории, периоды, тип)"""
+    """Получить список транзакций с фильтрами (месяц, год, категория/категории, периоды, тип).
+
+    Форму ответа задаёт только paged: без него — список первых limit транзакций (как раньше); с paged=true —
+    всегда {"items": [...], "next_cursor": ...}: страницы по (created_at, id), следующая — с cursor=next_cursor,
+    next_cursor = null на последней странице. Стоимость любой страницы одинакова.
+    """
+    if cursor is not None and not paged:
+        raise HTTPException(status_code=400, detail="cursor requires paged=true")
+    filters = _transaction_filters(month, year, period, categories, type_)
+    pattern = _search_pattern(q)
+    after_created_at, after_id = _decode_tx_cursor(cursor) if cursor else (datetime.max, None)
+    projection = None
+    if fields:
+        projection = [f.strip() for f in fields.split(",") if f.strip()]
+        unknown = set(projection) - set(_TRANSACTION_FIELDS)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
     db = await get_db()
     async with db.acquire() as conn:
-        conditions = ["t.user_id = $1"]
-        params: List = [user_id]
-        n = 2
-        if period and len(period) > 0:
-            period_conds = []
-            for p in period:
-                parts = p.strip().split("-")
-                if len(parts) == 2:
-                    try:
-                        y, m = int(parts[0]), int(parts[1])
-                        if 1 <= m <= 12:
-                            start = date_type(y, m, 1)
-                            end = date_type(y, m + 1, 1) if m < 12 else date_type(y + 1, 1, 1)
-                            period_conds.append(f"(t.created_at >= ${n}::timestamp AND t.created_at < ${n + 1}::timestamp)")
-                            params.extend([start, end])
-                            n += 2
-                    except ValueError:
-                        pass
-            if period_conds:
-                conditions.append("(" + " OR ".join(period_conds) + ")")
-        elif month is not None and year is not None:
-            start = date_type(year, month, 1)
-            end = date_type(year, month + 1, 1) if month < 12 else date_type(year + 1, 1, 1)
-            conditions.append(f"t.created_at >= ${n}::timestamp")
-            conditions.append(f"t.created_at < ${n + 1}::timestamp")
-            params.extend([start, end])
-            n += 2
-        cat_list = categories or []
-        if cat_list:
-            conditions.append(f"c.name = ANY(${n}::text[])")
-            params.append(cat_list)
-            n += 1
-        if type_ == "income":
-            conditions.append("t.amount >= 0")
-        elif type_ == "expense":
-            conditions.append("t.amount < 0")
-        params.append(limit)
-        q = f"""
-            SELECT t.id, t.amount, c.name AS category, t.description, t.created_at
-            FROM transactions t
-            JOIN categories c ON c.id = t.category_id
-            WHERE {" AND ".join(conditions)}
-            ORDER BY t.created_at DESC
-            LIMIT ${n}
-            """
-        rows = await conn.fetch(q, *params)
-        return [_row_to_dict(r) for r in rows]
+        # Строка сверх limit — признак того, что есть следующая страница
+        args = (user_id, *filters, limit + 1, after_created_at, after_id)
+        if pattern:
+            rows = await _search_query(conn, "fetch", "tx_list_search", *args, pattern)
+        else:
+            rows = await _fetch(conn, "tx_list", *args)
+    page = rows[:limit]
+    items = [
+        {k: _json_serializable(r[k]) for k in projection} if projection else _row_to_dict(r)
+        for r in page
+    ]
+    if not paged:
+        return items
+    next_cursor = _encode_tx_cursor(page[-1]["created_at"], page[-1]["id"]) if len(rows) > limit else None
+    return {"items": items, "next_cursor": next_cursor}
 
 
 TRANSFER_CATEGORIES = ("Переводы людям", "Переводы от людей")
 
 
+_EXPORT_FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "transactions.csv"),
+    "ndjson": ("application/x-ndjson", "transactions.ndjson"),
+}
+
+
+async def _export_transactions(user_id: int, filters: tuple, pattern: Optional[str], fmt: str):
+    """Порции выгрузки: строки читаются серверным курсором по EXPORT_BATCH_ROWS — в памяти только одна порция.
+
+    Соединение занято, пока клиент читает ответ; обрыв соединения отменяет генератор и освобождает его.
+    """
+    # Тот же запрос, что у списка: LIMIT NULL — без ограничения, курсор (infinity, NULL) — с самого начала
+    name = "tx_list_search" if pattern else "tx_list"
+    args = (user_id, *filters, None, datetime.max, None) + ((pattern,) if pattern else ())
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    if fmt == "csv":
+        buf.write("\ufeff")  # BOM — Excel распознаёт UTF-8
+        writer.writerow(_TRANSACTION_FIELDS)
+        yield buf.getvalue().encode()
+        buf.seek(0)
+        buf.truncate()
+    db = await get_db()
+    async with db.acquire() as conn, conn.transaction(isolation="repeatable_read", readonly=True):
+        rows = 0
+        async for r in conn.cursor(_STATEMENTS[name], *args, prefetch=EXPORT_BATCH_ROWS):
+            if fmt == "csv":
+                writer.writerow([
+                    r["created_at"].isoformat() if k == "created_at" and r[k] else r[k]
+                    for k in _TRANSACTION_FIELDS
+                ])
+            else:
+                buf.write(json.dumps(_row_to_dict(r), ensure_ascii=False))
+                buf.write("\n")
+            rows += 1
+            if rows % EXPORT_BATCH_ROWS == 0:
+                yield buf.getvalue().encode()
+                buf.seek(0)
+                buf.truncate()
+        if buf.tell():
+            yield buf.getvalue().encode()
+
+
+@app.get("/api/transactions/export")
+async def export_transactions(
+    month: Optional[int] = None,
+    year: Optional[int] = None,
+    categories: Optional[List[str]] = Query(None, alias="category"),
+    period: Optional[List[str]] = Query(None, alias="period"),
+    type_: Optional[str] = Query(None, alias="type"),
+    q: Optional[str] = None,
+    fmt: str = Query("csv", alias="format", pattern="^(csv|ndjson)$"),
+    user_id: int = Depends(get_user_id),
+):
+    """Выгрузка транзакций (CSV или NDJSON) с теми же фильтрами, что у /api/transactions — потоком, без лимита."""
+    filters = _transaction_filters(month, year, period, categories, type_)
+    pattern = _search_pattern(q)
+    if pattern:
+        # Ответ уже начат, когда запрос дойдёт до БД, — проверяем поиск заранее
+        db = await get_db()
+        async with db.acquire() as conn:
+            if await conn.fetchval("SELECT to_regprocedure('tx_search_norm(text)')") is None:
+                raise HTTPException(status_code=400, detail="Search not available. Run scripts/migrate_transactions_search.sql")
+    media_type, filename = _EXPORT_FORMATS[fmt]
+    return StreamingResponse(
+        _export_transactions(user_id, filters, pattern, fmt),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
 @app.get("/api/transactions/summary")
 async def get_transactions_summary(
     month: Optional[int] = None,
@@ -911,63 +2273,19 @@ async def get_transactions_summary(
     period: Optional[List[str]] = Query(None, alias="period"),
     type_: Optional[str] = Query(None, alias="type"),
     exclude_transfers: bool = Query(False, alias="excludeTransfers"),
+    q: Optional[str] = None,
     user_id: int = Depends(get_user_id),
 ):
     """Сводка по транзакциям (суммы и количество) без лимита — для карточек Расходы/Доходы."""
+    filters = _transaction_filters(month, year, period, categories, type_)
+    excluded = list(TRANSFER_CATEGORIES) if exclude_transfers else None
+    pattern = _search_pattern(q)
     db = await get_db()
     async with db.acquire() as conn:
-        conditions = ["t.user_id = $1"]
-        params: List = [user_id]
-        n = 2
-        if period and len(period) > 0:
-            period_conds = []
-            for p in period:
-                parts = p.strip().split("-")
-                if len(parts) == 2:
-                    try:
-                        y, m = int(parts[0]), int(parts[1])
-                        if 1 <= m <= 12:
-                            start = date_type(y, m, 1)
-                            end = date_type(y, m + 1, 1) if m < 12 else date_type(y + 1, 1, 1)
-                            period_conds.append(f"(t.created_at >= ${n}::timestamp AND t.created_at < ${n + 1}::timestamp)")
-                            params.extend([start, end])
-                            n += 2
-                    except ValueError:
-                        pass
-            if period_conds:
-                conditions.append("(" + " OR ".join(period_conds) + ")")
-        elif month is not None and year is not None:
-            start = date_type(year, month, 1)
-            end = date_type(year, month + 1, 1) if month < 12 else date_type(year + 1, 1, 1)
-            conditions.append(f"t.created_at >= ${n}::timestamp")
-            conditions.append(f"t.created_at < ${n + 1}::timestamp")
-            params.extend([start, end])
-            n += 2
-        cat_list_summary = categories or []
-        if cat_list_summary:
-            conditions.append(f"c.name = ANY(${n}::text[])")
-            params.append(cat_list_summary)
-            n += 1
-        if exclude_transfers:
-            conditions.append(f"c.name NOT IN (${n}, ${n + 1})")
-            params.extend(TRANSFER_CATEGORIES)
-            n += 2
-        if type_ == "income":
-            conditions.append("t.amount >= 0")
-        elif type_ == "expense":
-            conditions.append("t.amount < 0")
-        where_sql = " AND ".join(conditions)
-        q = f"""
-            SELECT
-                COALESCE(SUM(CASE WHEN t.amount < 0 THEN -t.amount ELSE 0 END), 0) AS total_expense,
-                COALESCE(SUM(CASE WHEN t.amount > 0 THEN t.amount ELSE 0 END), 0) AS total_income,
-                COUNT(CASE WHEN t.amount < 0 THEN 1 END)::int AS count_expense,
-                COUNT(CASE WHEN t.amount > 0 THEN 1 END)::int AS count_income
-            FROM transactions t
-            JOIN categories c ON c.id = t.category_id
-            WHERE {where_sql}
-            """
-        row = await conn.fetchrow(q, *params)
+        if pattern:
+            row = await _search_query(conn, "fetchrow", "tx_summary_search", user_id, *filters, excluded, pattern)
+        else:
+            row = await _fetchrow(conn, "tx_summary", user_id, *filters, excluded)
         return {
             "total_expense": float(row["total_expense"]),
             "total_income": float(row["total_income"]),
@@ -998,13 +2316,15 @@ async def create_transaction(transaction: TransactionCreate, user_id: int = Depe
                 except ValueError:
                     raise HTTPException(status_code=400, detail="Invalid date format (use YYYY-MM-DD)")
 
-        await conn.execute(
-            """
-            INSERT INTO transactions (user_id, amount, category_id, description, created_at)
-            VALUES ($1, $2, $3, $4, $5)
-            """,
-            user_id, transaction.amount, cid, transaction.description, created_at
-        )
+        async with conn.transaction():
+            await conn.execute(
+                """
+                INSERT INTO transactions (user_id, amount, category_id, description, created_at)
+                VALUES ($1, $2, $3, $4, $5)
+                """,
+                user_id, transaction.amount, cid, transaction.description, created_at
+            )
+            await _tx_agg_apply(conn, user_id, [(created_at, cid, transaction.amount)], 1)
         return {"status": "ok"}
 
 @app.put("/api/transactions/{tx_id}")
@@ -1015,7 +2335,12 @@ async def update_transaction(
 ):
     """Редактировать транзакцию"""
     db = await get_db()
-    async with db.acquire() as conn:
+    async with db.acquire() as conn, conn.transaction():
+        # Старые значения — чтобы перенести транзакцию в сводке tx_monthly_agg
+        old = await conn.fetchrow(
+            "SELECT created_at, category_id, amount FROM transactions WHERE id=$1 AND user_id=$2 FOR UPDATE",
+            tx_id, user_id
+        )
         if body.amount is not None:
             await conn.execute(
                 "UPDATE transactions SET amount=$1 WHERE id=$2 AND user_id=$3",
@@ -1050,6 +2375,14 @@ async def update_transaction(
                     "UPDATE transactions SET created_at=$1 WHERE id=$2 AND user_id=$3",
                     new_created_at, tx_id, user_id
                 )
+        if old is not None:
+            new = await conn.fetchrow(
+                "SELECT created_at, category_id, amount FROM transactions WHERE id=$1 AND user_id=$2",
+                tx_id, user_id
+            )
+            if tuple(new) != tuple(old):
+                await _tx_agg_apply(conn, user_id, [tuple(old)], -1)
+                await _tx_agg_apply(conn, user_id, [tuple(new)], 1)
         return {"status": "ok"}
 
 @app.delete("/api/transactions/{tx_id}")
@@ -1057,10 +2390,12 @@ async def delete_transaction(tx_id: int, user_id: int = Depends(get_user_id)):
     """Удалить транзакцию"""
     db = await get_db()
     async with db.acquire() as conn:
-        await conn.execute(
-            "DELETE FROM transactions WHERE id=$1 AND user_id=$2",
-            tx_id, user_id
-        )
+        async with conn.transaction():
+            deleted = await conn.fetch(
+                "DELETE FROM transactions WHERE id=$1 AND user_id=$2 RETURNING created_at, category_id, amount",
+                tx_id, user_id
+            )
+            await _tx_agg_apply(conn, user_id, [tuple(r) for r in deleted], -1)
         return {"status": "ok"}
 
 
@@ -1534,30 +2869,37 @@ async def import_transactions_apply(
     """Применить импорт: add — добавить к текущим; replace — удалить транзакции за период [min_date, max_date] из файла и вставить из файла."""
     if body.mode not in ("add", "replace"):
         raise HTTPException(status_code=400, detail="mode must be 'add' or 'replace'")
+    rows = []
+    for t in body.transactions:
+        try:
+            dt = datetime.strptime(t.date[:10], "%Y-%m-%d")
+        except (ValueError, TypeError):
+            dt = datetime.now()
+        rows.append((user_id, t.amount, t.category_id, (t.description or "").strip() or None, dt))
     db = await get_db()
-    async with db.acquire() as conn:
+    async with db.acquire() as conn, conn.transaction():
         if body.mode == "replace" and body.transactions:
             dates = [t.date[:10] for t in body.transactions if t.date and len(t.date) >= 10]
             if dates:
                 min_d, max_d = min(dates), max(dates)
                 min_date = date.fromisoformat(min_d)
                 max_date = date.fromisoformat(max_d)
-                await conn.execute(
-                    "DELETE FROM transactions WHERE user_id = $1 AND created_at::date >= $2 AND created_at::date <= $3",
+                deleted = await conn.fetch(
+                    """
+                    DELETE FROM transactions WHERE user_id = $1 AND created_at::date >= $2 AND created_at::date <= $3
+                    RETURNING created_at, category_id, amount
+                    """,
                     user_id, min_date, max_date
                 )
-        for t in body.transactions:
-            try:
-                dt = datetime.strptime(t.date[:10], "%Y-%m-%d")
-            except (ValueError, TypeError):
-                dt = datetime.now()
-            await conn.execute(
-                """
-                INSERT INTO transactions (user_id, amount, category_id, description, created_at)
-                VALUES ($1, $2, $3, $4, $5)
-                """,
-                user_id, t.amount, t.category_id, (t.description or "").strip() or None, dt
-            )
+                await _tx_agg_apply(conn, user_id, [tuple(r) for r in deleted], -1)
+        await conn.executemany(
+            """
+            INSERT INTO transactions (user_id, amount, category_id, description, created_at)
+            VALUES ($1, $2, $3, $4, $5)
+            """,
+            rows
+        )
+        await _tx_agg_apply(conn, user_id, [(r[4], r[2], r[1]) for r in rows], 1)
     return {"status": "ok", "applied": len(body.transactions)}
 
 # Ликвидные типы для расчёта current целей: активы и долги
@@ -1565,31 +2907,79 @@ _LIQUID_ASSET_TYPES = ("Депозит", "Акции", "Облигации", "Н
 _LIQUID_LIABILITY_TYPES = ("Кредит", "Займ", "Кредитная карта", "Рассрочка")
 
 
-async def _get_liquid_net(conn, user_id: int) -> float:
-    """Текущий ликвидный капитал: сумма ликвидных активов минус сумма ликвидных долгов. Один и тот же для всех целей."""
-    liquid_assets = await conn.fetchval(
-        """
-        SELECT COALESCE(SUM(v.amount), 0)
-        FROM assets a
-        LEFT JOIN LATERAL (
-            SELECT amount FROM asset_values WHERE asset_id = a.id ORDER BY created_at DESC LIMIT 1
-        ) v ON TRUE
-        WHERE a.user_id = $1 AND a.type = ANY($2::text[])
-        """,
-        user_id, list(_LIQUID_ASSET_TYPES)
-    )
-    liquid_liabilities = await conn.fetchval(
-        """
-        SELECT COALESCE(SUM(v.amount), 0)
-        FROM liabilities l
-        LEFT JOIN LATERAL (
-            SELECT amount FROM liability_values WHERE liability_id = l.id ORDER BY created_at DESC LIMIT 1
-        ) v ON TRUE
-        WHERE l.user_id = $1 AND l.type = ANY($2::text[])
-        """,
-        user_id, list(_LIQUID_LIABILITY_TYPES)
+@dataclass
+class CapitalSnapshot:
+    """Текущий капитал пользователя: последние значения всех активов и долгов."""
+    total_assets: float = 0.0
+    total_liabilities: float = 0.0
+    liquid_assets: float = 0.0
+    liquid_liabilities: float = 0.0
+    monthly_payments: float = 0.0  # сумма ежемесячных платежей по непогашенным долгам
+
+    @property
+    def net(self) -> float:
+        return self.total_assets - self.total_liabilities
+
+    @property
+    def liquid_net(self) -> float:
+        """Ликвидный капитал: current для обычных целей, резервный фонд в алертах и бейджах."""
+        return self.liquid_assets - self.liquid_liabilities
+
+
+def _capital_cache_get(user_id: int) -> Optional[CapitalSnapshot]:
+    if _premium_listener is None:
+        return None
+    entry = _capital_cache.get(user_id)
+    if entry is None:
+        return None
+    snapshot, expires_at = entry
+    if expires_at <= time.time():
+        _capital_cache.pop(user_id, None)
+        return None
+    _capital_cache.move_to_end(user_id)
+    return snapshot
+
+
+def _capital_cache_put(user_id: int, snapshot: CapitalSnapshot, epoch: int) -> None:
+    if _premium_listener is None or epoch != _capital_cache_epoch:
+        return
+    _capital_cache[user_id] = (snapshot, time.time() + CAPITAL_CACHE_TTL)
+    _capital_cache.move_to_end(user_id)
+    while len(_capital_cache) > CAPITAL_CACHE_MAX_SIZE:
+        _capital_cache.popitem(last=False)
+
+
+def _capital_cache_forget(user_id: Optional[int] = None) -> None:
+    """Вытеснить снимок пользователя (без user_id — все)."""
+    global _capital_cache_epoch
+    _capital_cache_epoch += 1
+    if user_id is None:
+        _capital_cache.clear()
+    else:
+        _capital_cache.pop(user_id, None)
+
+
+async def _capital_snapshot(conn, user_id: int) -> CapitalSnapshot:
+    """Снимок текущего капитала (один запрос), из кэша — если активы и долги с тех пор не менялись."""
+    snapshot = _capital_cache_get(user_id)
+    if snapshot is not None:
+        return snapshot
+    epoch = _capital_cache_epoch
+    row = await _capital_query(
+        conn, "fetchrow", "capital_snapshot", user_id, list(_LIQUID_ASSET_TYPES), list(_LIQUID_LIABILITY_TYPES)
     )
-    return float(liquid_assets or 0) - float(liquid_liabilities or 0)
+    snapshot = CapitalSnapshot(**{k: float(v or 0) for k, v in dict(row).items()}) if row else CapitalSnapshot()
+    _capital_cache_put(user_id, snapshot, epoch)
+    return snapshot
+
+
+async def _capital_changed(conn, user_id: int) -> None:
+    """Сбросить снимок капитала пользователя: здесь сразу, на всех репликах — по NOTIFY (внутри транзакции — после COMMIT).
+
+    Вызывать после записи: сброс до неё даёт параллельному чтению новую эпоху и старый баланс, который попадёт в кэш.
+    """
+    _capital_cache_forget(user_id)
+    await conn.execute("SELECT pg_notify('capital_changed', $1)", str(user_id))
 
 
 # Цели
@@ -1602,20 +2992,9 @@ async def get_goals(user_id: int = Depends(get_user_id)):
             "SELECT id, title, target, description FROM goals WHERE user_id=$1 ORDER BY id",
             user_id,
         )
-        # Базовый текущий показатель — ликвидный капитал (для обычных целей)
-        liquid_net = await _get_liquid_net(conn, user_id)
-
-        # Текущая сумма долгов — для корректного отображения целей по погашению кредитов/долгов
-        liabs_rows = await conn.fetch(
-            """
-            SELECT l.id, COALESCE(
-                (SELECT amount FROM liability_values WHERE liability_id = l.id ORDER BY created_at DESC LIMIT 1), 0
-            ) as amount
-            FROM liabilities l WHERE l.user_id = $1
-            """,
-            user_id,
-        )
-        total_liabilities = sum(float(r["amount"]) for r in liabs_rows)
+        # Ликвидный капитал — current обычных целей; сумма долгов — для целей по погашению кредитов/долгов
+        capital = await _capital_snapshot(conn, user_id)
+        liquid_net, total_liabilities = capital.liquid_net, capital.total_liabilities
 
         result: list[dict] = []
         for r in rows:
@@ -1674,60 +3053,41 @@ async def delete_goal(goal_id: int, user_id: int = Depends(get_user_id)):
         return {"status": "ok"}
 
 
-@app.get("/api/goals/insight")
-async def get_goals_insight(user_id: int = Depends(get_user_id)):
-    """Ценность 3: прогресс по целям + «через N месяцев». current = ликвидный капитал (активы − долги)."""
-    db = await get_db()
-    now = datetime.now()
-    since_3m = (now.replace(day=1) - timedelta(days=90)).replace(day=1)
-    async with db.acquire() as conn:
-        goals_rows = await conn.fetch(
-            "SELECT id, title, target FROM goals WHERE user_id=$1 ORDER BY id",
-            user_id,
-        )
-        # Базовый текущий показатель — ликвидный капитал (для обычных целей)
-        liquid_net = await _get_liquid_net(conn, user_id)
+def _is_debt_goal(title: str) -> bool:
+    """Цель по погашению кредита/долга (по названию)."""
+    title_lower = (title or "").lower()
+    return ("кредит" in title_lower) or ("долг" in title_lower)
 
-        # Текущая сумма долгов — для корректного отображения целей по погашению кредитов/долгов
-        liabs_rows = await conn.fetch(
-            """
-            SELECT l.id, COALESCE(
-                (SELECT amount FROM liability_values WHERE liability_id = l.id ORDER BY created_at DESC LIMIT 1), 0
-            ) as amount
-            FROM liabilities l WHERE l.user_id = $1
-            """,
-            user_id,
-        )
-        tx_rows = await conn.fetch(
-            "SELECT amount FROM transactions WHERE user_id=$1 AND created_at >= $2",
-            user_id,
-            since_3m,
-        )
-    monthly_savings = 0.0
-    if tx_rows:
-        total_inc = sum(float(r["amount"]) for r in tx_rows if float(r["amount"]) > 0)
-        total_exp = sum(-float(r["amount"]) for r in tx_rows if float(r["amount"]) < 0)
-        monthly_savings = max(0, (total_inc - total_exp) / 3) if len(tx_rows) else 0
 
-    total_liabilities = sum(float(r["amount"]) for r in liabs_rows)
+def _goal_progress(title: str, target: float, capital: CapitalSnapshot) -> tuple[float, float]:
+    """(current, remaining) цели. Цель по кредиту/долгу — погашение текущих долгов, остальные — ликвидный капитал."""
+    if _is_debt_goal(title):
+        # remaining = текущие долги, current = сколько уже погашено относительно изначальной цели (target)
+        return max(0.0, target - capital.total_liabilities), max(0.0, capital.total_liabilities)
+    return capital.liquid_net, max(0.0, target - capital.liquid_net)
+
+
+async def _goals_insight(conn, user_id: int) -> dict:
+    """Прогресс по целям и «через N месяцев» при текущем темпе накоплений."""
+    now = datetime.now()
+    since_3m = (now.date().replace(day=1) - timedelta(days=90)).replace(day=1)
+    goals_rows = await conn.fetch(
+        "SELECT id, title, target FROM goals WHERE user_id=$1 ORDER BY id",
+        user_id,
+    )
+    capital = await _capital_snapshot(conn, user_id)
+    tx_months = await _tx_monthly_rows(conn, user_id, since_3m, _add_months(now.date(), 1))
+    monthly_savings = 0.0
+    if tx_months:
+        total_inc = sum(float(r["income"]) for r in tx_months)
+        total_exp = sum(float(r["expense"]) for r in tx_months)
+        monthly_savings = max(0, (total_inc - total_exp) / 3)
 
     result = []
     for g in goals_rows:
         target = float(g["target"])
         title = g["title"] or ""
-        title_lower = title.lower()
-        is_debt_goal = ("кредит" in title_lower) or ("долг" in title_lower)
-
-        if is_debt_goal:
-            # Для целей по погашению кредитов/долгов:
-            # - remaining = текущие долги,
-            # - current = сколько уже погашено относительно изначальной цели (target).
-            remaining = max(0.0, total_liabilities)
-            current_for_goal = max(0.0, target - total_liabilities)
-        else:
-            remaining = max(0.0, target - liquid_net)
-            current_for_goal = liquid_net
-
+        current_for_goal, remaining = _goal_progress(title, target, capital)
         months_to_goal = int(remaining / monthly_savings) if monthly_savings > 0 else None
         result.append({
             "id": g["id"],
@@ -1740,6 +3100,14 @@ async def get_goals_insight(user_id: int = Depends(get_user_id)):
     return {"goals": result, "monthly_savings": monthly_savings}
 
 
+@app.get("/api/goals/insight")
+async def get_goals_insight(user_id: int = Depends(get_user_id)):
+    """Ценность 3: прогресс по целям + «через N месяцев». current = ликвидный капитал (активы − долги)."""
+    db = await get_db()
+    async with db.acquire() as conn:
+        return await _goals_insight(conn, user_id)
+
+
 # Бюджеты по категориям (ценность 2 — не перерасходовать)
 @app.get("/api/budgets")
 async def get_budgets(user_id: int = Depends(get_user_id)):
@@ -1756,40 +3124,38 @@ async def get_budgets(user_id: int = Depends(get_user_id)):
     return [{"id": r["id"], "category": r["category"], "monthly_limit": float(r["monthly_limit"])} for r in rows]
 
 
+async def _budgets_status(conn, user_id: int) -> list[dict]:
+    """Лимиты по категориям и потраченное за текущий месяц."""
+    month_start = datetime.now().date().replace(day=1)
+    try:
+        try:
+            rows = await _fetch(conn, "budgets_status_agg", user_id, month_start)
+        except asyncpg.UndefinedTableError:
+            # Нет сводки tx_monthly_agg — считаем по транзакциям (тоже одним запросом)
+            rows = await _fetch(conn, "budgets_status_raw", user_id, month_start, _add_months(month_start, 1))
+    except asyncpg.UndefinedTableError:
+        return []
+    result = []
+    for b in rows:
+        spent = float(b["spent"])
+        limit = float(b["monthly_limit"])
+        result.append({
+            "id": b["id"],
+            "category": b["category"],
+            "monthly_limit": limit,
+            "spent": spent,
+            "percent": min(100, int(100 * spent / limit)) if limit > 0 else 0,
+            "over_limit": limit > 0 and spent > limit,
+        })
+    return result
+
+
 @app.get("/api/budgets/status")
 async def get_budgets_status(user_id: int = Depends(get_user_id)):
     """Потрачено по категориям за текущий месяц vs лимиты (для прогресс-баров и алертов)"""
     db = await get_db()
-    now = datetime.now()
-    since = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
     async with db.acquire() as conn:
-        try:
-            budgets = await conn.fetch(
-                "SELECT id, category, monthly_limit FROM budgets WHERE user_id=$1",
-                user_id
-            )
-        except asyncpg.UndefinedTableError:
-            return []
-        result = []
-        for b in budgets:
-            spent_row = await conn.fetchrow(
-                """
-                SELECT COALESCE(SUM(ABS(amount)), 0) as s
-                FROM transactions
-                WHERE user_id=$1 AND category=$2 AND amount < 0 AND created_at >= $3
-                """,
-                user_id, b["category"], since
-            )
-            spent = float(spent_row["s"]) if spent_row else 0
-            limit = float(b["monthly_limit"])
-            result.append({
-                "id": b["id"],
-                "category": b["category"],
-                "monthly_limit": limit,
-                "spent": spent,
-                "percent": min(100, int(100 * spent / limit)) if limit > 0 else 0,
-            })
-    return result
+        return await _budgets_status(conn, user_id)
 
 
 @app.post("/api/budgets")
@@ -1829,30 +3195,68 @@ async def get_assets(user_id: int = Depends(get_user_id)):
     """Получить список активов"""
     db = await get_db()
     async with db.acquire() as conn:
-        rows = await conn.fetch(
-            """
-            SELECT a.id AS asset_id, a.title, a.type, a.currency,
-                   v.amount, v.created_at AS updated_at
-            FROM assets a
-            LEFT JOIN LATERAL (
-                SELECT amount, created_at
-                FROM asset_values
-                WHERE asset_id = a.id
-                ORDER BY created_at DESC
-                LIMIT 1
-            ) v ON TRUE
-            WHERE a.user_id = $1 AND (v.amount IS NULL OR v.amount > 0)
-            ORDER BY a.type, v.amount ASC
-            """,
-            user_id
-        )
+        rows = await _capital_query(conn, "fetch", "assets_latest", user_id)
         return [dict(r) for r in rows]
 
+# Новое значение актива/долга: запись в историю и обновление current_* одним запросом.
+# Условие по current_as_of: из двух параллельных записей текущей остаётся более поздняя.
+_ADD_ASSET_VALUE_SQL = """
+    WITH v AS (
+        INSERT INTO asset_values (asset_id, amount, created_at)
+        VALUES ($1, $2, NOW())
+        RETURNING amount, created_at
+    )
+    UPDATE assets a
+    SET current_amount = v.amount, current_as_of = v.created_at
+    FROM v
+    WHERE a.id = $1 AND (a.current_as_of IS NULL OR a.current_as_of <= v.created_at)
+"""
+
+_ADD_LIABILITY_VALUE_SQL = """
+    WITH v AS (
+        INSERT INTO liability_values (liability_id, amount, monthly_payment, created_at)
+        VALUES ($1, $2, $3, NOW())
+        RETURNING amount, monthly_payment, created_at
+    )
+    UPDATE liabilities l
+    SET current_amount = v.amount, current_monthly_payment = v.monthly_payment, current_as_of = v.created_at
+    FROM v
+    WHERE l.id = $1 AND (l.current_as_of IS NULL OR l.current_as_of <= v.created_at)
+"""
+
+
+async def _add_asset_value(conn, user_id: int, asset_id: int, amount: float) -> None:
+    try:
+        async with conn.transaction():
+            await conn.execute(_ADD_ASSET_VALUE_SQL, asset_id, amount)
+    except asyncpg.UndefinedColumnError:
+        # До migrate_current_balances.sql — только история значений
+        await conn.execute(
+            "INSERT INTO asset_values (asset_id, amount, created_at) VALUES ($1, $2, NOW())",
+            asset_id, amount
+        )
+    await _capital_changed(conn, user_id)
+
+
+async def _add_liability_value(
+    conn, user_id: int, liability_id: int, amount: float, monthly_payment: Optional[float]
+) -> None:
+    try:
+        async with conn.transaction():
+            await conn.execute(_ADD_LIABILITY_VALUE_SQL, liability_id, amount, monthly_payment)
+    except asyncpg.UndefinedColumnError:
+        await conn.execute(
+            "INSERT INTO liability_values (liability_id, amount, monthly_payment, created_at) VALUES ($1, $2, $3, NOW())",
+            liability_id, amount, monthly_payment
+        )
+    await _capital_changed(conn, user_id)
+
+
 @app.post("/api/assets")
 async def create_asset(asset: AssetCreate, user_id: int = Depends(get_user_id)):
     """Создать актив"""
     db = await get_db()
-    async with db.acquire() as conn:
+    async with db.acquire() as conn, conn.transaction():
         asset_id = await conn.fetchval(
             """
             INSERT INTO assets (user_id, type, title, currency, created_at)
@@ -1861,13 +3265,7 @@ async def create_asset(asset: AssetCreate, user_id: int = Depends(get_user_id)):
             """,
             user_id, asset.type, asset.title
         )
-        await conn.execute(
-            """
-            INSERT INTO asset_values (asset_id, amount, created_at)
-            VALUES ($1, $2, NOW())
-            """,
-            asset_id, asset.amount
-        )
+        await _add_asset_value(conn, user_id, asset_id, asset.amount)
         return {"status": "ok", "asset_id": asset_id}
 
 @app.put("/api/assets/{asset_id}")
@@ -1892,14 +3290,9 @@ async def update_asset(
             await conn.execute(
                 "UPDATE assets SET type=$1 WHERE id=$2", body.type, asset_id
             )
+            await _capital_changed(conn, user_id)
         if body.amount is not None:
-            await conn.execute(
-                """
-                INSERT INTO asset_values (asset_id, amount, created_at)
-                VALUES ($1, $2, NOW())
-                """,
-                asset_id, body.amount
-            )
+            await _add_asset_value(conn, user_id, asset_id, body.amount)
         return {"status": "ok"}
 
 @app.delete("/api/assets/{asset_id}")
@@ -1911,6 +3304,7 @@ async def delete_asset(asset_id: int, user_id: int = Depends(get_user_id)):
             "DELETE FROM assets WHERE id=$1 AND user_id=$2",
             asset_id, user_id
         )
+        await _capital_changed(conn, user_id)
         return {"status": "ok"}
 
 # Долги
@@ -1919,30 +3313,14 @@ async def get_liabilities(user_id: int = Depends(get_user_id)):
     """Получить список долгов"""
     db = await get_db()
     async with db.acquire() as conn:
-        rows = await conn.fetch(
-            """
-            SELECT l.id AS liability_id, l.title, l.type, l.currency,
-                   v.amount, v.monthly_payment, v.created_at AS updated_at
-            FROM liabilities l
-            LEFT JOIN LATERAL (
-                SELECT amount, monthly_payment, created_at
-                FROM liability_values
-                WHERE liability_id = l.id
-                ORDER BY created_at DESC
-                LIMIT 1
-            ) v ON TRUE
-            WHERE l.user_id = $1 AND (v.amount IS NULL OR v.amount > 0)
-            ORDER BY l.type, v.amount ASC
-            """,
-            user_id
-        )
+        rows = await _capital_query(conn, "fetch", "liabilities_latest", user_id)
         return [dict(r) for r in rows]
 
 @app.post("/api/liabilities")
 async def create_liability(liability: LiabilityCreate, user_id: int = Depends(get_user_id)):
     """Создать долг"""
     db = await get_db()
-    async with db.acquire() as conn:
+    async with db.acquire() as conn, conn.transaction():
         liability_id = await conn.fetchval(
             """
             INSERT INTO liabilities (user_id, type, title, currency, created_at)
@@ -1951,13 +3329,7 @@ async def create_liability(liability: LiabilityCreate, user_id: int = Depends(ge
             """,
             user_id, liability.type, liability.title
         )
-        await conn.execute(
-            """
-            INSERT INTO liability_values (liability_id, amount, monthly_payment, created_at)
-            VALUES ($1, $2, $3, NOW())
-            """,
-            liability_id, liability.amount, liability.monthly_payment
-        )
+        await _add_liability_value(conn, user_id, liability_id, liability.amount, liability.monthly_payment)
         return {"status": "ok", "liability_id": liability_id}
 
 @app.put("/api/liabilities/{liability_id}")
@@ -1983,6 +3355,7 @@ async def update_liability(
             await conn.execute(
                 "UPDATE liabilities SET type=$1 WHERE id=$2", body.type, liability_id
             )
+            await _capital_changed(conn, user_id)
         if body.amount is not None or body.monthly_payment is not None:
             r = await conn.fetchrow(
                 "SELECT amount, monthly_payment FROM liability_values WHERE liability_id=$1 ORDER BY created_at DESC LIMIT 1",
@@ -1994,13 +3367,7 @@ async def update_liability(
                 amt = body.amount
             if body.monthly_payment is not None:
                 mp = body.monthly_payment
-            await conn.execute(
-                """
-                INSERT INTO liability_values (liability_id, amount, monthly_payment, created_at)
-                VALUES ($1, $2, $3, NOW())
-                """,
-                liability_id, amt, mp
-            )
+            await _add_liability_value(conn, user_id, liability_id, amt, mp)
         return {"status": "ok"}
 
 @app.delete("/api/liabilities/{liability_id}")
@@ -2012,92 +3379,98 @@ async def delete_liability(liability_id: int, user_id: int = Depends(get_user_id
             "DELETE FROM liabilities WHERE id=$1 AND user_id=$2",
             liability_id, user_id
         )
+        await _capital_changed(conn, user_id)
         return {"status": "ok"}
 
 
+# --- Капитал во времени ---
+
+_CAPITAL_STEPS = {"day": "1 day", "week": "1 week", "month": "1 month"}
+_CAPITAL_MAX_POINTS = 1000
+
+
+def _period_start(d: date, granularity: str) -> date:
+    """Начало дня / недели (понедельник) / месяца, которому принадлежит d."""
+    if granularity == "week":
+        return d - timedelta(days=d.weekday())
+    if granularity == "month":
+        return date(d.year, d.month, 1)
+    return d
+
+
+async def _capital_series(conn, user_id: int, start: date, end: date, granularity: str = "month") -> list[dict]:
+    """Активы, долги и чистый капитал на конец каждого периода с start по end (включительно) — одним запросом.
+
+    Returns:
+        list[dict]: period_start (date), assets, liabilities, net — по возрастанию period_start
+    """
+    rows = await _fetch(
+        conn, "capital_series", user_id,
+        _period_start(start, granularity), _period_start(end, granularity), _CAPITAL_STEPS[granularity],
+    )
+    result = []
+    for r in rows:
+        assets, liabilities = float(r["assets"]), float(r["liabilities"])
+        result.append({
+            "period_start": r["period_start"].date(),
+            "assets": assets,
+            "liabilities": liabilities,
+            "net": assets - liabilities,
+        })
+    return result
+
+
 @app.get("/api/capital/summary")
 async def get_capital_summary(user_id: int = Depends(get_user_id)):
     """Текущие суммы активов, долгов и чистый капитал (на сейчас)."""
     db = await get_db()
     async with db.acquire() as conn:
-        assets_rows = await conn.fetch(
-            """
-            SELECT a.id, COALESCE(
-                (SELECT amount FROM asset_values WHERE asset_id = a.id ORDER BY created_at DESC LIMIT 1), 0
-            ) as amount
-            FROM assets a WHERE a.user_id = $1
-            """,
-            user_id
-        )
-        liabs_rows = await conn.fetch(
-            """
-            SELECT l.id, COALESCE(
-                (SELECT amount FROM liability_values WHERE liability_id = l.id ORDER BY created_at DESC LIMIT 1), 0
-            ) as amount
-            FROM liabilities l WHERE l.user_id = $1
-            """,
-            user_id
-        )
-    total_assets = sum(float(r["amount"]) for r in assets_rows)
-    total_liabilities = sum(float(r["amount"]) for r in liabs_rows)
+        capital = await _capital_snapshot(conn, user_id)
     return {
-        "assets": round(total_assets, 2),
-        "liabilities": round(total_liabilities, 2),
-        "net": round(total_assets - total_liabilities, 2),
+        "assets": round(capital.total_assets, 2),
+        "liabilities": round(capital.total_liabilities, 2),
+        "net": round(capital.net, 2),
     }
 
 
 @app.get("/api/capital/history")
-async def get_capital_history(user_id: int = Depends(get_user_id)):
-    """Активы и долги на последнее число каждого из последних 12 месяцев."""
-    now = datetime.now()
-    month_names_ru = (
-        "Январь", "Февраль", "Март", "Апрель", "Май", "Июнь",
-        "Июль", "Август", "Сентябрь", "Октябрь", "Ноябрь", "Декабрь"
-    )
-    result = []
+async def get_capital_history(
+    granularity: str = Query("month", pattern="^(day|week|month)$"),
+    from_: Optional[date] = Query(None, alias="from"),
+    to: Optional[date] = None,
+    user_id: int = Depends(get_user_id),
+):
+    """Активы и долги на конец каждого периода. По умолчанию — 12 завершённых месяцев до текущего.
+
+    granularity: day | week | month; from/to (YYYY-MM-DD) — произвольный диапазон.
+    """
+    today = datetime.now().date()
+    if to is None:
+        # По умолчанию — последний завершённый период (как раньше: последние 12 месяцев без текущего)
+        to = _add_months(today, -1) if granularity == "month" else today
+    if from_ is None:
+        from_ = _add_months(to, -11) if granularity == "month" else to - timedelta(days=11 * (7 if granularity == "week" else 1))
+    if from_ > to:
+        raise HTTPException(status_code=400, detail="from must not be after to")
+    points = (to - from_).days // {"day": 1, "week": 7, "month": 28}[granularity] + 1
+    if points > _CAPITAL_MAX_POINTS:
+        raise HTTPException(status_code=400, detail=f"Too many points (max {_CAPITAL_MAX_POINTS})")
     db = await get_db()
     async with db.acquire() as conn:
-        for i in range(11, -1, -1):
-            m = now.month - 1 - i
-            y = now.year
-            while m <= 0:
-                m += 12
-                y -= 1
-            last_day = date(y, m + 1, 1) - timedelta(days=1) if m < 12 else date(y + 1, 1, 1) - timedelta(days=1)
-            end_dt = datetime.combine(last_day, datetime.max.time().replace(microsecond=0))
-            assets_rows = await conn.fetch(
-                """
-                SELECT a.id, COALESCE(
-                    (SELECT amount FROM asset_values
-                     WHERE asset_id = a.id AND created_at <= $2
-                     ORDER BY created_at DESC LIMIT 1), 0
-                ) as amount
-                FROM assets a WHERE a.user_id = $1
-                """,
-                user_id, end_dt
-            )
-            liabs_rows = await conn.fetch(
-                """
-                SELECT l.id, COALESCE(
-                    (SELECT amount FROM liability_values
-                     WHERE liability_id = l.id AND created_at <= $2
-                     ORDER BY created_at DESC LIMIT 1), 0
-                ) as amount
-                FROM liabilities l WHERE l.user_id = $1
-                """,
-                user_id, end_dt
-            )
-            total_assets = sum(float(r["amount"]) for r in assets_rows)
-            total_liabilities = sum(float(r["amount"]) for r in liabs_rows)
-            result.append({
-                "year": y,
-                "month": m,
-                "label": f"{month_names_ru[m - 1]} {y}",
-                "assets": round(total_assets, 2),
-                "liabilities": round(total_liabilities, 2),
-                "net": round(total_assets - total_liabilities, 2),
-            })
+        series = await _capital_series(conn, user_id, from_, to, granularity)
+    result = []
+    for p in series:
+        d = p["period_start"]
+        label = f"{_MONTH_NAMES_RU[d.month - 1]} {d.year}" if granularity == "month" else d.strftime("%d.%m.%Y")
+        result.append({
+            "year": d.year,
+            "month": d.month,
+            "date": d.isoformat(),
+            "label": label,
+            "assets": round(p["assets"], 2),
+            "liabilities": round(p["liabilities"], 2),
+            "net": round(p["net"], 2),
+        })
     return result
 
 
@@ -2203,40 +3576,23 @@ async def get_benchmarks(user_id: int = Depends(get_user_id)):
     """Бенчмарки: доля от налогооблагаемого дохода (зарплата, дивиденды, прочие доходы). Период: последний год или доступный. Показать только Сбережения и категории, превышающие целевую норму."""
     db = await get_db()
     now = datetime.now()
-    since = (now.replace(day=1) - timedelta(days=365)).replace(day=1)
+    since = (now.date().replace(day=1) - timedelta(days=365)).replace(day=1)
     async with db.acquire() as conn:
-        # Доход за период: только налогооблагаемый (по категориям)
-        income_row = await conn.fetchval(
-            """
-            SELECT COALESCE(SUM(t.amount), 0)
-            FROM transactions t
-            JOIN categories c ON c.id = t.category_id AND c.type = 'Доход'
-            WHERE t.user_id = $1 AND t.amount > 0 AND t.created_at >= $2
-            AND c.name = ANY($3::text[])
-            """,
-            user_id, since, list(_TAXABLE_INCOME_CATEGORIES),
-        )
-        total_income = float(income_row or 0)
-        if total_income <= 0:
-            # Fallback: весь доход за период
-            income_row = await conn.fetchval(
-                "SELECT COALESCE(SUM(amount), 0) FROM transactions WHERE user_id=$1 AND amount > 0 AND created_at >= $2",
-                user_id, since,
-            )
-            total_income = float(income_row or 0)
-        if total_income <= 0:
-            return {"total_income": 0, "categories": [], "savings": None, "period_months": 12}
-        rows = await conn.fetch(
-            """
-            SELECT c.name, SUM(ABS(t.amount)) as total
-            FROM transactions t
-            JOIN categories c ON c.id = t.category_id
-            WHERE t.user_id=$1 AND t.amount < 0 AND t.created_at >= $2
-            GROUP BY c.name
-            """,
-            user_id, since
-        )
-    expenses_by_cat = {r["name"]: float(r["total"]) for r in rows}
+        month_rows = await _tx_monthly_rows(conn, user_id, since, _add_months(now.date(), 1))
+    # Доход за период: только налогооблагаемый (по категориям)
+    total_income = sum(
+        float(r["income"]) for r in month_rows
+        if r["category_type"] == "Доход" and r["category"] in _TAXABLE_INCOME_CATEGORIES
+    )
+    if total_income <= 0:
+        # Fallback: весь доход за период
+        total_income = sum(float(r["income"]) for r in month_rows)
+    if total_income <= 0:
+        return {"total_income": 0, "categories": [], "savings": None, "period_months": 12}
+    expenses_by_cat = {}
+    for r in month_rows:
+        if r["expense"] and r["category"] is not None:
+            expenses_by_cat[r["category"]] = expenses_by_cat.get(r["category"], 0) + float(r["expense"])
     total_expense = sum(expenses_by_cat.values())
     savings = total_income - total_expense
     savings_pct = round((savings / total_income) * 100, 1) if total_income else 0
@@ -2271,44 +3627,26 @@ async def get_benchmarks(user_id: int = Depends(get_user_id)):
 
 # --- Прогресс относительно себя ---
 
-@app.get("/api/progress-vs-self")
-async def get_progress_vs_self(user_id: int = Depends(get_user_id)):
-    """Сравнение: среднее в месяц за последние 12 месяцев vs последний месяц по категориям расходов. Топ-3 по разнице."""
-    db = await get_db()
+async def _progress_vs_self(conn, user_id: int) -> dict:
+    """Топ-3 категории расходов по разнице «последний месяц − среднее за 12 месяцев»."""
     now = datetime.now()
-    # Последние 12 месяцев (для среднего в месяц)
-    start_12 = (now.replace(day=1) - timedelta(days=365)).replace(day=1)
-    end_12 = now
+    # Последние 12 месяцев (для среднего в месяц), включая текущий
+    start_12 = (now.date().replace(day=1) - timedelta(days=365)).replace(day=1)
     # Последний календарный месяц
-    first_day_this = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    last_day_prev = first_day_this - timedelta(days=1)
-    start_last_month = last_day_prev.replace(day=1)
-    end_last_month = last_day_prev
-    async with db.acquire() as conn:
-        # Суммы по категориям за 12 месяцев
-        rows_12 = await conn.fetch(
-            """
-            SELECT c.name, SUM(ABS(t.amount)) as total
-            FROM transactions t JOIN categories c ON c.id = t.category_id
-            WHERE t.user_id=$1 AND t.amount < 0 AND t.created_at >= $2 AND t.created_at <= $3
-            GROUP BY c.name
-            """,
-            user_id, start_12, end_12
-        )
-        # Суммы по категориям за последний месяц
-        rows_last = await conn.fetch(
-            """
-            SELECT c.name, SUM(ABS(t.amount)) as total
-            FROM transactions t JOIN categories c ON c.id = t.category_id
-            WHERE t.user_id=$1 AND t.amount < 0 AND t.created_at >= $2 AND t.created_at <= $3
-            GROUP BY c.name
-            """,
-            user_id, start_last_month, end_last_month
-        )
+    start_last_month = _add_months(now.date(), -1)
+    month_rows = await _tx_monthly_rows(conn, user_id, start_12, _add_months(now.date(), 1))
+    by_cat_12: dict = {}
+    by_cat_last: dict = {}
+    for r in month_rows:
+        if not r["expense"] or r["category"] is None:
+            continue
+        by_cat_12[r["category"]] = by_cat_12.get(r["category"], 0) + float(r["expense"])
+        if (r["year"], r["month"]) == (start_last_month.year, start_last_month.month):
+            by_cat_last[r["category"]] = by_cat_last.get(r["category"], 0) + float(r["expense"])
     # Исключаем категории «переводы» (как в фильтре транзакций)
     _PROGRESS_EXCLUDE_CATEGORIES = ("Переводы людям", "Переводы от людей")
-    by_cat_12 = {r["name"]: float(r["total"]) for r in rows_12 if r["name"] not in _PROGRESS_EXCLUDE_CATEGORIES}
-    by_cat_last = {r["name"]: float(r["total"]) for r in rows_last if r["name"] not in _PROGRESS_EXCLUDE_CATEGORIES}
+    by_cat_12 = {k: v for k, v in by_cat_12.items() if k not in _PROGRESS_EXCLUDE_CATEGORIES}
+    by_cat_last = {k: v for k, v in by_cat_last.items() if k not in _PROGRESS_EXCLUDE_CATEGORIES}
     all_cats = set(by_cat_12) | set(by_cat_last)
     months_with_data = 12
     result = []
@@ -2333,147 +3671,394 @@ async def get_progress_vs_self(user_id: int = Depends(get_user_id)):
     }
 
 
+@app.get("/api/progress-vs-self")
+async def get_progress_vs_self(user_id: int = Depends(get_user_id)):
+    """Сравнение: среднее в месяц за последние 12 месяцев vs последний месяц по категориям расходов. Топ-3 по разнице."""
+    db = await get_db()
+    async with db.acquire() as conn:
+        return await _progress_vs_self(conn, user_id)
+
+
 # --- Прогресс онбординга (пайплайн) ---
 
+async def _onboarding_progress(conn, ctx: UserContext) -> dict:
+    """Флаги пайплайна онбординга — один запрос; профиль берётся из UserContext."""
+    user_id = ctx.id
+    row = None
+    if ctx.exists:
+        try:
+            row = await _fetchrow(conn, "onboarding_progress", user_id)
+        except asyncpg.UndefinedColumnError:
+            pass
+    if row is None:
+        row = await _fetchrow(conn, "onboarding_progress_live", user_id)
+    return {
+        "has_transactions": bool(row["has_transactions"]),
+        "has_capital": bool(row["has_capital"]),
+        "has_profile": ctx.has_profile,
+        "has_consultation": bool(row["has_consultation"]),
+    }
+
+
 @app.get("/api/onboarding-progress")
-async def get_onboarding_progress(user_id: int = Depends(get_user_id)):
+async def get_onboarding_progress(ctx: UserContext = Depends(get_user_context)):
     """Флаги для пайплайна онбординга: 1 транзакция, 1 актив/долг, профиль заполнен, 1 консультация."""
     db = await get_db()
     async with db.acquire() as conn:
-        has_tx = await conn.fetchval(
-            "SELECT 1 FROM transactions WHERE user_id = $1 LIMIT 1", user_id
-        )
-        has_assets = await conn.fetchval("SELECT 1 FROM assets WHERE user_id = $1 LIMIT 1", user_id)
-        has_liabs = await conn.fetchval("SELECT 1 FROM liabilities WHERE user_id = $1 LIMIT 1", user_id)
-        profile_row = await conn.fetchrow(
-            "SELECT gender, birth_date, marital_status, children_count, city FROM users WHERE id = $1",
-            user_id,
-        )
-        has_profile = False
-        if profile_row:
-            has_profile = bool(
-                profile_row.get("gender")
-                or profile_row.get("birth_date")
-                or profile_row.get("marital_status")
-                or profile_row.get("children_count") is not None
-                or profile_row.get("city")
-            )
-        has_consultation = await conn.fetchval(
-            """
-            SELECT 1 FROM ai_context
-            WHERE user_id = $1 AND role = 'assistant' AND content LIKE 'CONSULTATION:%' LIMIT 1
-            """,
-            user_id,
-        )
-    return {
-        "has_transactions": bool(has_tx),
-        "has_capital": bool(has_assets or has_liabs),
-        "has_profile": has_profile,
-        "has_consultation": bool(has_consultation),
-    }
+        return await _onboarding_progress(conn, ctx)
 
 
 # --- Мягкие алерты ---
 
+async def _evaluate_alerts(conn, user_id: int) -> list[dict]:
+    """Мягкие алерты: расходы выше обычного, резервный фонд, превышенные лимиты."""
+    now = datetime.now()
+    alerts = []
+    # Расходы текущего месяца vs средние за предыдущие 3
+    cur_month_start = date(now.year, now.month, 1)
+    month_rows = await _tx_monthly_rows(conn, user_id, _add_months(cur_month_start, -3), _add_months(cur_month_start, 1))
+    cur_exp = sum(
+        float(r["expense"]) for r in month_rows
+        if (r["year"], r["month"]) == (cur_month_start.year, cur_month_start.month)
+    )
+    prev_avg = (sum(float(r["expense"]) for r in month_rows) - cur_exp) / 3
+    if prev_avg > 0 and cur_exp > prev_avg * 1.15:
+        pct = int(round((cur_exp / prev_avg - 1) * 100))
+        alerts.append({"type": "expense_above", "text": f"В этом месяце расходы пока на {pct}% выше среднего за предыдущие 3 месяца."})
+    # Резервный фонд: месячные расходы и сколько месяцев покрывает ликвидный капитал
+    liquid_net = (await _capital_snapshot(conn, user_id)).liquid_net
+    if prev_avg > 0 and liquid_net >= 0:
+        months_reserve = liquid_net / prev_avg
+        if months_reserve < 3:
+            alerts.append({"type": "reserve_low", "text": f"Резервный фонд покрывает около {months_reserve:.1f} мес. расходов. Рекомендуется 3–6 мес."})
+        elif months_reserve >= 3:
+            alerts.append({"type": "reserve_ok", "text": f"Резервный фонд покрывает около {months_reserve:.1f} мес. расходов."})
+    # Превышенные лимиты: статус бюджетов — один запрос по числу бюджетов, без чтения транзакций
+    for b in await _budgets_status(conn, user_id):
+        if b["over_limit"]:
+            text = f"Лимит по категории «{b['category']}» превышен: {int(b['spent']):,} ₽ из {int(b['monthly_limit']):,} ₽.".replace(",", " ")
+            alerts.append({"type": "budget_over", "text": text})
+    return alerts
+
+
+async def _alerts(conn, user_id: int) -> dict:
+    return {"alerts": (await _insights(conn, user_id))["alerts"]}
+
+
 @app.get("/api/alerts")
 async def get_alerts(user_id: int = Depends(get_user_id)):
     """Мягкие алерты: расходы выше обычного, до цели по резерву и т.д."""
     db = await get_db()
-    now = datetime.now()
-    alerts = []
     async with db.acquire() as conn:
-        # Расходы текущего месяца vs средние за предыдущие 3
-        cur_month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        cur_exp = await conn.fetchval(
-            "SELECT COALESCE(SUM(ABS(amount)), 0) FROM transactions WHERE user_id=$1 AND amount < 0 AND created_at >= $2",
-            user_id, cur_month_start
-        )
-        prev_start = (cur_month_start - timedelta(days=1)).replace(day=1) - timedelta(days=90)
-        prev_end = cur_month_start - timedelta(days=1)
-        prev_avg = await conn.fetchval(
-            "SELECT COALESCE(SUM(ABS(amount)), 0) / 3 FROM transactions WHERE user_id=$1 AND amount < 0 AND created_at >= $2 AND created_at <= $3",
-            user_id, prev_start, prev_end
-        )
-        cur_exp = float(cur_exp or 0)
-        prev_avg = float(prev_avg or 0)
-        if prev_avg > 0 and cur_exp > prev_avg * 1.15:
-            pct = int(round((cur_exp / prev_avg - 1) * 100))
-            alerts.append({"type": "expense_above", "text": f"В этом месяце расходы пока на {pct}% выше среднего за предыдущие 3 месяца."})
-        # Резервный фонд: месячные расходы и сколько месяцев покрывает ликвидный капитал
-        liquid_net = await _get_liquid_net(conn, user_id)
-        if prev_avg > 0 and liquid_net >= 0:
-            months_reserve = liquid_net / prev_avg
-            if months_reserve < 3:
-                alerts.append({"type": "reserve_low", "text": f"Резервный фонд покрывает около {months_reserve:.1f} мес. расходов. Рекомендуется 3–6 мес."})
-            elif months_reserve >= 3:
-                alerts.append({"type": "reserve_ok", "text": f"Резервный фонд покрывает около {months_reserve:.1f} мес. расходов."})
-    return {"alerts": alerts}
+        return await _alerts(conn, user_id)
 
 
 # --- Симулятор сценариев ---
 
+_SIMULATOR_PERCENTILES = (10, 25, 50, 75, 90)
+_SIMULATOR_MAX_AMOUNT = 1e9  # ₽ в месяц: с запасом для реальных сумм и далеко от переполнения float32
+_SIMULATOR_MAX_STEPS = 1_000_000  # траекторий × месяцев за запрос (~50 мс): при длинном горизонте — меньше траекторий
+
+
+def _simulate_savings(
+    start: float,
+    target: Optional[float],
+    income_mean: float,
+    income_sd: float,
+    expense_mean: float,
+    expense_sd: float,
+    annual_return: float,
+    return_volatility: float,
+    months: int,
+    paths: int,
+    seed: Optional[int] = None,
+) -> dict:
+    """Монте-Карло накоплений: paths траекторий на months месяцев, все траектории — одним массивом NumPy.
+
+    Каждый месяц положительный капитал растёт на случайную доходность (логнормальную, годовые
+    annual_return и return_volatility), затем прибавляется доход и вычитается расход — независимые
+    нормальные величины (income_mean ± income_sd, expense_mean ± expense_sd), отрицательные обрезаются до 0.
+    Возвращает перцентили капитала на конец каждого года и, если задан target, перцентили числа месяцев
+    до цели и вероятность её достичь.
+    """
+    # Время уходит в основном на генерацию случайных чисел: SFC64 и float32 — самые быстрые в NumPy,
+    # антитетические пары (z и -z) вдвое сокращают генерацию и заодно уменьшают разброс оценок
+    rng = np.random.Generator(np.random.SFC64(seed))
+    half = (paths + 1) // 2
+    paths = 2 * half
+    sigma = np.float32(return_volatility / np.sqrt(12))
+    mu = np.float32(np.log1p(annual_return) / 12 - sigma ** 2 / 2)
+    income_mean, income_sd = np.float32(income_mean), np.float32(income_sd)
+    expense_mean, expense_sd = np.float32(expense_mean), np.float32(expense_sd)
+    capital = np.full(paths, start, dtype=np.float64)
+    growth = np.empty(paths, dtype=np.float32)
+    income = np.empty(paths, dtype=np.float32)
+    expense = np.empty(paths, dtype=np.float32)
+    buf = np.empty(paths, dtype=np.float64)
+    reached_at = np.zeros(paths, dtype=np.int32)  # 0 — цель ещё не достигнута
+    hit = np.empty(paths, dtype=bool)
+    track_goal = target is not None and start < target
+    checkpoints = []
+    for month in range(1, months + 1):
+        rng.standard_normal(dtype=np.float32, out=growth[:half])
+        rng.standard_normal(dtype=np.float32, out=income[:half])
+        rng.standard_normal(dtype=np.float32, out=expense[:half])
+        np.negative(growth[:half], out=growth[half:])
+        np.negative(income[:half], out=income[half:])
+        np.negative(expense[:half], out=expense[half:])
+        # Доходность за месяц: exp(mu + sigma * z) - 1, начисляется только на положительный капитал
+        growth *= sigma
+        growth += mu
+        np.expm1(growth, out=growth)
+        np.maximum(capital, 0, out=buf)
+        buf *= growth
+        capital += buf
+        income *= income_sd
+        income += income_mean
+        np.maximum(income, 0, out=income)
+        capital += income
+        expense *= expense_sd
+        expense += expense_mean
+        np.maximum(expense, 0, out=expense)
+        capital -= expense
+        if track_goal:
+            np.greater_equal(capital, target, out=hit)
+            hit &= reached_at == 0
+            reached_at[hit] = month
+        if month % 12 == 0 or month == months:
+            checkpoints.append((month, capital.astype(np.float32)))
+
+    # Ближайший ранг вместо интерполяции: частичная сортировка по 5 позициям, а не по 10
+    bands = np.percentile(np.stack([c for _, c in checkpoints]), _SIMULATOR_PERCENTILES, axis=1, method="nearest")
+    result = {
+        "paths": paths,
+        "capital": [
+            {"month": m, **{f"p{p}": round(float(bands[k, i]), 2) for k, p in enumerate(_SIMULATOR_PERCENTILES)}}
+            for i, (m, _) in enumerate(checkpoints)
+        ],
+        "goal": None,
+    }
+    if target is not None:
+        if track_goal:
+            months_to_goal = np.where(reached_at > 0, reached_at, np.inf)
+        else:
+            months_to_goal = np.zeros(paths)
+        # Без интерполяции: перцентиль — число месяцев одной из траекторий; inf — цель за горизонт не достигнута
+        months_q = np.percentile(months_to_goal, _SIMULATOR_PERCENTILES, method="higher")
+        result["goal"] = {
+            "target": round(target, 2),
+            "probability": round(float(np.isfinite(months_to_goal).mean()), 4),
+            "months": {f"p{p}": (int(q) if np.isfinite(q) else None) for p, q in zip(_SIMULATOR_PERCENTILES, months_q)},
+        }
+    return result
+
+
 @app.get("/api/simulator")
 async def get_simulator(
     goal_id: Optional[int] = Query(None),
-    monthly_savings: Optional[float] = Query(None),
-    monthly_payment: Optional[float] = Query(None),
+    monthly_savings: Optional[float] = Query(None, ge=-_SIMULATOR_MAX_AMOUNT, le=_SIMULATOR_MAX_AMOUNT, allow_inf_nan=False),
+    monthly_payment: Optional[float] = Query(None, ge=0, le=_SIMULATOR_MAX_AMOUNT, allow_inf_nan=False),
+    annual_return: float = Query(0.05, ge=-0.5, le=1),
+    return_volatility: float = Query(0.05, ge=0, le=1),
+    monte_carlo: bool = Query(False),
+    horizon: int = Query(360, ge=12, le=600),
+    paths: int = Query(2500, ge=100, le=20000),
+    seed: Optional[int] = Query(None, ge=0),
     user_id: int = Depends(get_user_id)
 ):
-    """Сценарии: до цели при откладывании X в месяц; до погашения долга при платеже Y в месяц."""
+    """Сценарии: до цели при откладывании X в месяц; до погашения долга при платеже Y в месяц.
+
+    monte_carlo=true — ещё и paths траекторий на horizon месяцев (paths × horizon не больше _SIMULATOR_MAX_STEPS,
+    лишние траектории отбрасываются): доходы и расходы случайны независимо, каждый со своим средним и разбросом
+    из помесячной статистики пользователя за 12 месяцев (при monthly_savings среднее сальдо доводится до него
+    через средний доход), доходность капитала — annual_return ± return_volatility. Перцентили ликвидного капитала
+    по годам и месяцев до цели; для целей по погашению долга (их прогресс — остаток долга, а не капитал)
+    месяцы до цели не считаются.
+    """
     db = await get_db()
     result = {"goal_months": None, "debt_months": None}
+    now = datetime.now()
     async with db.acquire() as conn:
-        if goal_id is not None and monthly_savings is not None and monthly_savings > 0:
-            row = await conn.fetchrow("SELECT target, current FROM goals WHERE id=$1 AND user_id=$2", goal_id, user_id)
-            if row:
-                remaining = float(row["target"]) - float(row["current"])
-                if remaining > 0:
-                    months = max(1, int(remaining / monthly_savings))
-                    result["goal_months"] = months
-        # Долг: сумма долгов; при monthly_payment — сколько месяцев до нуля
-        if monthly_payment is not None and monthly_payment > 0:
-            total_debt = await conn.fetchval(
-                """
-                SELECT COALESCE(SUM(v.amount), 0) FROM liabilities l
-                LEFT JOIN LATERAL (SELECT amount FROM liability_values WHERE liability_id = l.id ORDER BY created_at DESC LIMIT 1) v ON TRUE
-                WHERE l.user_id = $1
-                """,
-                user_id
-            )
-            total_debt = float(total_debt or 0)
-            if total_debt > 0:
-                result["debt_months"] = max(1, int(total_debt / monthly_payment))
-                result["total_debt"] = total_debt
+        capital = await _capital_snapshot(conn, user_id)
+        cash_flow = await _monthly_cash_flow(conn, user_id, date(now.year, now.month, 1), 12) if monte_carlo else []
+        goal = None
+        if goal_id is not None:
+            goal = await conn.fetchrow("SELECT title, target FROM goals WHERE id=$1 AND user_id=$2", goal_id, user_id)
+    # Прогресс цели — как в /api/goals/insight (goals.current после создания цели не обновляется)
+    start, target = capital.liquid_net, None
+    if goal is not None:
+        current, remaining = _goal_progress(goal["title"], float(goal["target"]), capital)
+        if not _is_debt_goal(goal["title"]):
+            target = current + remaining
+        if monthly_savings is not None and monthly_savings > 0 and remaining > 0:
+            result["goal_months"] = max(1, int(remaining / monthly_savings))
+    # Долг: сумма долгов; при monthly_payment — сколько месяцев до нуля
+    if monthly_payment is not None and monthly_payment > 0 and capital.total_liabilities > 0:
+        result["debt_months"] = max(1, int(capital.total_liabilities / monthly_payment))
+        result["total_debt"] = capital.total_liabilities
+
+    if not monte_carlo:
+        return result
+    # Месяцы без операций не учитываем: у новых пользователей они занизили бы и среднее, и разброс
+    history = np.array(
+        [(m["income"], m["expense"]) for m in cash_flow if m["income"] or m["expense"]], dtype=np.float64
+    ).reshape(-1, 2)
+    income_mean, expense_mean = (float(x) for x in history.mean(axis=0)) if len(history) else (0.0, 0.0)
+    income_sd, expense_sd = (float(x) for x in history.std(axis=0, ddof=1)) if len(history) > 1 else (0.0, 0.0)
+    if monthly_savings is not None:
+        income_mean = max(expense_mean + monthly_savings, 0.0)
+        expense_mean = income_mean - monthly_savings
+    paths = min(paths, _SIMULATOR_MAX_STEPS // horizon)
+    simulation = await asyncio.to_thread(
+        _simulate_savings, start, target, income_mean, income_sd, expense_mean, expense_sd,
+        annual_return, return_volatility, horizon, paths, seed,
+    )
+    result["monte_carlo"] = {
+        "horizon_months": horizon,
+        "start_capital": round(start, 2),
+        "monthly_income_mean": round(income_mean, 2),
+        "monthly_income_sd": round(income_sd, 2),
+        "monthly_expense_mean": round(expense_mean, 2),
+        "monthly_expense_sd": round(expense_sd, 2),
+        "history_months": len(history),
+        "annual_return": annual_return,
+        "return_volatility": return_volatility,
+        **simulation,
+    }
     return result
 
 
 # --- Отметки прогресса (бейджи) ---
 
+async def _evaluate_badges(conn, user_id: int) -> list[dict]:
+    """Бейджи: резервный фонд, достигнутые цели."""
+    badges = []
+    capital = await _capital_snapshot(conn, user_id)
+    liquid_net = capital.liquid_net
+    now = datetime.now()
+    month_rows = await _tx_monthly_rows(
+        conn, user_id, (now.date() - timedelta(days=120)).replace(day=1), _add_months(now.date(), 1)
+    )
+    avg_expense = sum(float(r["expense"]) for r in month_rows) / 3
+    if avg_expense > 0 and liquid_net >= 0:
+        months_reserve = liquid_net / avg_expense
+        if months_reserve >= 3:
+            badges.append({"id": "reserve_3", "label": f"Резервный фонд на {int(months_reserve)} мес."})
+        if months_reserve >= 6:
+            badges.append({"id": "reserve_6", "label": "Резервный фонд на 6+ мес."})
+    # goals.current не обновляется после создания цели — прогресс считаем, как в /api/goals/insight
+    goals = await conn.fetch("SELECT title, target FROM goals WHERE user_id=$1 AND target > 0", user_id)
+    if any(_goal_progress(g["title"], float(g["target"]), capital)[1] <= 0 for g in goals):
+        badges.append({"id": "first_goal", "label": "Первая цель достигнута"})
+    return badges
+
+
+async def _badges(conn, user_id: int) -> dict:
+    return {"badges": (await _insights(conn, user_id))["badges"]}
+
+
+# --- Сохранённые бейджи и алерты ---
+
+async def _insights(conn, user_id: int) -> dict:
+    """Бейджи и алерты из user_insights. Правила пересчитываются, только когда изменились данные пользователя
+    (users.data_version растёт после каждой записи через API: транзакции, капитал, цели, бюджеты)
+    или начался новый месяц; иначе — одно чтение по первичному ключу."""
+    period = datetime.now().date().replace(day=1)
+    version = None
+    try:
+        row = await _fetchrow(conn, "user_insights_get", user_id, period)
+    except (asyncpg.UndefinedTableError, asyncpg.UndefinedColumnError):
+        # Нет migrate_user_insights.sql или migrate_users_data_version.sql — считаем на каждый запрос
+        row = None
+    if row is not None:
+        if row["badges"] is not None:
+            return {"badges": json.loads(row["badges"]), "alerts": json.loads(row["alerts"])}
+        version = row["data_version"]
+    badges = await _evaluate_badges(conn, user_id)
+    alerts = await _evaluate_alerts(conn, user_id)
+    if version is not None:
+        # Версия прочитана до пересчёта: запись, пришедшая во время него, увеличит версию и вызовет новый пересчёт
+        await _fetchval(
+            conn, "user_insights_put",
+            user_id, version, period, json.dumps(badges, ensure_ascii=False), json.dumps(alerts, ensure_ascii=False),
+        )
+    return {"badges": badges, "alerts": alerts}
+
+
 @app.get("/api/badges")
 async def get_badges(user_id: int = Depends(get_user_id)):
     """Бейджи: резервный фонд на N мес., первая цель достигнута и т.д."""
     db = await get_db()
-    badges = []
     async with db.acquire() as conn:
-        liquid_net = await _get_liquid_net(conn, user_id)
-        avg_expense = await conn.fetchval(
-            "SELECT COALESCE(SUM(ABS(amount)), 0) / 3 FROM transactions WHERE user_id=$1 AND amount < 0 AND created_at >= $2",
-            user_id, (datetime.now() - timedelta(days=120)).replace(day=1)
-        )
-        avg_expense = float(avg_expense or 0)
-        if avg_expense > 0 and liquid_net >= 0:
-            months_reserve = liquid_net / avg_expense
-            if months_reserve >= 3:
-                badges.append({"id": "reserve_3", "label": f"Резервный фонд на {int(months_reserve)} мес."})
-            if months_reserve >= 6:
-                badges.append({"id": "reserve_6", "label": "Резервный фонд на 6+ мес."})
-        goals_done = await conn.fetchval(
-            "SELECT COUNT(*) FROM goals WHERE user_id=$1 AND current >= target AND target > 0",
-            user_id
-        )
-        if goals_done and int(goals_done) > 0:
-            badges.append({"id": "first_goal", "label": "Первая цель достигнута"})
-    return {"badges": badges}
+        return await _badges(conn, user_id)
+
+
+# --- Главный экран одним запросом ---
+
+async def _dashboard_section(db, name: str, section, *args):
+    """Раздел /api/dashboard на своём соединении пула: (данные, None) или (None, "timeout" | "error")."""
+    async def run():
+        async with db.acquire() as conn:
+            return await section(conn, *args)
+
+    try:
+        # Таймаут включает ожидание свободного соединения
+        return await asyncio.wait_for(run(), DASHBOARD_SECTION_TIMEOUT), None
+    except asyncio.TimeoutError:
+        logging.warning("dashboard section %s timed out after %.1fs", name, DASHBOARD_SECTION_TIMEOUT)
+        return None, "timeout"
+    except Exception:
+        logging.exception("dashboard section %s failed", name)
+        return None, "error"
+
+
+@app.get("/api/dashboard")
+async def get_dashboard(
+    month: Optional[int] = None,
+    year: Optional[int] = None,
+    months: int = Query(12, ge=1, le=120),
+    from_: Optional[date] = Query(None, alias="from"),
+    to: Optional[date] = None,
+    ctx: UserContext = Depends(get_user_context),
+):
+    """Всё для главного экрана за один запрос: разделы считаются параллельно на отдельных соединениях.
+
+    Ответ — те же данные, что у /api/stats, /api/stats/monthly, /api/goals/insight, /api/alerts, /api/badges,
+    /api/onboarding-progress, /api/budgets/status и /api/progress-vs-self. Раздел, который упал или не уложился
+    в DASHBOARD_SECTION_TIMEOUT, равен null и попадает в errors — остальные возвращаются как есть.
+    """
+    _check_stats_range(from_, to)
+    user_id = ctx.id
+    now = datetime.now()
+    db = await get_db()
+    sections = {
+        "stats": (_month_stats, user_id, month, year, from_, to),
+        "monthly": (_monthly_cash_flow, user_id, date(now.year, now.month, 1), months),
+        "goals_insight": (_goals_insight, user_id),
+        # Бейджи и алерты — один раздел: _insights считает и сохраняет их вместе
+        "insights": (_insights, user_id),
+        "onboarding_progress": (_onboarding_progress, ctx),
+        "budgets_status": (_budgets_status, user_id),
+        "progress_vs_self": (_progress_vs_self, user_id),
+    }
+    results = await asyncio.gather(
+        *(_dashboard_section(db, name, fn, *args) for name, (fn, *args) in sections.items())
+    )
+    response = {"errors": {}}
+    for name, (data, error) in zip(sections, results):
+        if name == "insights":
+            for key in ("alerts", "badges"):
+                response[key] = {key: data[key]} if data is not None else None
+                if error is not None:
+                    response["errors"][key] = error
+            continue
+        response[name] = data
+        if error is not None:
+            response["errors"][name] = error
+    if response["errors"]:
+        # Неполный ответ не кэшируем: иначе один медленный запрос скрыл бы разделы до следующей записи
+        return JSONResponse(response, headers={"Cache-Control": "no-store"})
+    return response
 
 
 # ============================================
@@ -2582,39 +4167,33 @@ async def save_message(user_id: int, role: str, content: str):
         logging.warning(f"Failed to save message: {e}")
 
 
-async def analyze_user_finances_text(user_id: int) -> str:
+async def analyze_user_finances_text(user_id: int, ctx: Optional[UserContext] = None) -> str:
     """Анализ финансов пользователя для AI (включая профиль, если есть)."""
     MAX_TX_FOR_ANALYSIS = 200
+    if ctx is None:
+        ctx = await _user_context(None, user_id)
+    # Профиль пользователя (пол, возраст, семья, город) — для персональных рекомендаций
+    profile_lines = []
+    if ctx.gender:
+        profile_lines.append(f"Пол: {ctx.gender}")
+    if ctx.birth_date:
+        bd = ctx.birth_date
+        age = (date.today() - bd).days // 365 if isinstance(bd, date) else None
+        if age is not None:
+            profile_lines.append(f"Возраст: {age} лет (дата рождения: {bd})")
+    if ctx.marital_status:
+        profile_lines.append(f"Семейное положение: {ctx.marital_status}")
+    if ctx.children_count is not None:
+        profile_lines.append(f"Дети: {ctx.children_count}")
+    if ctx.city:
+        profile_lines.append(f"Город: {ctx.city}")
+    if profile_lines:
+        s = "Профиль пользователя:\n" + "\n".join(profile_lines) + "\n\n"
+    else:
+        s = ""
+
     db = await get_db()
     async with db.acquire() as conn:
-        # Профиль пользователя (пол, возраст, семья, город) — для персональных рекомендаций
-        profile_lines = []
-        try:
-            profile_row = await conn.fetchrow(
-                "SELECT gender, birth_date, marital_status, children_count, city FROM users WHERE id=$1",
-                user_id
-            )
-            if profile_row and (profile_row.get("gender") or profile_row.get("birth_date") or profile_row.get("marital_status") or profile_row.get("children_count") is not None or profile_row.get("city")):
-                if profile_row.get("gender"):
-                    profile_lines.append(f"Пол: {profile_row['gender']}")
-                if profile_row.get("birth_date"):
-                    bd = profile_row["birth_date"]
-                    age = (date.today() - bd).days // 365 if isinstance(bd, date) else None
-                    if age is not None:
-                        profile_lines.append(f"Возраст: {age} лет (дата рождения: {bd})")
-                if profile_row.get("marital_status"):
-                    profile_lines.append(f"Семейное положение: {profile_row['marital_status']}")
-                if profile_row.get("children_count") is not None:
-                    profile_lines.append(f"Дети: {profile_row['children_count']}")
-                if profile_row.get("city"):
-                    profile_lines.append(f"Город: {profile_row['city']}")
-        except asyncpg.UndefinedColumnError:
-            pass
-        if profile_lines:
-            s = "Профиль пользователя:\n" + "\n".join(profile_lines) + "\n\n"
-        else:
-            s = ""
-
         rows = await conn.fetch(
             """
             SELECT t.amount, c.name AS category, t.description, t.created_at
@@ -2635,23 +4214,13 @@ async def analyze_user_finances_text(user_id: int) -> str:
         
         goals = await conn.fetch("SELECT title, target FROM goals WHERE user_id=$1", user_id)
         if goals:
-            liquid_net = await _get_liquid_net(conn, user_id)
+            liquid_net = (await _capital_snapshot(conn, user_id)).liquid_net
             s += "\nЦели:\n"
             for g in goals:
                 s += f"- {g.get('title','Цель')}: {liquid_net}/{g['target']} ₽\n"
         
         # Активы
-        assets_rows = await conn.fetch(
-            """
-            SELECT a.title, a.type, v.amount
-            FROM assets a
-            LEFT JOIN LATERAL (
-                SELECT amount FROM asset_values WHERE asset_id = a.id ORDER BY created_at DESC LIMIT 1
-            ) v ON TRUE
-            WHERE a.user_id = $1 AND (v.amount IS NULL OR v.amount > 0)
-            """,
-            user_id
-        )
+        assets_rows = await _capital_query(conn, "fetch", "assets_latest", user_id)
         if assets_rows:
             total_assets = sum([a["amount"] for a in assets_rows if a["amount"]])
             s += f"\nАктивы (итого {total_assets}₽):\n"
@@ -2660,17 +4229,7 @@ async def analyze_user_finances_text(user_id: int) -> str:
                     s += f"- {a['title']} ({a['type']}): {a['amount']}₽\n"
         
         # Долги
-        liabs_rows = await conn.fetch(
-            """
-            SELECT l.title, l.type, v.amount
-            FROM liabilities l
-            LEFT JOIN LATERAL (
-                SELECT amount FROM liability_values WHERE liability_id = l.id ORDER BY created_at DESC LIMIT 1
-            ) v ON TRUE
-            WHERE l.user_id = $1 AND (v.amount IS NULL OR v.amount > 0)
-            """,
-            user_id
-        )
+        liabs_rows = await _capital_query(conn, "fetch", "liabilities_latest", user_id)
         if liabs_rows:
             total_liabs = sum([l["amount"] for l in liabs_rows if l["amount"]])
             s += f"\nДолги (итого {total_liabs}₽):\n"
@@ -2714,10 +4273,10 @@ def _stub_consultation_text(finance_snapshot: str) -> str:
     )
 
 
-async def generate_consultation(user_id: int) -> str:
+async def generate_consultation(user_id: int, ctx: Optional[UserContext] = None) -> str:
     """Генерация финансовой консультации"""
     try:
-        finance_snapshot = await analyze_user_finances_text(user_id)
+        finance_snapshot = await analyze_user_finances_text(user_id, ctx)
 
         # Если GigaChat не настроен (нет кредов) — всегда возвращаем понятную заглушку,
         # чтобы пользователь получал осмысленную консультацию, а не техническую ошибку.
@@ -2952,7 +4511,7 @@ async def get_reports(user_id: int = Depends(get_user_id)):
             """,
             user_id
         )
-        liquid_net = await _get_liquid_net(conn, user_id)
+        liquid_net = (await _capital_snapshot(conn, user_id)).liquid_net
         def _goal_progress(current: float, target: float) -> float:
             """Прогресс 0–100%; при target=0 возвращаем 100%; деление на 0 исключено."""
             if target <= 0:
@@ -2969,52 +4528,18 @@ async def get_reports(user_id: int = Depends(get_user_id)):
             for g in goals_rows
         ]
         
-        # График 3: Динамика капитала за последние 12 недель
-        weeks_data = []
-        for i in range(11, -1, -1):
-            week_end = now - timedelta(weeks=i)
-            # Находим воскресенье недели
-            days_since_monday = (week_end.weekday()) % 7
-            sunday = week_end - timedelta(days=days_since_monday) + timedelta(days=6)
-            sunday = sunday.replace(hour=23, minute=59, second=59)
-            
-            # Получаем активы на эту дату
-            assets_rows = await conn.fetch(
-                """
-                SELECT a.id, COALESCE(
-                    (SELECT amount FROM asset_values 
-                     WHERE asset_id = a.id AND created_at <= $2 
-                     ORDER BY created_at DESC LIMIT 1), 0
-                ) as amount
-                FROM assets a
-                WHERE a.user_id = $1
-                """,
-                user_id, sunday
-            )
-            total_assets = sum(float(r['amount']) for r in assets_rows)
-            
-            # Получаем долги на эту дату
-            liabs_rows = await conn.fetch(
-                """
-                SELECT l.id, COALESCE(
-                    (SELECT amount FROM liability_values 
-                     WHERE liability_id = l.id AND created_at <= $2 
-                     ORDER BY created_at DESC LIMIT 1), 0
-                ) as amount
-                FROM liabilities l
-                WHERE l.user_id = $1
-                """,
-                user_id, sunday
-            )
-            total_liabs = sum(float(r['amount']) for r in liabs_rows)
-            
-            net_capital = total_assets - total_liabs
-            weeks_data.append({
-                'week': sunday.strftime('%d.%m'),
-                'assets': total_assets,
-                'liabilities': total_liabs,
-                'net_capital': net_capital
-            })
+        # График 3: Динамика капитала за последние 12 недель (по воскресеньям)
+        today = now.date()
+        weeks = await _capital_series(conn, user_id, today - timedelta(weeks=11), today, "week")
+        weeks_data = [
+            {
+                'week': (w["period_start"] + timedelta(days=6)).strftime('%d.%m'),
+                'assets': w["assets"],
+                'liabilities': w["liabilities"],
+                'net_capital': w["net"],
+            }
+            for w in weeks
+        ]
         
         return {
             "chart1": {
@@ -3035,6 +4560,104 @@ async def get_reports(user_id: int = Depends(get_user_id)):
         }
 
 
+# --- Отчёт в Excel ---
+
+_XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+def _xlsx_start(cash_flow: list[dict], by_category: list[tuple], capital: list[dict]):
+    """Книга write-only: лист транзакций (заполняется порциями позже) и три готовых листа."""
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws_tx = wb.create_sheet("Транзакции")
+    for col, width in zip("ABCDE", (10, 20, 14, 28, 50)):
+        ws_tx.column_dimensions[col].width = width
+    ws_tx.append(["ID", "Дата", "Сумма, ₽", "Категория", "Описание"])
+
+    ws = wb.create_sheet("Денежный поток")
+    ws.column_dimensions["A"].width = 18
+    ws.append(["Месяц", "Доходы, ₽", "Расходы, ₽", "Разница, ₽"])
+    for m in cash_flow:
+        ws.append([m["label"], m["income"], m["expense"], m["difference"]])
+
+    ws = wb.create_sheet("По категориям")
+    ws.column_dimensions["A"].width = 28
+    ws.append(["Категория", "Доходы, ₽", "Расходы, ₽", "Операций"])
+    for row in by_category:
+        ws.append(list(row))
+
+    ws = wb.create_sheet("Капитал")
+    ws.column_dimensions["A"].width = 18
+    ws.append(["Месяц", "Активы, ₽", "Долги, ₽", "Чистый капитал, ₽"])
+    for p in capital:
+        d = p["period_start"]
+        ws.append([f"{_MONTH_NAMES_RU[d.month - 1]} {d.year}", p["assets"], p["liabilities"], p["net"]])
+    return wb, ws_tx
+
+
+def _xlsx_append(ws, rows: list[list]) -> None:
+    for row in rows:
+        ws.append(row)
+
+
+@app.get("/api/reports/export.xlsx")
+async def export_report_xlsx(
+    months: int = Query(12, ge=1, le=120),
+    user_id: int = Depends(get_user_id),
+):
+    """Отчёт в Excel: все транзакции, денежный поток, категории и капитал за months завершённых месяцев.
+
+    Книга строится в режиме write-only в потоках пула (цикл событий не блокируется): строки сразу уходят
+    во временный файл, транзакции читаются серверным курсором порциями по EXPORT_BATCH_ROWS — память
+    не растёт с числом строк. Готовый файл отдаётся потоком и удаляется после отправки.
+    """
+    now = datetime.now()
+    month_start = date(now.year, now.month, 1)
+    start = _add_months(month_start, -months)
+    db = await get_db()
+    async with db.acquire() as conn:
+        cash_flow = await _monthly_cash_flow(conn, user_id, month_start, months)
+        month_rows = await _tx_monthly_rows(conn, user_id, start, month_start)
+        capital = await _capital_series(conn, user_id, start, _add_months(month_start, -1), "month")
+    totals: dict = {}
+    for r in month_rows:
+        t = totals.setdefault(r["category"] or "—", [0.0, 0.0, 0])
+        t[0] += float(r["income"])
+        t[1] += float(r["expense"])
+        t[2] += int(r["count"])
+    by_category = sorted(
+        ((cat, round(inc, 2), round(exp, 2), cnt) for cat, (inc, exp, cnt) in totals.items()),
+        key=lambda row: -row[2],
+    )
+
+    wb, ws_tx = await asyncio.to_thread(_xlsx_start, cash_flow, by_category, capital)
+    fd, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    try:
+        async with db.acquire() as conn, conn.transaction(isolation="repeatable_read", readonly=True):
+            batch = []
+            async for r in conn.cursor(
+                _STATEMENTS["tx_list"], user_id, datetime.min, datetime.max, None, None, None, None, datetime.max, None,
+                prefetch=EXPORT_BATCH_ROWS,
+            ):
+                batch.append([r["id"], r["created_at"], float(r["amount"]), r["category"], r["description"]])
+                if len(batch) >= EXPORT_BATCH_ROWS:
+                    await asyncio.to_thread(_xlsx_append, ws_tx, batch)
+                    batch = []
+            if batch:
+                await asyncio.to_thread(_xlsx_append, ws_tx, batch)
+        await asyncio.to_thread(wb.save, path)
+    except BaseException:
+        os.unlink(path)
+        raise
+    return FileResponse(
+        path,
+        media_type=_XLSX_MEDIA_TYPE,
+        filename=f"finadvisor_report_{now:%Y-%m-%d}.xlsx",
+        background=BackgroundTask(os.unlink, path),
+    )
+
+
 # Ценность 6: удаление всех данных (мои данные под контролем)
 @app.delete("/api/me")
 async def delete_my_account(user_id: int = Depends(get_user_id)):
@@ -3049,11 +4672,21 @@ async def delete_my_account(user_id: int = Depends(get_user_id)):
         await conn.execute("DELETE FROM ai_context WHERE user_id = $1", user_id)
         await conn.execute("DELETE FROM goals WHERE user_id = $1", user_id)
         await conn.execute("DELETE FROM transactions WHERE user_id = $1", user_id)
+        await _tx_agg_forget_user(conn, user_id)
         await conn.execute("DELETE FROM asset_values WHERE asset_id IN (SELECT id FROM assets WHERE user_id = $1)", user_id)
         await conn.execute("DELETE FROM assets WHERE user_id = $1", user_id)
         await conn.execute("DELETE FROM liability_values WHERE liability_id IN (SELECT id FROM liabilities WHERE user_id = $1)", user_id)
         await conn.execute("DELETE FROM liabilities WHERE user_id = $1", user_id)
+        await _capital_changed(conn, user_id)
+        try:
+            await conn.execute("DELETE FROM user_insights WHERE user_id = $1", user_id)
+        except asyncpg.UndefinedTableError:
+            pass
         await conn.execute("DELETE FROM users WHERE id = $1", user_id)
+        # Остальные процессы API вытесняют пользователя из кэша подписки — его сессионные токены перестают приниматься
+        await conn.execute("SELECT pg_notify('premium_changed', $1)", str(user_id))
+    _auth_cache_forget_user(user_id)
+    _premium_cache_forget(user_id)
     return {"status": "ok", "message": "Аккаунт и все данные удалены."}
 
 
@@ -3063,20 +4696,7 @@ async def get_consultation_history(user_id: int = Depends(get_user_id)):
     """Получить историю консультаций, сгруппированную по сессиям (дням)."""
     db = await get_db()
     async with db.acquire() as conn:
-        rows = await conn.fetch(
-            """
-            SELECT role, content, created_at
-            FROM ai_context
-            WHERE user_id=$1
-              AND (
-                (role='assistant' AND content LIKE 'CONSULTATION:%')
-                OR (role='user' AND content LIKE 'FOLLOW_UP:%')
-              )
-            ORDER BY created_at ASC
-            LIMIT 500
-            """,
-            user_id
-        )
+        rows = await _fetch(conn, "consultation_history", user_id)
     # Группируем по дате (день): в каждой сессии первое assistant CONSULTATION — основная консультация, пары user FOLLOW_UP + assistant CONSULTATION — уточнения
     from collections import defaultdict
     sessions_by_date = defaultdict(lambda: {"main": None, "follow_ups": []})
@@ -3113,7 +4733,7 @@ async def get_consultation_history(user_id: int = Depends(get_user_id)):
 
 
 # Консультация - проверка лимита по сессиям (1 сессия = 1 день; бесплатно 1/мес, по подписке 5/мес)
-async def check_consultation_limit(user_id: int) -> tuple[bool, int, int, bool]:
+async def check_consultation_limit(user_id: int, request: Optional[Request] = None) -> tuple[bool, int, int, bool]:
     """
     Returns:
         tuple[bool, int, int, bool]: (can_request_main, sessions_used, limit, can_followup_today)
@@ -3121,31 +4741,15 @@ async def check_consultation_limit(user_id: int) -> tuple[bool, int, int, bool]:
     db = await get_db()
     now = datetime.now()
     since = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    is_premium = await check_premium(user_id)
+    is_premium = await check_premium(user_id, request)
     limit = 5 if is_premium else 1
 
     async with db.acquire() as conn:
         # Количество сессий (уникальных дней) в этом месяце с хотя бы одной консультацией
-        rows = await conn.fetch(
-            """
-            SELECT DISTINCT DATE(created_at) as d
-            FROM ai_context
-            WHERE user_id=$1 AND role='assistant' AND content LIKE 'CONSULTATION:%'
-              AND created_at >= $2
-            """,
-            user_id, since
-        )
+        rows = await _fetch(conn, "consultation_days_since", user_id, since)
         sessions_used = len(rows)
         # Последняя консультация — сегодня? (можно задать уточняющий вопрос)
-        last_row = await conn.fetchrow(
-            """
-            SELECT DATE(created_at) as d
-            FROM ai_context
-            WHERE user_id=$1 AND role='assistant' AND content LIKE 'CONSULTATION:%'
-            ORDER BY created_at DESC LIMIT 1
-            """,
-            user_id
-        )
+        last_row = await _fetchrow(conn, "consultation_last", user_id)
         last_date = last_row["d"] if last_row and last_row["d"] else None
         today = now.date()
         can_followup_today = last_date == today
@@ -3155,9 +4759,9 @@ async def check_consultation_limit(user_id: int) -> tuple[bool, int, int, bool]:
 
 # Консультация
 @app.get("/api/consultation/limit")
-async def get_consultation_limit(user_id: int = Depends(get_user_id)):
+async def get_consultation_limit(request: Request, user_id: int = Depends(get_user_id)):
     """Лимит сессий (1 сессия = 1 день). Бесплатно 1/мес, по подписке 5/мес. И можно ли задать уточняющий вопрос сегодня."""
-    can_main, sessions_used, limit, can_followup_today = await check_consultation_limit(user_id)
+    can_main, sessions_used, limit, can_followup_today = await check_consultation_limit(user_id, request)
     return {
         "sessions_used": sessions_used,
         "limit": limit,
@@ -3167,9 +4771,10 @@ async def get_consultation_limit(user_id: int = Depends(get_user_id)):
 
 
 @app.get("/api/consultation")
-async def get_consultation(user_id: int = Depends(get_user_id)):
+async def get_consultation(request: Request, ctx: UserContext = Depends(get_user_context)):
     """Получить AI консультацию (основная консультация = 1 сессия в день; лимит 1/мес бесплатно, 5/мес по подписке)."""
-    can_main, sessions_used, limit, _ = await check_consultation_limit(user_id)
+    user_id = ctx.id
+    can_main, sessions_used, limit, _ = await check_consultation_limit(user_id, request)
 
     if not can_main:
         return {
@@ -3183,7 +4788,7 @@ async def get_consultation(user_id: int = Depends(get_user_id)):
     try:
         logging.info(f"Consultation request for user_id={user_id} ({sessions_used + 1}/{limit})")
         consultation = await asyncio.wait_for(
-            generate_consultation(user_id),
+            generate_consultation(user_id, ctx),
             timeout=60.0
         )
         logging.info("Consultation completed successfully")
@@ -3253,7 +4858,9 @@ async def get_consultation(user_id: int = Depends(get_user_id)):
 
 
 # Консультация — ввод целей через сообщение (AI извлекает цели и сохраняет в goals).
-async def _extract_goals_from_message(user_message: str, user_id: int | None = None) -> list[dict]:
+async def _extract_goals_from_message(
+    user_message: str, user_id: int | None = None, ctx: Optional[UserContext] = None
+) -> list[dict]:
     """
     Вызвать GigaChat для извлечения финансовых целей из текста.
     ЛОГИКА ПОЛНОСТЬЮ В ПРОМПТЕ — БЕЗ ХАРДКОДА В КОДЕ.
@@ -3295,7 +4902,7 @@ async def _extract_goals_from_message(user_message: str, user_id: int | None = N
         finance_snapshot = None
         if user_id is not None:
             try:
-                finance_snapshot = await analyze_user_finances_text(user_id)
+                finance_snapshot = await analyze_user_finances_text(user_id, ctx)
             except Exception:
                 finance_snapshot = None
 
@@ -3338,16 +4945,17 @@ async def _extract_goals_from_message(user_message: str, user_id: int | None = N
 @app.post("/api/consultation/message")
 async def consultation_message(
     body: ConsultationMessageRequest,
-    user_id: int = Depends(get_user_id)
+    ctx: UserContext = Depends(get_user_context)
 ):
     """Отправить сообщение в консультацию: AI извлекает цели и сохраняет в goals."""
+    user_id = ctx.id
     message = (body.message or "").strip()
     if not message:
         raise HTTPException(status_code=400, detail="message is required")
     await save_message(user_id, "user", message)
     goals_added = []
     try:
-        extracted = await _extract_goals_from_message(message, user_id)
+        extracted = await _extract_goals_from_message(message, user_id, ctx)
         db = await get_db()
         async with db.acquire() as conn:
             # Обычный путь: LLM вернул цели с числами
@@ -3368,10 +4976,11 @@ async def consultation_message(
 @app.post("/api/consultation/follow-up")
 async def consultation_follow_up(
     body: ConsultationMessageRequest,
+    request: Request,
     user_id: int = Depends(get_user_id)
 ):
     """Задать уточняющий вопрос по последней консультации. Доступно только в тот же день (1 сессия = консультация + уточнения). Не тратит лимит сессий."""
-    _, sessions_used, limit, can_followup_today = await check_consultation_limit(user_id)
+    _, sessions_used, limit, can_followup_today = await check_consultation_limit(user_id, request)
     if not can_followup_today:
         raise HTTPException(
             status_code=400,
@@ -3383,14 +4992,7 @@ async def consultation_follow_up(
 
     db = await get_db()
     async with db.acquire() as conn:
-        row = await conn.fetchrow(
-            """
-            SELECT content FROM ai_context
-            WHERE user_id=$1 AND role='assistant' AND content LIKE 'CONSULTATION:%'
-            ORDER BY created_at DESC LIMIT 1
-            """,
-            user_id
-        )
+        row = await _fetchrow(conn, "consultation_last", user_id)
     if not row:
         raise HTTPException(
             status_code=400,
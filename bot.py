@@ -15,6 +15,8 @@ from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo, LabeledPrice, ErrorEvent
 
+from users_db import provision_user
+
 # Загружаем .env из папки, где лежит bot.py (не зависит от текущей директории)
 _env_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")
 load_dotenv(_env_path)
@@ -118,24 +120,11 @@ async def get_or_create_user(tg_id: int, username: Optional[str] = None, display
         tuple[int, bool]: (user_id, is_new_user)
     """
     name_to_save = username or display_name
+    # Новый пользователь - даем 2 бесплатных месяца (у существующих premium_until не меняется)
+    free_months_until = datetime.now() + timedelta(days=60)
     async with db.acquire() as conn:
-        row = await conn.fetchrow("SELECT id, premium_until, username FROM users WHERE tg_id=$1", tg_id)
-        if not row:
-            # Новый пользователь - даем 2 бесплатных месяца
-            free_months_until = datetime.now() + timedelta(days=60)
-            await conn.execute(
-                "INSERT INTO users (tg_id, username, created_at, premium_until) VALUES ($1, $2, NOW(), $3)",
-                tg_id, name_to_save, free_months_until
-            )
-            row = await conn.fetchrow("SELECT id, premium_until FROM users WHERE tg_id=$1", tg_id)
-            return row['id'], True  # Возвращаем True если новый пользователь
-        # Если пользователь существует, но username пустой, а передан новый - обновляем
-        if name_to_save and (not row['username'] or row['username'] != name_to_save):
-            await conn.execute(
-                "UPDATE users SET username=$1 WHERE tg_id=$2",
-                name_to_save, tg_id
-            )
-        return row['id'], False  # Существующий пользователь
+        row = await provision_user(conn, tg_id, name_to_save, free_months_until)
+    return row['id'], row['is_new']
 
 
 def format_premium_status(premium_until: Optional[datetime]) -> str:
@@ -406,6 +395,8 @@ async def successful_payment_handler(m: types.Message):
             "UPDATE users SET premium_until=$1 WHERE id=$2",
             new_premium_until, user_id
         )
+        # API кэширует подписку в памяти — сообщаем об изменении (NOTIFY premium_changed, '<user_id>')
+        await conn.execute("SELECT pg_notify('premium_changed', $1)", str(user_id))
     
     status_text = format_premium_status(new_premium_until)
     
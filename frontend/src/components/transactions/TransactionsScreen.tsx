@@ -21,6 +21,10 @@ interface Category {
   type: string;
 }
 
+/** Страница /api/transactions (не больше лимита API) и сколько строк держим на экране */
+const TX_PAGE_SIZE = 500;
+const TX_MAX_ROWS = 1000;
+
 /** Ссылка на видеоинструкцию по загрузке Excel (Сбер/Т‑Банк). Замените на свой URL. */
 const VIDEO_INSTRUCTION_URL = 'https://vk.com/video_ext.php?oid=-221650337&id=456239017&hd=2';
 
@@ -136,7 +140,8 @@ export function TransactionsScreen({ embedded }: TransactionsScreenProps) {
     setLoading(true);
     try {
       const params = new URLSearchParams();
-      params.append('limit', '1000');
+      params.append('limit', String(TX_PAGE_SIZE));
+      params.append('paged', 'true');
       if (selectedPeriods.length > 0) {
         selectedPeriods.forEach((p) => params.append('period', p));
       } else if (selectedMonth !== null) {
@@ -145,8 +150,18 @@ export function TransactionsScreen({ embedded }: TransactionsScreenProps) {
       }
       if (selectedType !== 'all') params.append('type', selectedType);
       selectedCategories.forEach((c) => params.append('category', c));
-      const data = await apiRequest<Transaction[]>(`/api/transactions?${params}`);
-      setTransactions(data);
+      // Постранично по next_cursor: первая страница — без cursor
+      const rows: Transaction[] = [];
+      let cursor: string | null = '';
+      while (cursor !== null && rows.length < TX_MAX_ROWS) {
+        if (cursor) params.set('cursor', cursor);
+        const page = await apiRequest<{ items: Transaction[]; next_cursor: string | null }>(
+          `/api/transactions?${params}`
+        );
+        rows.push(...page.items);
+        cursor = page.next_cursor;
+      }
+      setTransactions(rows);
     } catch (e) {
       console.error('Ошибка загрузки транзакций:', e);
     } finally {
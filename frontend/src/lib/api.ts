@@ -32,12 +32,44 @@ function getInitData(): string {
   return '';
 }
 
+let sessionToken: { token: string; expiresAt: number } | null = null;
+let sessionTokenRequest: Promise<string | null> | null = null;
+
+/**
+ * Сессионный токен из /api/auth/telegram (user_id + premium_until, подписан сервером).
+ * С ним API не проверяет initData и не ходит в БД за пользователем. Ошибка — работаем по initData.
+ */
+async function getSessionToken(initData: string): Promise<string | null> {
+  // Обновляем заранее, за минуту до истечения
+  if (sessionToken && sessionToken.expiresAt - 60 > Date.now() / 1000) return sessionToken.token;
+  if (!sessionTokenRequest) {
+    sessionTokenRequest = fetch(`${API_BASE}/api/auth/telegram`, {
+      method: 'POST',
+      headers: { 'init-data': initData },
+    })
+      .then(async (r) => {
+        if (!r.ok) return null;
+        const data = (await r.json()) as { session_token?: string; session_expires_at?: number };
+        if (!data.session_token || !data.session_expires_at) return null;
+        sessionToken = { token: data.session_token, expiresAt: data.session_expires_at };
+        return sessionToken.token;
+      })
+      .catch(() => null)
+      .finally(() => {
+        sessionTokenRequest = null;
+      });
+  }
+  return sessionTokenRequest;
+}
+
 /** Заголовки для запросов к API (в т.ч. multipart/file). В тесте добавляет X-Test-User-Id. */
 export async function getApiHeaders(extra: HeadersInit = {}): Promise<HeadersInit> {
   const initData = getInitData();
   const headers: HeadersInit = { ...extra };
   if (initData) {
     (headers as Record<string, string>)['init-data'] = initData;
+    const token = await getSessionToken(initData);
+    if (token) (headers as Record<string, string>)['Authorization'] = `Bearer ${token}`;
   } else {
     const env = await fetchEnvInfo();
     if (env?.environment === 'test') {
@@ -55,7 +87,10 @@ export async function apiRequest<T>(endpoint: string, options: RequestInit = {})
     ...(initData ? { 'init-data': initData } : {}),
     ...options.headers,
   };
-  if (!initData) {
+  if (initData) {
+    const token = await getSessionToken(initData);
+    if (token) (headers as Record<string, string>)['Authorization'] = `Bearer ${token}`;
+  } else {
     const env = await fetchEnvInfo();
     if (env?.environment === 'test') {
       (headers as Record<string, string>)['X-Test-User-Id'] =
@@ -1,7 +1,10 @@
-/** Ответ /api/stats — статистика за выбранный месяц */
+/** Ответ /api/stats — статистика за выбранный месяц или диапазон from..to */
 export interface Stats {
-  month?: number;
-  year?: number;
+  month?: number | null;
+  year?: number | null;
+  /** Границы периода включительно, YYYY-MM-DD */
+  from?: string;
+  to?: string;
   total_income: number;
   total_expense: number;
   income_by_category: Record<string, number>;
@@ -96,9 +99,39 @@ export interface BadgesResponse {
   badges: Array<{ id: string; label: string }>;
 }
 
+/** Перцентили p10/p25/p50/p75/p90 */
+export interface PercentileBand {
+  p10: number;
+  p25: number;
+  p50: number;
+  p75: number;
+  p90: number;
+}
+
 /** Ответ /api/simulator */
 export interface SimulatorResponse {
   goal_months: number | null;
   debt_months: number | null;
   total_debt?: number;
+  /** Монте-Карло (только при monte_carlo=true): траектории доходов, расходов и доходности по статистике пользователя */
+  monte_carlo?: {
+    paths: number;
+    horizon_months: number;
+    start_capital: number;
+    monthly_income_mean: number;
+    monthly_income_sd: number;
+    monthly_expense_mean: number;
+    monthly_expense_sd: number;
+    history_months: number;
+    annual_return: number;
+    return_volatility: number;
+    /** Капитал на конец каждого года горизонта */
+    capital: Array<{ month: number } & PercentileBand>;
+    goal: {
+      target: number;
+      probability: number;
+      /** Месяцев до цели; null — за горизонт не достигается */
+      months: { [K in keyof PercentileBand]: number | null };
+    } | null;
+  };
 }
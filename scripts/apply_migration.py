@@ -44,15 +44,19 @@ def main():
         sql = f.read()
 
     def statements_from_sql(content: str):
-        """Разбивает SQL на отдельные команды (по ; в конце строки или ; + пробелы + перевод)."""
+        """Разбивает SQL на отдельные команды (по ; в конце строки или ; + пробелы + перевод).
+        Внутри DO $$ ... $$ ; в конце строки команду не завершает."""
         out = []
         current = []
+        in_dollar = False
         for line in content.splitlines():
             stripped = line.strip()
             if not stripped or stripped.startswith("--"):
                 continue
             current.append(line)
-            if stripped.endswith(";"):
+            if stripped.count("$$") % 2:
+                in_dollar = not in_dollar
+            if stripped.endswith(";") and not in_dollar:
                 stmt = "\n".join(current).strip()
                 if stmt:
                     out.append(stmt)
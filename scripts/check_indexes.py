@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Проверить, что горячие запросы api.py идут по индексам (после migrate_hot_path_indexes.sql).
+Внутри одной транзакции создаются временные копии таблиц (LIKE ... INCLUDING ALL — вместе с индексами),
+заполняются синтетическими данными, по каждому запросу выполняется EXPLAIN; в конце — ROLLBACK,
+в БД ничего не остаётся. Запускать на тестовой БД (значения по умолчанию берут номера из последовательностей).
+Использование: python scripts/check_indexes.py
+Из корня проекта, с настроенным .env. Код выхода 1 — если какой-то запрос читает таблицу Seq Scan.
+"""
+import asyncio
+import json
+import os
+import sys
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+os.chdir(PROJECT_ROOT)
+sys.path.insert(0, PROJECT_ROOT)
+
+from dotenv import load_dotenv
+load_dotenv(os.path.join(PROJECT_ROOT, ".env"))
+
+import asyncpg
+from datetime import datetime
+
+from api import _STATEMENTS, _LIQUID_ASSET_TYPES, _LIQUID_LIABILITY_TYPES
+
+DB_NAME = os.getenv("DB_NAME", "").strip()
+DB_USER = os.getenv("DB_USER", "").strip()
+DB_PASSWORD = os.getenv("DB_PASSWORD") or ""
+DB_HOST = os.getenv("DB_HOST", "localhost").strip()
+DB_PORT = os.getenv("DB_PORT", "5432").strip()
+
+USERS = 200
+TX_PER_USER = 1500
+ITEMS_PER_USER = 5        # активов и долгов у каждого пользователя
+VALUES_PER_ITEM = 40      # записей истории значений на актив/долг
+MESSAGES_PER_USER = 300   # строк ai_context
+
+TABLES = (
+    "categories", "transactions", "assets", "asset_values",
+    "liabilities", "liability_values", "ai_context", "category_mapping",
+)
+
+SEED_SQL = [
+    """INSERT INTO categories (id, name, type)
+       SELECT g, 'Категория ' || g, CASE WHEN g <= 4 THEN 'Доход' ELSE 'Расход' END
+       FROM generate_series(1, 30) g""",
+    f"""INSERT INTO transactions (id, user_id, amount, category_id, description, created_at)
+        SELECT g, 1 + g % {USERS},
+               CASE WHEN g % 10 = 0 THEN 50000 ELSE -(100 + g % 5000) END,
+               1 + g % 30, 'Покупка ' || g % 997,
+               NOW() - (g % 730) * INTERVAL '1 day'
+        FROM generate_series(1, {USERS * TX_PER_USER}) g""",
+    f"""INSERT INTO assets (id, user_id, title, type, currency)
+        SELECT g, 1 + g % {USERS}, 'Актив ' || g,
+               (ARRAY['Депозит', 'Акции', 'Недвижимость', 'Наличные'])[1 + g % 4], 'RUB'
+        FROM generate_series(1, {USERS * ITEMS_PER_USER}) g""",
+    f"""INSERT INTO asset_values (asset_id, amount, created_at)
+        SELECT 1 + g % {USERS * ITEMS_PER_USER}, 1000 + g % 100000, NOW() - (g % 720) * INTERVAL '1 day'
+        FROM generate_series(1, {USERS * ITEMS_PER_USER * VALUES_PER_ITEM}) g""",
+    f"""INSERT INTO liabilities (id, user_id, title, type, currency)
+        SELECT g, 1 + g % {USERS}, 'Долг ' || g,
+               (ARRAY['Кредит', 'Ипотека', 'Кредитная карта'])[1 + g % 3], 'RUB'
+        FROM generate_series(1, {USERS * ITEMS_PER_USER}) g""",
+    f"""INSERT INTO liability_values (liability_id, amount, monthly_payment, created_at)
+        SELECT 1 + g % {USERS * ITEMS_PER_USER}, 1000 + g % 100000, 100 + g % 5000,
+               NOW() - (g % 720) * INTERVAL '1 day'
+        FROM generate_series(1, {USERS * ITEMS_PER_USER * VALUES_PER_ITEM}) g""",
+    f"""INSERT INTO ai_context (user_id, role, content, created_at)
+        SELECT 1 + g % {USERS},
+               CASE WHEN g % 30 IN (0, 1) THEN 'assistant' WHEN g % 2 = 0 THEN 'user' ELSE 'assistant' END,
+               CASE WHEN g % 30 = 0 THEN 'CONSULTATION: ответ ' || g
+                    WHEN g % 30 = 2 THEN 'FOLLOW_UP: вопрос ' || g
+                    ELSE 'сообщение ' || g END,
+               NOW() - (g % 365) * INTERVAL '1 day'
+        FROM generate_series(1, {USERS * MESSAGES_PER_USER}) g""",
+    """INSERT INTO category_mapping (bank_category, category_id, bank_category_type)
+       SELECT 'Категория банка ' || g, 1 + g % 30, CASE WHEN g % 2 = 0 THEN 'Расход' ELSE 'Доход' END
+       FROM generate_series(1, 5000) g""",
+]
+
+
+def _checks() -> list[tuple[str, str, tuple, tuple[str, ...]]]:
+    """(название, SQL, параметры, таблицы, которые не должны читаться Seq Scan)."""
+    month_start, month_end = datetime(datetime.now().year, 1, 1), datetime(datetime.now().year, 2, 1)
+    user_id = 7
+    return [
+        ("tx_list (месяц)", _STATEMENTS["tx_list"],
+         (user_id, month_start, month_end, None, None, None, 100, datetime.max, None), ("transactions",)),
+        ("tx_list (без фильтров)", _STATEMENTS["tx_list"],
+         (user_id, datetime.min, datetime.max, None, None, None, 100, datetime.max, None), ("transactions",)),
+        ("tx_list (глубокая страница)", _STATEMENTS["tx_list"],
+         (user_id, datetime.min, datetime.max, None, None, None, 100, datetime(2000, 1, 1), 1000), ("transactions",)),
+        ("tx_summary", _STATEMENTS["tx_summary"],
+         (user_id, month_start, month_end, None, None, False, None), ("transactions",)),
+        ("tx_list_search", _STATEMENTS["tx_list_search"],
+         (user_id, datetime.min, datetime.max, None, None, None, 100, datetime.max, None, "%покупка 42%"),
+         ("transactions",)),
+        ("tx_summary_search", _STATEMENTS["tx_summary_search"],
+         (user_id, datetime.min, datetime.max, None, None, None, None, "%покупка 42%"), ("transactions",)),
+        ("tx_monthly_raw_range", _STATEMENTS["tx_monthly_raw_range"],
+         (user_id, month_start.date(), month_end.date()), ("transactions",)),
+        ("stats_by_category_raw", _STATEMENTS["stats_by_category_raw"],
+         (user_id, month_start.date(), month_end.date()), ("transactions",)),
+        ("capital_snapshot", _STATEMENTS["capital_snapshot"],
+         (user_id, list(_LIQUID_ASSET_TYPES), list(_LIQUID_LIABILITY_TYPES)), ("assets", "liabilities")),
+        ("capital_snapshot_history", _STATEMENTS["capital_snapshot_history"],
+         (user_id, list(_LIQUID_ASSET_TYPES), list(_LIQUID_LIABILITY_TYPES)), ("asset_values", "liability_values")),
+        ("assets_latest_history", _STATEMENTS["assets_latest_history"], (user_id,), ("asset_values",)),
+        ("liabilities_latest_history", _STATEMENTS["liabilities_latest_history"], (user_id,), ("liability_values",)),
+        ("consultation_exists", _STATEMENTS["consultation_exists"], (user_id,), ("ai_context",)),
+        ("onboarding_progress_live", _STATEMENTS["onboarding_progress_live"], (user_id,),
+         ("transactions", "assets", "liabilities", "ai_context")),
+        ("consultation_days_since", _STATEMENTS["consultation_days_since"],
+         (user_id, month_start), ("ai_context",)),
+        ("consultation_last", _STATEMENTS["consultation_last"], (user_id,), ("ai_context",)),
+        ("consultation_history", _STATEMENTS["consultation_history"], (user_id,), ("ai_context",)),
+        ("category_mapping (импорт)",
+         """SELECT category_id FROM category_mapping
+            WHERE LOWER(TRIM(bank_category)) = $1 AND bank_category_type = $2""",
+         ("категория банка 42", "Расход"), ("category_mapping",)),
+    ]
+
+
+def _plan_nodes(plan: dict):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from _plan_nodes(child)
+
+
+def main():
+    if not DB_NAME or not DB_USER:
+        print("В .env задайте DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT.", file=sys.stderr)
+        sys.exit(1)
+
+    async def run() -> bool:
+        conn = await asyncpg.connect(
+            user=DB_USER, password=DB_PASSWORD, database=DB_NAME,
+            host=DB_HOST, port=DB_PORT,
+        )
+        ok = True
+        tr = conn.transaction()
+        await tr.start()
+        try:
+            # Временные таблицы с теми же именами перекрывают public.* (pg_temp первым в search_path)
+            for table in TABLES:
+                await conn.execute(f"CREATE TEMP TABLE {table} (LIKE public.{table} INCLUDING ALL)")
+            for sql in SEED_SQL:
+                await conn.execute(sql)
+            for table in TABLES:
+                await conn.execute(f"ANALYZE {table}")
+
+            for title, sql, args, tables in _checks():
+                raw = await conn.fetchval("EXPLAIN (FORMAT JSON) " + sql, *args)
+                plan = json.loads(raw)[0]["Plan"]
+                scans = []
+                failed = False
+                for node in _plan_nodes(plan):
+                    relation = node.get("Relation Name")
+                    if not relation:
+                        continue
+                    index = node.get("Index Name")
+                    scans.append(f"{node['Node Type']} {relation}" + (f" ({index})" if index else ""))
+                    if node["Node Type"] == "Seq Scan" and relation in tables:
+                        failed = True
+                ok = ok and not failed
+                print(f"{'FAIL' if failed else 'OK  '} {title}: " + "; ".join(scans))
+        finally:
+            await tr.rollback()
+            await conn.close()
+        return ok
+
+    if not asyncio.run(run()):
+        print("Есть запросы без индекса — примените scripts/migrate_hot_path_indexes.sql.", file=sys.stderr)
+        sys.exit(1)
+    print("Все горячие запросы используют индексы.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+-- Текущие значения активов и долгов прямо в assets/liabilities (current_amount, current_monthly_payment, current_as_of).
+-- api.py обновляет их тем же запросом, что добавляет запись в asset_values/liability_values,
+-- поэтому «текущий капитал» считается простым SUM по assets/liabilities без подзапросов по истории.
+-- Применение: python scripts/apply_migration.py scripts/migrate_current_balances.sql
+-- Проверка/исправление расхождений с историей: python scripts/repair_current_balances.py
+ALTER TABLE assets ADD COLUMN IF NOT EXISTS current_amount NUMERIC;
+ALTER TABLE assets ADD COLUMN IF NOT EXISTS current_as_of TIMESTAMP;
+ALTER TABLE liabilities ADD COLUMN IF NOT EXISTS current_amount NUMERIC;
+ALTER TABLE liabilities ADD COLUMN IF NOT EXISTS current_monthly_payment NUMERIC;
+ALTER TABLE liabilities ADD COLUMN IF NOT EXISTS current_as_of TIMESTAMP;
+
+-- Начальное заполнение из последних значений истории
+UPDATE assets a
+SET current_amount = v.amount, current_as_of = v.created_at
+FROM (
+    SELECT DISTINCT ON (asset_id) asset_id, amount, created_at
+    FROM asset_values
+    ORDER BY asset_id, created_at DESC
+) v
+WHERE v.asset_id = a.id AND a.current_as_of IS NULL;
+
+UPDATE liabilities l
+SET current_amount = v.amount, current_monthly_payment = v.monthly_payment, current_as_of = v.created_at
+FROM (
+    SELECT DISTINCT ON (liability_id) liability_id, amount, monthly_payment, created_at
+    FROM liability_values
+    ORDER BY liability_id, created_at DESC
+) v
+WHERE v.liability_id = l.id AND l.current_as_of IS NULL;
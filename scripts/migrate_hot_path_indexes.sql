@@ -0,0 +1,49 @@
+-- Индексы под запросы api.py (список/сводка транзакций, последние значения активов и долгов,
+-- консультации в ai_context, маппинг категорий банка при импорте).
+-- CONCURRENTLY: таблицы не блокируются на запись, миграцию можно применять на работающем проде.
+-- apply_migration.py выполняет команды по одной вне транзакции — это обязательно для CONCURRENTLY.
+-- Если построение прервалось, индекс остаётся INVALID и IF NOT EXISTS его пропустит:
+-- удалите его (DROP INDEX CONCURRENTLY <имя>;) и примените миграцию ещё раз.
+-- Проверка планов: python scripts/check_indexes.py
+-- Применение: python scripts/apply_migration.py scripts/migrate_hot_path_indexes.sql
+
+-- Почти все эндпоинты: WHERE user_id = $1 AND created_at >= $2 AND created_at < $3 ORDER BY created_at DESC
+CREATE INDEX CONCURRENTLY IF NOT EXISTS transactions_user_created_idx
+    ON transactions (user_id, created_at DESC, id DESC);
+
+-- Последнее значение актива/долга: WHERE asset_id = a.id ORDER BY created_at DESC LIMIT 1
+CREATE INDEX CONCURRENTLY IF NOT EXISTS asset_values_asset_created_idx
+    ON asset_values (asset_id, created_at DESC) INCLUDE (amount);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS liability_values_liability_created_idx
+    ON liability_values (liability_id, created_at DESC) INCLUDE (amount, monthly_payment);
+
+-- Активы/долги пользователя с фильтром по типу (ликвидный капитал)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS assets_user_type_idx
+    ON assets (user_id, type);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS liabilities_user_type_idx
+    ON liabilities (user_id, type);
+
+-- Консультации: role = 'assistant' AND content LIKE 'CONSULTATION:%' (лимит сессий, последняя консультация, онбординг).
+-- Частичный индекс содержит только строки консультаций; условие в запросах должно совпадать с WHERE индекса.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ai_context_consultation_idx
+    ON ai_context (user_id, created_at DESC)
+    WHERE role = 'assistant' AND content LIKE 'CONSULTATION:%';
+
+-- Уточняющие вопросы (история консультаций: OR с условием выше → BitmapOr двух частичных индексов)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ai_context_follow_up_idx
+    ON ai_context (user_id, created_at)
+    WHERE role = 'user' AND content LIKE 'FOLLOW_UP:%';
+
+-- _resolve_bank_category_to_id: WHERE LOWER(TRIM(bank_category)) = $1 AND bank_category_type = $2
+CREATE INDEX CONCURRENTLY IF NOT EXISTS category_mapping_bank_category_idx
+    ON category_mapping ((LOWER(TRIM(bank_category))), bank_category_type);
+
+ANALYZE transactions;
+ANALYZE asset_values;
+ANALYZE liability_values;
+ANALYZE assets;
+ANALYZE liabilities;
+ANALYZE ai_context;
+ANALYZE category_mapping;
@@ -0,0 +1,19 @@
+-- Поиск по описанию транзакций (q в /api/transactions и /api/transactions/summary).
+-- tx_search_norm: нижний регистр и ё → е. Кириллица переводится явно — lower() в локали C её не трогает.
+-- Индекс GIN (user_id, tx_search_norm(description) gin_trgm_ops): триграммы ищут подстроку LIKE '%...%',
+-- user_id в том же индексе (btree_gin) — чтобы не перебирать совпадения других пользователей.
+-- pg_trgm и btree_gin — trusted-расширения (PostgreSQL 13+): достаточно прав владельца БД.
+-- CONCURRENTLY: apply_migration.py выполняет команды по одной вне транзакции.
+-- Если построение индекса прервалось: DROP INDEX CONCURRENTLY transactions_description_trgm_idx; и повторить.
+-- Применение: python scripts/apply_migration.py scripts/migrate_transactions_search.sql
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE EXTENSION IF NOT EXISTS btree_gin;
+
+CREATE OR REPLACE FUNCTION tx_search_norm(text) RETURNS text
+    LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE
+    AS $$ SELECT translate(lower($1), 'АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯё', 'абвгдеежзийклмнопрстуфхцчшщъыьэюяе') $$;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS transactions_description_trgm_idx
+    ON transactions USING gin (user_id, tx_search_norm(description) gin_trgm_ops);
+
+ANALYZE transactions;
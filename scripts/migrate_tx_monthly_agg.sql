@@ -0,0 +1,39 @@
+-- Помесячная сводка транзакций: (пользователь, год, месяц, категория) → доход, расход, количество.
+-- Её читают статистика, бенчмарки, алерты, бейджи и прогноз по целям вместо сканирования transactions;
+-- api.py обновляет сводку в той же транзакции БД, что и запись в transactions.
+-- category_id = 0 — транзакции без категории.
+-- Применение: python scripts/apply_migration.py scripts/migrate_tx_monthly_agg.sql
+-- Полная пересборка (после ручных правок transactions в БД): python scripts/rebuild_tx_monthly_agg.py
+--
+-- apply_migration.py фиксирует каждую команду отдельно, поэтому сводка строится под другим именем
+-- и переименовывается в той же транзакции, что и заполнение: пока tx_monthly_agg нет, API читает
+-- transactions напрямую и не пишет в сводку, а появляется она сразу заполненной.
+-- SHARE-блокировка (как в rebuild_tx_monthly_agg.py) не даёт API менять transactions до COMMIT,
+-- иначе запись между заполнением и переименованием не попала бы в сводку; чтение не блокируется.
+-- При ошибке соединение закрывается и транзакция откатывается целиком. Повторно не применяется
+-- (tx_monthly_agg уже есть — команда завершится ошибкой, ничего не изменится); для пересчёта — rebuild_tx_monthly_agg.py.
+BEGIN;
+
+LOCK TABLE transactions IN SHARE MODE;
+
+CREATE TABLE tx_monthly_agg_build (
+    user_id     INTEGER NOT NULL,
+    year        INTEGER NOT NULL,
+    month       INTEGER NOT NULL,
+    category_id INTEGER NOT NULL,
+    income      NUMERIC NOT NULL DEFAULT 0,
+    expense     NUMERIC NOT NULL DEFAULT 0,
+    count       INTEGER NOT NULL DEFAULT 0,
+    CONSTRAINT tx_monthly_agg_pkey PRIMARY KEY (user_id, year, month, category_id)
+);
+
+INSERT INTO tx_monthly_agg_build (user_id, year, month, category_id, income, expense, count)
+SELECT user_id, EXTRACT(YEAR FROM created_at)::int, EXTRACT(MONTH FROM created_at)::int,
+       COALESCE(category_id, 0),
+       SUM(GREATEST(amount, 0)), SUM(GREATEST(-amount, 0)), COUNT(*)
+FROM transactions
+GROUP BY 1, 2, 3, 4;
+
+ALTER TABLE tx_monthly_agg_build RENAME TO tx_monthly_agg;
+
+COMMIT;
@@ -0,0 +1,13 @@
+-- Сохранённые бейджи и алерты пользователя (/api/badges, /api/alerts, раздел дашборда).
+-- Результат действителен, пока не изменилась users.data_version (любая запись через API) и не начался
+-- новый месяц (period); иначе правила пересчитываются при следующем запросе и строка перезаписывается.
+-- Нужна migrate_users_data_version.sql. Без таблицы бейджи и алерты считаются на каждый запрос.
+-- Применение: python scripts/apply_migration.py scripts/migrate_user_insights.sql
+CREATE TABLE IF NOT EXISTS user_insights (
+    user_id      INTEGER PRIMARY KEY,
+    data_version BIGINT NOT NULL,
+    period       DATE NOT NULL,
+    badges       JSONB NOT NULL,
+    alerts       JSONB NOT NULL,
+    evaluated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
@@ -0,0 +1,5 @@
+-- Версия данных пользователя: растёт при каждом изменяющем запросе к API (транзакции, импорт, цели,
+-- бюджеты, активы, долги, профиль, удаление данных). По ней api.py кэширует GET-ответы в памяти.
+-- Без колонки кэш ответов просто не используется.
+-- Применение: python scripts/apply_migration.py scripts/migrate_users_data_version.sql
+ALTER TABLE users ADD COLUMN IF NOT EXISTS data_version BIGINT NOT NULL DEFAULT 0;
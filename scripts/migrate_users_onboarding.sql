@@ -0,0 +1,8 @@
+-- Пройденные шаги онбординга (1 транзакция, 1 актив/долг, 1 консультация). Шаг отмечается один раз,
+-- когда /api/onboarding-progress впервые его увидит, и сбрасывается только при удалении всех данных:
+-- у прошедших онбординг пользователей запрос читает только строку users.
+-- Без колонок флаги считаются по таблицам при каждом запросе.
+-- Применение: python scripts/apply_migration.py scripts/migrate_users_onboarding.sql
+ALTER TABLE users ADD COLUMN IF NOT EXISTS onboarding_transactions BOOLEAN NOT NULL DEFAULT FALSE;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS onboarding_capital BOOLEAN NOT NULL DEFAULT FALSE;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS onboarding_consultation BOOLEAN NOT NULL DEFAULT FALSE;
@@ -0,0 +1,103 @@
+-- Уникальность users.tg_id: нужна для INSERT ... ON CONFLICT (tg_id) в users_db.provision_user.
+-- Если в БД уже есть UNIQUE на tg_id, команда ничего не делает.
+-- Применение: python scripts/apply_migration.py scripts/migrate_users_tg_id_unique.sql
+--
+-- Старая регистрация (SELECT → INSERT) при параллельных первых запросах могла создать несколько
+-- пользователей с одним tg_id, и тогда CREATE UNIQUE INDEX падает. Поэтому сначала дубликаты
+-- сливаются в пользователя с наименьшим id: его строки в users остаются, данные дубликатов
+-- (транзакции, цели, активы, долги, история AI и т.д. — все таблицы с колонкой user_id)
+-- переносятся к нему, сами дубликаты удаляются. Всё в одной транзакции; при ошибке ничего не меняется.
+-- Блокировка users не даёт зарегистрировать нового пользователя до COMMIT; чтение не блокируется.
+BEGIN;
+
+LOCK TABLE users IN SHARE ROW EXCLUSIVE MODE;
+
+CREATE TEMP TABLE users_tg_id_dups ON COMMIT DROP AS
+SELECT u.id AS dup_id, k.keep_id
+FROM users u
+JOIN (
+    SELECT tg_id, MIN(id) AS keep_id
+    FROM users
+    WHERE tg_id IS NOT NULL
+    GROUP BY tg_id
+    HAVING COUNT(*) > 1
+) k ON k.tg_id = u.tg_id AND u.id <> k.keep_id;
+
+-- Подписка — самая поздняя из дубликатов, имя — первое непустое
+UPDATE users k
+SET premium_until = GREATEST(k.premium_until, d.premium_until),
+    username = COALESCE(k.username, d.username)
+FROM (
+    SELECT d.keep_id, MAX(u.premium_until) AS premium_until, MAX(u.username) AS username
+    FROM users_tg_id_dups d
+    JOIN users u ON u.id = d.dup_id
+    GROUP BY d.keep_id
+) d
+WHERE k.id = d.keep_id;
+
+DO $$
+DECLARE
+    t TEXT;
+BEGIN
+    -- Сводка: суммы дубликатов прибавляются к сводке оставшегося пользователя
+    IF to_regclass('tx_monthly_agg') IS NOT NULL THEN
+        INSERT INTO tx_monthly_agg AS a (user_id, year, month, category_id, income, expense, count)
+        SELECT d.keep_id, x.year, x.month, x.category_id, SUM(x.income), SUM(x.expense), SUM(x.count)
+        FROM tx_monthly_agg x
+        JOIN users_tg_id_dups d ON d.dup_id = x.user_id
+        GROUP BY 1, 2, 3, 4
+        ON CONFLICT (user_id, year, month, category_id) DO UPDATE
+        SET income = a.income + EXCLUDED.income,
+            expense = a.expense + EXCLUDED.expense,
+            count = a.count + EXCLUDED.count;
+        DELETE FROM tx_monthly_agg x USING users_tg_id_dups d WHERE x.user_id = d.dup_id;
+    END IF;
+    -- Кэш бейджей и алертов пересчитается сам (data_version ниже растёт)
+    IF to_regclass('user_insights') IS NOT NULL THEN
+        DELETE FROM user_insights x USING users_tg_id_dups d WHERE x.user_id = d.dup_id;
+    END IF;
+    -- Уникальные ключи на пользователя: при совпадении остаётся строка с наименьшим user_id
+    IF to_regclass('budgets') IS NOT NULL THEN
+        DELETE FROM budgets b USING users_tg_id_dups d
+        WHERE b.user_id = d.dup_id AND EXISTS (
+            SELECT 1 FROM budgets o
+            LEFT JOIN users_tg_id_dups od ON od.dup_id = o.user_id
+            WHERE COALESCE(od.keep_id, o.user_id) = d.keep_id
+              AND o.category = b.category AND o.user_id < b.user_id
+        );
+    END IF;
+    IF to_regclass('user_focus_goal') IS NOT NULL THEN
+        DELETE FROM user_focus_goal g USING users_tg_id_dups d
+        WHERE g.user_id = d.dup_id AND EXISTS (
+            SELECT 1 FROM user_focus_goal o
+            LEFT JOIN users_tg_id_dups od ON od.dup_id = o.user_id
+            WHERE COALESCE(od.keep_id, o.user_id) = d.keep_id
+              AND o.for_month = g.for_month AND o.for_year = g.for_year AND o.user_id < g.user_id
+        );
+    END IF;
+    -- Остальные таблицы с user_id — просто перенос строк
+    FOR t IN
+        SELECT c.table_name
+        FROM information_schema.columns c
+        JOIN information_schema.tables tb
+          ON tb.table_schema = c.table_schema AND tb.table_name = c.table_name
+        WHERE c.table_schema = current_schema() AND c.column_name = 'user_id'
+          AND tb.table_type = 'BASE TABLE'
+    LOOP
+        EXECUTE format(
+            'UPDATE %I x SET user_id = d.keep_id FROM users_tg_id_dups d WHERE x.user_id = d.dup_id', t
+        );
+    END LOOP;
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'users' AND column_name = 'data_version'
+    ) THEN
+        EXECUTE 'UPDATE users SET data_version = data_version + 1 WHERE id IN (SELECT keep_id FROM users_tg_id_dups)';
+    END IF;
+END $$;
+
+DELETE FROM users u USING users_tg_id_dups d WHERE u.id = d.dup_id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS users_tg_id_uidx ON users (tg_id);
+
+COMMIT;
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Пересобрать помесячную сводку tx_monthly_agg из transactions (всю или одного пользователя).
+Нужно после ручных правок transactions в БД или если сводка разошлась с данными.
+Использование: python scripts/rebuild_tx_monthly_agg.py [users.id]
+Из корня проекта, с настроенным .env. Запись транзакций на время пересборки блокируется (чтение — нет).
+"""
+import asyncio
+import os
+import sys
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+os.chdir(PROJECT_ROOT)
+sys.path.insert(0, PROJECT_ROOT)
+
+from dotenv import load_dotenv
+load_dotenv(os.path.join(PROJECT_ROOT, ".env"))
+
+import asyncpg
+
+DB_NAME = os.getenv("DB_NAME", "").strip()
+DB_USER = os.getenv("DB_USER", "").strip()
+DB_PASSWORD = os.getenv("DB_PASSWORD") or ""
+DB_HOST = os.getenv("DB_HOST", "localhost").strip()
+DB_PORT = os.getenv("DB_PORT", "5432").strip()
+
+# $1 — users.id или NULL (все пользователи)
+DELETE_SQL = "DELETE FROM tx_monthly_agg WHERE $1::int IS NULL OR user_id = $1::int"
+INSERT_SQL = """
+    INSERT INTO tx_monthly_agg (user_id, year, month, category_id, income, expense, count)
+    SELECT user_id, EXTRACT(YEAR FROM created_at)::int, EXTRACT(MONTH FROM created_at)::int,
+           COALESCE(category_id, 0),
+           SUM(GREATEST(amount, 0)), SUM(GREATEST(-amount, 0)), COUNT(*)
+    FROM transactions
+    WHERE $1::int IS NULL OR user_id = $1::int
+    GROUP BY 1, 2, 3, 4
+"""
+
+
+def main():
+    if not DB_NAME or not DB_USER:
+        print("В .env задайте DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT.", file=sys.stderr)
+        sys.exit(1)
+    user_id = None
+    if len(sys.argv) > 1:
+        try:
+            user_id = int(sys.argv[1])
+        except ValueError:
+            print("users.id должен быть числом: python scripts/rebuild_tx_monthly_agg.py 42", file=sys.stderr)
+            sys.exit(1)
+
+    async def run():
+        conn = await asyncpg.connect(
+            user=DB_USER, password=DB_PASSWORD, database=DB_NAME,
+            host=DB_HOST, port=DB_PORT,
+        )
+        try:
+            async with conn.transaction():
+                # SHARE: API не может менять transactions, пока сводка пересобирается,
+                # иначе дельта параллельной записи потеряется между DELETE и INSERT
+                await conn.execute("LOCK TABLE transactions IN SHARE MODE")
+                await conn.execute(DELETE_SQL, user_id)
+                status = await conn.execute(INSERT_SQL, user_id)
+        finally:
+            await conn.close()
+        return status
+
+    status = asyncio.run(run())
+    who = f"пользователя {user_id}" if user_id is not None else "всех пользователей"
+    print(f"Сводка tx_monthly_agg пересобрана для {who}: {status.split()[-1]} строк.")
+
+
+if __name__ == "__main__":
+    main()
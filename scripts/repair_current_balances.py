@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Сверить assets/liabilities.current_* с последними значениями из asset_values/liability_values и исправить расхождения.
+Нужно после ручных правок истории значений в БД (api.py поддерживает current_* сам).
+Использование: python scripts/repair_current_balances.py [users.id]
+Из корня проекта, с настроенным .env.
+"""
+import asyncio
+import os
+import sys
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+os.chdir(PROJECT_ROOT)
+sys.path.insert(0, PROJECT_ROOT)
+
+from dotenv import load_dotenv
+load_dotenv(os.path.join(PROJECT_ROOT, ".env"))
+
+import asyncpg
+
+DB_NAME = os.getenv("DB_NAME", "").strip()
+DB_USER = os.getenv("DB_USER", "").strip()
+DB_PASSWORD = os.getenv("DB_PASSWORD") or ""
+DB_HOST = os.getenv("DB_HOST", "localhost").strip()
+DB_PORT = os.getenv("DB_PORT", "5432").strip()
+
+# $1 — users.id или NULL (все). Позиции без истории значений получают NULL.
+REPAIR_ASSETS_SQL = """
+    UPDATE assets a
+    SET current_amount = v.amount, current_as_of = v.created_at
+    FROM assets a2
+    LEFT JOIN LATERAL (
+        SELECT amount, created_at FROM asset_values
+        WHERE asset_id = a2.id ORDER BY created_at DESC LIMIT 1
+    ) v ON TRUE
+    WHERE a2.id = a.id
+      AND ($1::int IS NULL OR a.user_id = $1::int)
+      AND (a.current_amount IS DISTINCT FROM v.amount OR a.current_as_of IS DISTINCT FROM v.created_at)
+"""
+REPAIR_LIABILITIES_SQL = """
+    UPDATE liabilities l
+    SET current_amount = v.amount, current_monthly_payment = v.monthly_payment, current_as_of = v.created_at
+    FROM liabilities l2
+    LEFT JOIN LATERAL (
+        SELECT amount, monthly_payment, created_at FROM liability_values
+        WHERE liability_id = l2.id ORDER BY created_at DESC LIMIT 1
+    ) v ON TRUE
+    WHERE l2.id = l.id
+      AND ($1::int IS NULL OR l.user_id = $1::int)
+      AND (l.current_amount IS DISTINCT FROM v.amount
+           OR l.current_monthly_payment IS DISTINCT FROM v.monthly_payment
+           OR l.current_as_of IS DISTINCT FROM v.created_at)
+"""
+
+
+def main():
+    if not DB_NAME or not DB_USER:
+        print("В .env задайте DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT.", file=sys.stderr)
+        sys.exit(1)
+    user_id = None
+    if len(sys.argv) > 1:
+        try:
+            user_id = int(sys.argv[1])
+        except ValueError:
+            print("users.id должен быть числом: python scripts/repair_current_balances.py 42", file=sys.stderr)
+            sys.exit(1)
+
+    async def run():
+        conn = await asyncpg.connect(
+            user=DB_USER, password=DB_PASSWORD, database=DB_NAME,
+            host=DB_HOST, port=DB_PORT,
+        )
+        try:
+            async with conn.transaction():
+                assets_status = await conn.execute(REPAIR_ASSETS_SQL, user_id)
+                liabilities_status = await conn.execute(REPAIR_LIABILITIES_SQL, user_id)
+        finally:
+            await conn.close()
+        return int(assets_status.split()[-1]), int(liabilities_status.split()[-1])
+
+    fixed_assets, fixed_liabilities = asyncio.run(run())
+    print(f"Исправлено активов: {fixed_assets}, долгов: {fixed_liabilities}.")
+
+
+if __name__ == "__main__":
+    main()
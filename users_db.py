@@ -0,0 +1,73 @@
+# Общая логика работы с таблицей users для api.py и bot.py
+from __future__ import annotations
+
+import logging
+from datetime import datetime
+from typing import Optional
+
+import asyncpg
+
+# Один запрос вместо select → insert → re-select → update.
+# ON CONFLICT ... DO UPDATE ... WHERE переписывает username только при реальном изменении;
+# если обновлять нечего, RETURNING пуст и строка берётся вторым SELECT того же запроса.
+# xmax = 0 — строка только что вставлена (новый пользователь).
+_PROVISION_USER_SQL = """
+    WITH upsert AS (
+        INSERT INTO users (tg_id, username, created_at, premium_until)
+        VALUES ($1, $2, NOW(), $3)
+        ON CONFLICT (tg_id) DO UPDATE
+            SET username = EXCLUDED.username
+            WHERE EXCLUDED.username IS NOT NULL
+              AND users.username IS DISTINCT FROM EXCLUDED.username
+        RETURNING id, premium_until, (xmax = 0) AS is_new
+    )
+    SELECT id, premium_until, is_new FROM upsert
+    UNION ALL
+    SELECT id, premium_until, FALSE FROM users
+    WHERE tg_id = $1 AND NOT EXISTS (SELECT 1 FROM upsert)
+"""
+
+
+async def _provision_user_legacy(conn, tg_id: int, username: Optional[str], premium_until: Optional[datetime]):
+    """Прежний путь select → insert → re-select для БД без уникального индекса на users.tg_id."""
+    row = await conn.fetchrow("SELECT id, premium_until, username FROM users WHERE tg_id=$1 ORDER BY id LIMIT 1", tg_id)
+    if not row:
+        await conn.execute(
+            "INSERT INTO users (tg_id, username, created_at, premium_until) VALUES ($1, $2, NOW(), $3)",
+            tg_id, username, premium_until
+        )
+        row = await conn.fetchrow("SELECT id, premium_until FROM users WHERE tg_id=$1 ORDER BY id LIMIT 1", tg_id)
+        return {"id": row["id"], "premium_until": row["premium_until"], "is_new": True}
+    if username and row["username"] != username:
+        await conn.execute("UPDATE users SET username=$1 WHERE tg_id=$2", username, tg_id)
+    return {"id": row["id"], "premium_until": row["premium_until"], "is_new": False}
+
+
+async def provision_user(
+    conn,
+    tg_id: int,
+    username: Optional[str] = None,
+    premium_until: Optional[datetime] = None,
+):
+    """Получить или создать пользователя за один round trip.
+
+    Args:
+        conn: соединение asyncpg
+        tg_id: Telegram user ID
+        username: имя для отображения; пустое значение не затирает сохранённое
+        premium_until: срок подписки для НОВОГО пользователя (пробный период); у существующих не меняется
+
+    Returns:
+        asyncpg.Record (или dict без миграции tg_id): (id, premium_until, is_new)
+    """
+    try:
+        row = await conn.fetchrow(_PROVISION_USER_SQL, tg_id, username or None, premium_until)
+    except asyncpg.InvalidColumnReferenceError:
+        # ON CONFLICT (tg_id) без уникального индекса: миграция ещё не применена
+        logging.warning("users.tg_id has no unique index; run migrate_users_tg_id_unique.sql")
+        return await _provision_user_legacy(conn, tg_id, username or None, premium_until)
+    if row is None:
+        # Параллельная вставка того же tg_id закоммичена после снимка нашего запроса:
+        # конфликт уже разрешён, повтор увидит строку.
+        row = await conn.fetchrow(_PROVISION_USER_SQL, tg_id, username or None, premium_until)
+    return row